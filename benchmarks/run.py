@@ -0,0 +1,219 @@
+''' Forward+backward throughput and peak memory of the retrieval reasoning
+    models on synthetic contexts, using a tiny RoBERTa on CPU.
+
+    $ python -m benchmarks.run --out runs/bench.json
+    $ python -m benchmarks.run --baseline benchmarks/baseline.json      # exits 1 on a regression
+    $ python -m benchmarks.run --baseline benchmarks/baseline.json --save-baseline
+
+    Each model runs in a fresh process so its peak memory is not mixed up
+    with the other models'.
+
+    Throughput and memory depend on the machine, so no baseline is
+    committed: save one with --save-baseline on the machine you compare on.
+'''
+import argparse
+import json
+import logging
+import multiprocessing as mp
+import os
+import queue as queue_module
+import resource
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+MODELS = ['gumbel_softmax_unified', 'gumbel_softmax_pg', 'variational_inference_base', 'transformer_binary_qa_retriever']
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux and bytes on macOS
+    scale = 1024 ** 2 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def build_model(name, model_dir, vocab, topk):
+    from ruletaker.allennlp_models.dataset_readers.retrieval_reasoning_reader import RetrievalReasoningReader
+    from ruletaker.allennlp_models.models.gumbel_softmax import (
+        GumbelSoftmaxRetrieverReasoner, ProgressiveDeepeningGumbelSoftmaxRetsrieverReasoner
+    )
+    from ruletaker.allennlp_models.models.replay_buffer import ReplayMemory
+    from ruletaker.allennlp_models.models.transformer_binary_qa_model import TransformerBinaryQA
+    from ruletaker.allennlp_models.models.transformer_binary_qa_retriever import TransformerBinaryQARetriever
+    from ruletaker.allennlp_models.models.vi import ELBO
+
+    # Same reader settings as the bin/config experiments of each model
+    reader = RetrievalReasoningReader(
+        pretrained_model=model_dir, retriever_variant=model_dir, topk=topk,
+        concat_q_and_c=(name != 'transformer_binary_qa_retriever'),
+    )
+    qa_model = TransformerBinaryQA(vocab, pretrained_model=model_dir)
+    kwargs = dict(qa_model=qa_model, variant=model_dir, vocab=vocab, topk=topk, dataset_reader=reader)
+
+    if name == 'gumbel_softmax_unified':
+        model = GumbelSoftmaxRetrieverReasoner(**kwargs)
+    elif name == 'gumbel_softmax_pg':
+        model = ProgressiveDeepeningGumbelSoftmaxRetsrieverReasoner(**kwargs)
+        model._replay_memory = ReplayMemory()
+    elif name == 'variational_inference_base':
+        model = ELBO(**kwargs)
+    elif name == 'transformer_binary_qa_retriever':
+        model = TransformerBinaryQARetriever(**kwargs)
+    else:
+        raise ValueError(f"Unknown benchmark model: {name}.\nInvestigate!")
+    return model, reader
+
+
+def run_case(name, args):
+    ''' Time forward+backward of one model over a fixed synthetic batch.
+    '''
+    import torch
+    from allennlp.data import Vocabulary
+    from allennlp.data.dataloader import allennlp_collate
+
+    from .synthetic import make_examples, write_tiny_roberta
+
+    os.environ.setdefault('WANDB_LOG', 'false')
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.num_threads)
+
+    model_name = f'tiny-roberta-h{args.hidden_size}-l{args.num_layers}-a{args.num_heads}'
+    model_dir = write_tiny_roberta(
+        os.path.join(args.work_dir, model_name), args.hidden_size, args.num_layers, args.num_heads
+    )
+    start_rss = _peak_rss_mb()
+
+    vocab = Vocabulary()
+    model, reader = build_model(name, model_dir, vocab, args.proof_length)
+    model.train()
+
+    examples = make_examples(args.batch_size, args.num_sentences, args.proof_length, args.seed)
+    instances = [reader.text_to_instance(**example) for example in examples]
+    for instance in instances:
+        instance.index_fields(vocab)
+    batch = allennlp_collate(instances)
+
+    def step():
+        model.zero_grad()
+        output = model(**batch)
+        output['loss'].mean().backward()
+
+    for _ in range(args.warmup_steps):
+        step()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        step()
+    elapsed = time.perf_counter() - start
+
+    return {
+        'examples_per_sec': args.batch_size * args.steps / elapsed,
+        'step_ms': 1000 * elapsed / args.steps,
+        'peak_memory_mb': _peak_rss_mb(),
+        'peak_memory_delta_mb': _peak_rss_mb() - start_rss,
+    }
+
+
+def _run_case_in_process(name, args, queue):
+    try:
+        queue.put((name, run_case(name, args), None))
+    except Exception as e:
+        logger.exception(f"Benchmark {name} failed")
+        queue.put((name, None, repr(e)))
+
+
+def run_all(args):
+    ctx = mp.get_context('spawn')
+    results = {}
+    for name in args.models:
+        queue = ctx.Queue()
+        process = ctx.Process(target=_run_case_in_process, args=(name, args, queue))
+        process.start()
+        while True:
+            try:
+                _, result, error = queue.get(timeout=1)
+                break
+            except queue_module.Empty:
+                if not process.is_alive():
+                    raise RuntimeError(f"Benchmark {name} exited with code {process.exitcode}")
+        process.join()
+        if error is not None:
+            raise RuntimeError(f"Benchmark {name} failed: {error}")
+        results[name] = result
+        logger.info(f"{name}: {result['examples_per_sec']:.2f} examples/sec, {result['peak_memory_delta_mb']:.1f} MB")
+    return results
+
+
+def compare(results, baseline, tolerance):
+    ''' Returns the (model, metric, value, baseline value) of every result
+        which is more than `tolerance` worse than the baseline.
+    '''
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result['examples_per_sec'] < (1 - tolerance) * base['examples_per_sec']:
+            regressions.append((name, 'examples_per_sec', result['examples_per_sec'], base['examples_per_sec']))
+        if result['peak_memory_delta_mb'] > (1 + tolerance) * base['peak_memory_delta_mb']:
+            regressions.append((name, 'peak_memory_delta_mb', result['peak_memory_delta_mb'], base['peak_memory_delta_mb']))
+    return regressions
+
+
+def print_table(results, baseline):
+    print(f"{'model':<36}{'ex/sec':>10}{'step_ms':>10}{'peak_mb':>10}{'delta_mb':>10}{'vs_base':>10}")
+    for name, r in results.items():
+        speedup = r['examples_per_sec'] / baseline[name]['examples_per_sec'] if name in baseline else float('nan')
+        print(f"{name:<36}{r['examples_per_sec']:>10.2f}{r['step_ms']:>10.1f}"
+              f"{r['peak_memory_mb']:>10.1f}{r['peak_memory_delta_mb']:>10.1f}{speedup:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--models', nargs='+', default=MODELS, choices=MODELS)
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--num-sentences', type=int, default=20, help='context sentences per example')
+    parser.add_argument('--proof-length', type=int, default=3, help='proof sentences per example (and topk)')
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--warmup-steps', type=int, default=2)
+    parser.add_argument('--hidden-size', type=int, default=32)
+    parser.add_argument('--num-layers', type=int, default=2)
+    parser.add_argument('--num-heads', type=int, default=2)
+    parser.add_argument('--num-threads', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', type=str, default='benchmarks/.cache', help='where the tiny model is written')
+    parser.add_argument('--out', type=str, default=None, help='write results to this JSON file')
+    parser.add_argument('--baseline', type=str, default=None, help='baseline JSON to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='overwrite the baseline with these results')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative slowdown / memory growth')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    results = run_all(args)
+    settings = {k: v for k, v in vars(args).items() if k not in ('out', 'baseline', 'save_baseline', 'models', 'tolerance', 'work_dir')}
+    report = {'settings': settings, 'results': results}
+
+    baseline = {}
+    if args.baseline is not None and os.path.isfile(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        if stored['settings'] != settings:
+            logger.warning(f"Baseline settings differ from this run: {stored['settings']}")
+        baseline = stored['results']
+    elif args.baseline is not None and not args.save_baseline:
+        logger.warning(f"No baseline at {args.baseline}, generate one on this machine with --save-baseline")
+    print_table(results, baseline)
+
+    for path in [args.out, args.baseline if args.save_baseline else None]:
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    regressions = compare(results, baseline, args.tolerance)
+    for name, metric, value, base in regressions:
+        print(f"REGRESSION {name} {metric}: {value:.2f} (baseline {base:.2f})")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
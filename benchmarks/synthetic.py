@@ -0,0 +1,130 @@
+''' Synthetic rule-reasoning examples and a tiny, randomly initialized
+    RoBERTa (config, weights and tokenizer) to benchmark the models on CPU
+    without downloading anything.
+'''
+import json
+import os
+import random
+
+import numpy as np
+
+ENTITIES = ['lion', 'dog', 'rabbit', 'cat', 'mouse', 'tiger', 'bear', 'cow', 'squirrel', 'eagle']
+ATTRIBUTES = [
+    'red', 'blue', 'green', 'big', 'small', 'round', 'cold', 'kind', 'nice', 'rough',
+    'young', 'quiet', 'smart', 'white', 'furry', 'furious', 'heavy', 'sleepy', 'strong', 'quick',
+]
+FUNCTION_WORDS = ['The', 'If', 'someone', 'is', 'then', 'they', 'are', 'not', 'and', 'E', 'True', 'False', 'q', 'c']
+SPECIAL_TOKENS = ['<s>', '<pad>', '</s>', '<unk>']
+
+
+def make_example(rng: random.Random, n_sentences: int, proof_length: int, item_id: str):
+    ''' One example whose context has a proof chain of proof_length sentences
+        (a fact followed by proof_length - 1 rules) among distractors. Half
+        of the questions are about an attribute which cannot be derived.
+    '''
+    assert n_sentences >= proof_length
+    entity = rng.choice(ENTITIES)
+    chain = rng.sample(ATTRIBUTES, proof_length + 1)
+
+    proof = [f"The {entity} is {chain[0]}."]
+    proof += [f"If someone is {a} then they are {b}." for a, b in zip(chain[:-2], chain[1:-1])]
+    distractors = []
+    while len(distractors) < n_sentences - proof_length:
+        if rng.random() < 0.5:
+            distractors.append(f"The {rng.choice(ENTITIES)} is {rng.choice(ATTRIBUTES)}.")
+        else:
+            a, b = rng.sample(ATTRIBUTES, 2)
+            distractors.append(f"If someone is {a} then they are {b}.")
+
+    sentences = [(s, 1) for s in proof] + [(s, 0) for s in distractors]
+    rng.shuffle(sentences)
+
+    label = int(rng.random() < 0.5)
+    attribute = chain[proof_length - 1] if label else chain[-1]
+    node_label = np.array([in_proof * label for _, in_proof in sentences] + [1 - label], dtype=np.int8)
+
+    return {
+        'item_id': item_id,
+        'question_text': f"The {entity} is {attribute}.",
+        'context': ' '.join(s for s, _ in sentences),
+        'label': label,
+        'qdep': proof_length - 1,
+        'qlen': proof_length,
+        'node_label': node_label,
+    }
+
+
+def make_examples(n: int, n_sentences: int, proof_length: int, seed: int = 0):
+    rng = random.Random(seed)
+    return [make_example(rng, n_sentences, proof_length, f"synthetic-{i}") for i in range(n)]
+
+
+def _bytes_to_unicode(path):
+    ''' The byte -> unicode table of RoBERTa's byte-level BPE, read from a
+        tokenizer over placeholder vocab files in path.
+    '''
+    from transformers import RobertaTokenizer
+
+    vocab_file, merges_file = os.path.join(path, 'vocab.json'), os.path.join(path, 'merges.txt')
+    with open(vocab_file, 'w') as f:
+        json.dump({tok: i for i, tok in enumerate(SPECIAL_TOKENS)}, f)
+    with open(merges_file, 'w') as f:
+        f.write('#version: 0.2\n')
+    return RobertaTokenizer(vocab_file, merges_file).byte_encoder
+
+
+def _word_merges(words, space):
+    ''' BPE merges which build each word (with a leading space marker) up
+        from its characters, so synthetic sentences tokenize word by word.
+    '''
+    merges = []
+    for word in words:
+        pieces = [space + word[0]] + list(word[1:]) if space else list(word)
+        if space:
+            merges.append((space, word[0]))
+        for piece in pieces[1:]:
+            merges.append((pieces[0], piece))
+            pieces[0] += piece
+    return merges
+
+
+def write_tiny_roberta(path: str, hidden_size: int = 32, num_layers: int = 2, num_heads: int = 2):
+    ''' Write a randomly initialized RoBERTa with a word-level byte BPE
+        tokenizer to path. The directory name should contain "roberta", as
+        the models pick their architecture from the model name.
+    '''
+    if os.path.isfile(os.path.join(path, 'config.json')):
+        return path
+    from transformers import RobertaConfig, RobertaModel
+
+    os.makedirs(path, exist_ok=True)
+    byte_encoder = _bytes_to_unicode(path)
+    space = byte_encoder[ord(' ')]
+    words = FUNCTION_WORDS + ENTITIES + ATTRIBUTES      # Sentence initial words first
+
+    merges = []
+    for merge in _word_merges(words, space) + _word_merges(words, ''):
+        if merge not in merges:
+            merges.append(merge)
+
+    vocab = {tok: i for i, tok in enumerate(SPECIAL_TOKENS)}
+    for tok in list(byte_encoder.values()) + [a + b for a, b in merges] + ['<mask>']:
+        vocab.setdefault(tok, len(vocab))
+
+    with open(os.path.join(path, 'vocab.json'), 'w') as f:
+        json.dump(vocab, f)
+    with open(os.path.join(path, 'merges.txt'), 'w') as f:
+        f.write('#version: 0.2\n' + ''.join(f'{a} {b}\n' for a, b in merges))
+
+    config = RobertaConfig(
+        vocab_size=len(vocab),
+        hidden_size=hidden_size,
+        num_hidden_layers=num_layers,
+        num_attention_heads=num_heads,
+        intermediate_size=4 * hidden_size,
+        max_position_embeddings=514,
+        type_vocab_size=1,
+        pad_token_id=1,
+    )
+    RobertaModel(config).save_pretrained(path)
+    return path
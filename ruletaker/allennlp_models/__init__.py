@@ -9,6 +9,7 @@ try:
     from allennlp_models.predictors.transformer_binary_qa_predictor import *
     from allennlp_models.train.custom_train import *
     from allennlp_models.train.custom_trainer import *
+    from allennlp_models.train.build_sentence_index import *
     from allennlp_models.models.transformer_binary_qa_retriever import TransformerBinaryQARetriever
     from allennlp_models.models.retriever import RetrievalScorer
     from allennlp_models.models.policy_gradients import PolicyGradientsAgent
@@ -26,6 +27,7 @@ except:
     from ruletaker.allennlp_models.predictors.transformer_binary_qa_predictor import *
     from ruletaker.allennlp_models.train.custom_train import *
     from ruletaker.allennlp_models.train.custom_trainer import *
+    from ruletaker.allennlp_models.train.build_sentence_index import *
     from ruletaker.allennlp_models.models.transformer_binary_qa_retriever import TransformerBinaryQARetriever
     from ruletaker.allennlp_models.models.retriever import RetrievalScorer
     from ruletaker.allennlp_models.models.gumbel_softmax import GumbelSoftmaxRetrieverReasoner, ProgressiveDeepeningGumbelSoftmaxRetsrieverReasoner
@@ -0,0 +1,84 @@
+import numpy as np
+import torch
+
+from allennlp.data.tokenizers import Token
+
+
+def encode_texts(tokenizer, texts, max_length, pad_idx=None):
+    ''' Tokenize a list of texts or (text, text_pair) tuples with one batched
+        (huggingface) tokenizer call. Returns the padded tensors a
+        PretrainedTransformerIndexer would produce for the same inputs:
+        token_ids, mask and type_ids, each [n, max_len].
+    '''
+    encoded = tokenizer.batch_encode_plus(
+        texts, add_special_tokens=True, max_length=max_length, return_token_type_ids=True
+    )
+    pad_idx = tokenizer.pad_token_id if pad_idx is None else pad_idx
+    return pad_ids(encoded['input_ids'], encoded.get('token_type_ids'), pad_idx)
+
+
+def encode_id_arrays(tokenizer, texts, max_length):
+    ''' encode_texts as unpadded (token ids, type ids) int32 / int8 arrays,
+        one pair per text, which are cheap to send between processes.
+    '''
+    encoded = encode_texts(tokenizer, texts, max_length)
+    lengths = encoded['mask'].sum(-1).tolist()
+    token_ids = encoded['token_ids'].numpy().astype('<i4')
+    type_ids = encoded['type_ids'].numpy().astype('<i1')
+    return [(token_ids[n, :l], type_ids[n, :l]) for n, l in enumerate(lengths)]
+
+
+def tokens_from_ids(ids, type_ids, id_to_token):
+    ''' The Tokens a pretrained transformer tokenizer gives for the ids,
+        with their text from id_to_token (e.g. convert_ids_to_tokens).
+    '''
+    ids, type_ids = np.asarray(ids).tolist(), np.asarray(type_ids).tolist()
+    return [
+        Token(text=text, text_id=i, type_id=t)
+        for text, i, t in zip(id_to_token(ids), ids, type_ids)
+    ]
+
+
+def pad_ids(input_ids, type_ids, pad_idx):
+    lengths = torch.tensor([len(ids) for ids in input_ids], dtype=torch.long)
+    max_len = int(lengths.max()) if len(input_ids) else 0
+    mask = torch.arange(max_len).unsqueeze(0) < lengths.unsqueeze(1)
+
+    token_ids = torch.full((len(input_ids), max_len), pad_idx, dtype=torch.long)
+    token_ids[mask] = torch.tensor([i for ids in input_ids for i in ids], dtype=torch.long)
+    token_type_ids = torch.zeros_like(token_ids)
+    if type_ids is not None:
+        token_type_ids[mask] = torch.tensor([i for ids in type_ids for i in ids], dtype=torch.long)
+
+    return {'token_ids': token_ids, 'mask': mask, 'type_ids': token_type_ids}
+
+
+def group_rows(tensors, counts, pad_idx):
+    ''' Regroup [sum(counts), seq_len] row tensors into [len(counts),
+        max(counts), seq_len], padding missing rows as a ListField would.
+    '''
+    counts = torch.tensor(counts, dtype=torch.long)
+    n_max = int(counts.max()) if len(counts) else 0
+    slots = torch.arange(n_max).unsqueeze(0) < counts.unsqueeze(1)
+
+    grouped = {}
+    for key, rows in tensors.items():
+        fill = pad_idx if key == 'token_ids' else 0
+        out = rows.new_full((len(counts), n_max, rows.size(-1)), fill)
+        out[slots] = rows
+        grouped[key] = out
+    return grouped
+
+
+def truncate_pair(ids, pair_ids, num_tokens_to_remove):
+    ''' The tokenizer's "longest_first" truncation: tokens are removed one
+        at a time from the end of the longer sequence (the pair on ties).
+    '''
+    # Trim the longer one down to the other, then alternate
+    n = min(num_tokens_to_remove, abs(len(ids) - len(pair_ids)))
+    if len(ids) > len(pair_ids):
+        ids = ids[:len(ids) - n]
+    else:
+        pair_ids = pair_ids[:len(pair_ids) - n]
+    rest = num_tokens_to_remove - n
+    return ids[:max(len(ids) - rest // 2, 0)], pair_ids[:max(len(pair_ids) - (rest + 1) // 2, 0)]
@@ -0,0 +1,60 @@
+import threading
+from collections import OrderedDict
+
+
+class ContextStore:
+    ''' Values computed from a context alone (tokenized sentences, the
+        fields built from them, ...) for the most recently seen contexts.
+        Every question about a context reuses, and its instance references,
+        the same objects rather than its own copies.
+
+        Questions about a context are read consecutively, so only a small
+        number of contexts (max_contexts) need to be kept. max_contexts = 0
+        disables sharing.
+    '''
+    def __init__(self, max_contexts: int = 1024):
+        self._max_contexts = max_contexts
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, context, name, build):
+        ''' The value of `name` for context, calling build() the first time.
+        '''
+        if self._max_contexts <= 0:
+            return build()
+
+        with self._lock:
+            entry = self._entries.get(context)
+            if entry is None:
+                entry = self._entries[context] = {}
+                if len(self._entries) > self._max_contexts:
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.move_to_end(context)
+            value = entry.get(name)
+
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = build()
+        return entry.setdefault(name, value)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __getstate__(self):
+        # Forked/pickled copies (e.g. tokenization workers) start empty
+        state = self.__dict__.copy()
+        state['_entries'] = OrderedDict()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
@@ -0,0 +1,197 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from .batch_encoding import tokens_from_ids
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+CACHE_VERSION = 4
+
+# How each tokenized field is laid out as spans in the flat id pool
+TOKENS, TOKEN_LISTS, ARRAY, ARRAY_ROWS = 0, 1, 2, 3
+
+
+def hash_files(*file_paths, chunk_size=1 << 20):
+    ''' sha1 over the contents of the given files.
+    '''
+    h = hashlib.sha1()
+    for path in file_paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_key(file_paths, options):
+    ''' Key a cache entry on the data file contents plus the tokenizers
+        and reader options which affect the tokenized output.
+    '''
+    h = hashlib.sha1()
+    h.update(hash_files(*file_paths).encode())
+    h.update(json.dumps({**options, 'version': CACHE_VERSION}, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+class TokenizedInstanceCache:
+    ''' On-disk store of tokenized instances. Token ids of every field live
+        in one flat int32 pool which is memory-mapped on load, so warm starts
+        rebuild instances without running the tokenizers.
+
+        Layout of a cache entry (<cache_dir>/<key>/), raw little-endian arrays:
+            - ids.bin, type_ids.bin: flat int32 token id / int8 type id pools
+            - spans.bin: (n_spans, 2) int64 [start, end) offsets into the pools
+            - fields.bin: (n_instances, n_fields, 2) int64 [start, end) offsets into spans
+            - records.jsonl: the non-tokenized text_to_instance kwargs
+            - header.json: field names and layouts, array sizes, the dtypes of
+              array fields (restored on load, the pool is int32)
+    '''
+    def __init__(self, cache_dir: str, key: str):
+        self.path = os.path.join(cache_dir, key)
+        self._cache_dir = cache_dir
+
+    def exists(self):
+        return os.path.isfile(os.path.join(self.path, 'header.json'))
+
+    def writer(self, field_kinds: dict):
+        return _CacheWriter(self, field_kinds)
+
+    def read(self, id_to_token: dict):
+        ''' Yield (record, tokens) pairs, where tokens maps field names to the
+            same structures the reader's tokenize step produces. Token text is
+            recovered with id_to_token[field] (a vocab lookup of a list of ids,
+            e.g. convert_ids_to_tokens, no tokenization).
+        '''
+        with open(os.path.join(self.path, 'header.json')) as f:
+            header = json.load(f)
+        n_fields = len(header['fields'])
+        ids = self._load('ids.bin', '<i4', (header['n_ids'],))
+        type_ids = self._load('type_ids.bin', '<i1', (header['n_ids'],))
+        spans = self._load('spans.bin', '<i8', (header['n_spans'], 2))
+        fields = self._load('fields.bin', '<i8', (header['n_instances'], n_fields, 2))
+        dtypes = header.get('array_dtypes', {})
+
+        with open(os.path.join(self.path, 'records.jsonl')) as f:
+            for n, line in enumerate(f):
+                tokens = {}
+                for (name, kind), (s_start, s_end) in zip(header['fields'], fields[n]):
+                    if s_start < 0:
+                        continue
+                    rows = [
+                        (ids[start:end], type_ids[start:end]) for start, end in spans[s_start:s_end]
+                    ]
+                    if kind == TOKENS:
+                        tokens[name] = tokens_from_ids(*rows[0], id_to_token[name])
+                    elif kind == TOKEN_LISTS:
+                        tokens[name] = [tokens_from_ids(*row, id_to_token[name]) for row in rows]
+                    elif kind == ARRAY:
+                        tokens[name] = np.array(rows[0][0], dtype=dtypes.get(name, ids.dtype))
+                    elif kind == ARRAY_ROWS:
+                        tokens[name] = np.stack([row[0] for row in rows]).astype(dtypes.get(name, ids.dtype), copy=False)
+                    else:
+                        raise NotImplementedError
+                yield json.loads(line), tokens
+
+    def _load(self, name, dtype, shape):
+        if int(np.prod(shape)) == 0:
+            return np.zeros(shape, dtype=dtype)     # Can't memory-map an empty file
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode='r', shape=shape)
+
+
+class _CacheWriter:
+    ''' Streams tokenized instances into a temporary directory next to the
+        cache entry, which is renamed into place by finalize() once the full
+        dataset has been seen. close() without finalize() (e.g. a partially
+        read dataset) discards the temporary directory.
+    '''
+    def __init__(self, cache: TokenizedInstanceCache, field_kinds: dict):
+        self._cache = cache
+        self._field_kinds = list(field_kinds.items())
+        os.makedirs(cache._cache_dir, exist_ok=True)
+        self._tmp_dir = tempfile.mkdtemp(dir=cache._cache_dir)
+        self._files = {
+            name: open(os.path.join(self._tmp_dir, name), 'wb')
+            for name in ['ids.bin', 'type_ids.bin', 'spans.bin', 'fields.bin']
+        }
+        self._records = open(os.path.join(self._tmp_dir, 'records.jsonl'), 'w')
+        self._n_ids, self._n_spans, self._n_instances = 0, 0, 0
+        self._array_dtypes = {}
+
+    def _add_span(self, ids, type_ids, spans):
+        self._files['ids.bin'].write(np.asarray(ids, dtype='<i4').tobytes())
+        self._files['type_ids.bin'].write(np.asarray(type_ids, dtype='<i1').tobytes())
+        spans.append((self._n_ids, self._n_ids + len(ids)))
+        self._n_ids += len(ids)
+
+    def _add_tokens(self, tokens, spans):
+        self._add_span([t.text_id for t in tokens], [t.type_id or 0 for t in tokens], spans)
+
+    def add(self, record: dict, tokens: dict):
+        fields, spans = [], []
+        for name, kind in self._field_kinds:
+            if name not in tokens:
+                fields.append((-1, -1))
+                continue
+            value = tokens[name]
+            s_start = self._n_spans + len(spans)
+            if kind == TOKENS:
+                self._add_tokens(value, spans)
+            elif kind == TOKEN_LISTS:
+                for toks in value:
+                    self._add_tokens(toks, spans)
+            elif kind == ARRAY:
+                self._array_dtypes[name] = np.asarray(value).dtype.str
+                self._add_span(value, np.zeros(len(value)), spans)
+            elif kind == ARRAY_ROWS:
+                self._array_dtypes[name] = np.asarray(value).dtype.str
+                for row in value:
+                    self._add_span(row, np.zeros(len(row)), spans)
+            else:
+                raise NotImplementedError
+            fields.append((s_start, self._n_spans + len(spans)))
+        self._files['spans.bin'].write(np.asarray(spans, dtype='<i8').reshape(-1, 2).tobytes())
+        self._files['fields.bin'].write(np.asarray(fields, dtype='<i8').tobytes())
+        self._records.write(json.dumps(record, default=_to_json) + '\n')
+        self._n_spans += len(spans)
+        self._n_instances += 1
+
+    def _close_files(self):
+        for f in [*self._files.values(), self._records]:
+            f.close()
+
+    def finalize(self):
+        self._close_files()
+        with open(os.path.join(self._tmp_dir, 'header.json'), 'w') as f:
+            json.dump({
+                'version': CACHE_VERSION,
+                'fields': self._field_kinds,
+                'n_ids': self._n_ids,
+                'n_spans': self._n_spans,
+                'n_instances': self._n_instances,
+                'array_dtypes': self._array_dtypes,
+            }, f)
+
+        if os.path.isdir(self._cache.path):
+            shutil.rmtree(self._tmp_dir)      # Another process got there first
+        else:
+            os.rename(self._tmp_dir, self._cache.path)
+        self._tmp_dir = None
+        logger.info(f"Wrote {self._n_instances} tokenized instances to {self._cache.path}")
+
+    def close(self):
+        ''' Discard the entry unless it was finalized. '''
+        if self._tmp_dir is not None:
+            self._close_files()
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            self._tmp_dir = None
+
+
+def _to_json(value):
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    raise TypeError(f'{type(value)} is not JSON serializable')
@@ -0,0 +1,63 @@
+import itertools
+import multiprocessing as mp
+
+# Reader shared with forked workers, so it is never pickled
+_READER = None
+
+
+def _apply_chunk(args):
+    method, chunk = args
+    return getattr(_READER, method)(chunk)
+
+
+def _chunks(items, chunk_size):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class ParallelTokenizationMixin:
+    ''' Runs a reader method over chunks of a stream of items across a pool
+        of forked worker processes, yielding results in input order so the
+        instances (and anything sampled while building the stream) are the
+        same as a serial read. The method maps a list of items to a list of
+        results, so a chunk can be tokenized with one batched tokenizer call.
+        num_workers <= 1 runs in-process.
+
+        Instances are built in the parent: the workers only run
+        _encode_records, which returns token ids (cheap to pickle).
+    '''
+    def _init_workers(self, num_workers: int = 0, worker_chunk_size: int = 64):
+        self._num_workers = num_workers
+        self._worker_chunk_size = worker_chunk_size
+
+    def _parallel_map(self, method: str, items):
+        chunks = _chunks(items, getattr(self, '_worker_chunk_size', 64))
+        if getattr(self, '_num_workers', 0) <= 1:
+            fn = getattr(self, method)
+            for chunk in chunks:
+                yield from fn(chunk)
+            return
+
+        global _READER
+        _READER = self
+        with mp.get_context('fork').Pool(self._num_workers) as pool:
+            for results in pool.imap(_apply_chunk, ((method, chunk) for chunk in chunks)):
+                yield from results
+
+    def _instances_from_records(self, records):
+        ''' text_to_instance over records of its kwargs, plus the encoding
+            _encode_records made of each.
+        '''
+        for record, encoding in self._parallel_map('_encode_records', records):
+            yield self.text_to_instance(**record, **encoding)
+
+    def _encode_records(self, records):
+        ''' Tokenize a chunk of records: a (record, encoding) pair each, where
+            encoding holds extra text_to_instance kwargs (e.g. token ids).
+            The default leaves the tokenization to text_to_instance.
+        '''
+        return [(record, {}) for record in records]
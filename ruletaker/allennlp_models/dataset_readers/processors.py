@@ -10,7 +10,7 @@ import json
 from nltk.tokenize import sent_tokenize
 import numpy as np
 
-from .proof_utils import get_proof_graph, get_proof_graph_with_fail, RRInputExample
+from .proof_utils import get_proof_graph, get_proof_graph_with_fail, parse_proof, RRInputExample
 
 
 class DataProcessor(object):
@@ -46,7 +46,58 @@ class DataProcessor(object):
             return records
 
 
+class IndexedJsonl(object):
+    """Lazily-indexed JSONL file. Records are only parsed when iterated over
+    or accessed, by line number or by record id, through a byte-offset index
+    which is built on first use."""
+
+    def __init__(self, input_file):
+        self.input_file = input_file
+        self._offsets = None
+        self._id_to_line = None
+
+    def __iter__(self):
+        with open(self.input_file, "r", encoding="utf-8-sig") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, n):
+        with open(self.input_file, "rb") as f:
+            f.seek(int(self.offsets[n]))
+            return json.loads(f.readline().decode("utf-8-sig"))
+
+    @property
+    def offsets(self):
+        """Byte offset of the start of each (non-empty) line."""
+        if self._offsets is None:
+            offsets = []
+            with open(self.input_file, "rb") as f:
+                offset = 0
+                for line in f:
+                    if line.strip():
+                        offsets.append(offset)
+                    offset += len(line)
+            self._offsets = np.array(offsets, dtype=np.int64)
+        return self._offsets
+
+    def line_of(self, record_id):
+        """Line number of a record id, indexing the ids on first call."""
+        if self._id_to_line is None:
+            self._id_to_line = {record["id"]: n for n, record in enumerate(self)}
+        return self._id_to_line[record_id]
+
+    def get(self, record_id):
+        return self[self.line_of(record_id)]
+
+
 class RRProcessor(DataProcessor):
+    def __init__(self):
+        self._indexes = {}
+
     def get_examples(self, data_dir, dset, get_proof=True):
         return self._create_examples(
             self._read_jsonl(os.path.join(data_dir, dset+".jsonl")),
@@ -54,145 +105,121 @@ class RRProcessor(DataProcessor):
             get_proof=get_proof
         )
 
+    def iter_examples(self, data_dir, dset, get_proof=True):
+        """Stream examples record by record without loading the files."""
+        records, meta_records = self._indexed_files(data_dir, dset)
+        for record, meta_record in zip(records, meta_records):
+            yield from self._record_examples(record, meta_record, get_proof)
+
+    def get_record_examples(self, data_dir, dset, record_id, get_proof=True):
+        """Examples of a single context, looked up through the line index."""
+        records, meta_records = self._indexed_files(data_dir, dset)
+        n = records.line_of(record_id)
+        return list(self._record_examples(records[n], meta_records[n], get_proof))
+
+    def _indexed_files(self, data_dir, dset):
+        key = (data_dir, dset)
+        if key not in self._indexes:
+            self._indexes[key] = (
+                IndexedJsonl(os.path.join(data_dir, dset+".jsonl")),
+                IndexedJsonl(os.path.join(data_dir, "meta-"+dset+".jsonl")),
+            )
+        return self._indexes[key]
+
     def get_labels(self):
         return [True, False]
 
-    # Unconstrained training, use this for ablation
-    def _get_node_edge_label_unconstrained(self, proofs, sentence_scramble, nfact, nrule):
-        proof = proofs.split("OR")[0]
-        #print(proof)
-        node_label = [0] * (nfact + nrule + 1)
-        edge_label = np.zeros((nfact+nrule+1, nfact+nrule+1), dtype=int)
-
-        if "FAIL" in proof:
-            nodes, edges = get_proof_graph_with_fail(proof)
-        else:
-            nodes, edges = get_proof_graph(proof)
-        #print(nodes)
-        #print(edges)
-
+    def _get_record_structures(self, sentence_scramble, nfact, nrule):
+        ''' Lookups shared by every question on the same context: a map of
+            proof component -> sentence index and a fact/NAF indicator vector.
+        '''
         component_index_map = {}
         for (i, index) in enumerate(sentence_scramble):
             if index <= nfact:
                 component = "triple" + str(index)
             else:
-                component = "rule" + str(index-nfact)
+                component = "rule" + str(index - nfact)
             component_index_map[component] = i
+        component_index_map["NAF"] = nfact + nrule
 
-        for node in nodes:
-            if node != "NAF":
-                index = component_index_map[node]
-            else:
-                index = nfact+nrule
-            node_label[index] = 1
+        # Final node is NAF which is treated as a fact
+        is_fact = np.ones(nfact + nrule + 1, dtype=bool)
+        is_fact[:-1] = np.asarray(sentence_scramble[:nfact + nrule]) <= nfact
 
-        edges = list(set(edges))
-        for edge in edges:
-            if edge[0] != "NAF":
-                start_index = component_index_map[edge[0]]
-            else:
-                start_index = nfact+nrule
-            if edge[1] != "NAF":
-                end_index = component_index_map[edge[1]]
-            else:
-                end_index = nfact+nrule
+        return component_index_map, is_fact
 
-            edge_label[start_index][end_index] = 1
+    def _get_node_edge_matrices(self, proofs, component_index_map, n):
+        nodes, edges = parse_proof(proofs)
+        node_label = np.zeros(n, dtype=np.int8)
+        node_label[[component_index_map[node] for node in nodes]] = 1
 
-        return node_label, list(edge_label.flatten())
+        edge_label = np.zeros((n, n), dtype=np.int8)
+        if edges:
+            starts, ends = zip(*[(component_index_map[s], component_index_map[e]) for s, e in edges])
+            edge_label[list(starts), list(ends)] = 1
 
-    def _get_node_edge_label_constrained(self, proofs, sentence_scramble, nfact, nrule):
-        proof = proofs.split("OR")[0]
-        node_label = [0] * (nfact + nrule + 1)
-        edge_label = np.zeros((nfact + nrule + 1, nfact + nrule + 1), dtype=int)
+        return node_label, edge_label
 
-        if "FAIL" in proof:
-            nodes, edges = get_proof_graph_with_fail(proof)
-        else:
-            nodes, edges = get_proof_graph(proof)
+    # Unconstrained training, use this for ablation
+    def _get_node_edge_label_unconstrained(self, proofs, sentence_scramble, nfact, nrule, structures=None):
+        component_index_map, _ = structures or self._get_record_structures(sentence_scramble, nfact, nrule)
+        node_label, edge_label = self._get_node_edge_matrices(proofs, component_index_map, nfact + nrule + 1)
+
+        return node_label, edge_label.flatten()
+
+    def _get_node_edge_label_constrained(self, proofs, sentence_scramble, nfact, nrule, structures=None):
+        component_index_map, is_fact = structures or self._get_record_structures(sentence_scramble, nfact, nrule)
+        node_label, edge_label = self._get_node_edge_matrices(proofs, component_index_map, nfact + nrule + 1)
+
+        # Mask impossible edges: the diagonal, edges between non-nodes and
+        # edges ending at a fact/NAF (i.e. fact/NAF -> fact/NAF and rule -> fact/NAF)
+        is_node = node_label.astype(bool)
+        impossible = (
+            np.eye(len(is_node), dtype=bool)
+            | ~(is_node[:, None] & is_node[None, :])
+            | is_fact[None, :]
+        )
+        edge_label[impossible] = -100
 
-        component_index_map = {}
-        for (i, index) in enumerate(sentence_scramble):
-            if index <= nfact:
-                component = "triple" + str(index)
-            else:
-                component = "rule" + str(index - nfact)
-            component_index_map[component] = i
-        component_index_map["NAF"] = nfact+nrule
-
-        for node in nodes:
-            index = component_index_map[node]
-            node_label[index] = 1
-
-        edges = list(set(edges))
-        for edge in edges:
-            start_index = component_index_map[edge[0]]
-            end_index = component_index_map[edge[1]]
-            edge_label[start_index][end_index] = 1
-
-        # Mask impossible edges
-        for i in range(len(edge_label)):
-            for j in range(len(edge_label)):
-                # Ignore diagonal
-                if i == j:
-                    edge_label[i][j] = -100
-                    continue
-
-                # Ignore edges between non-nodes
-                if node_label[i] == 0 or node_label[j] == 0:
-                    edge_label[i][j] = -100
-                    continue
-
-                is_fact_start = False
-                is_fact_end = False
-                if i == len(edge_label)-1 or sentence_scramble[i] <= nfact:
-                    is_fact_start = True
-                if j == len(edge_label)-1 or sentence_scramble[j] <= nfact:
-                    is_fact_end = True
-
-                # No edge between fact/NAF -> fact/NAF
-                if is_fact_start and is_fact_end:
-                    edge_label[i][j] = -100
-                    continue
-
-                # No edge between Rule -> fact/NAF
-                if not is_fact_start and is_fact_end:
-                    edge_label[i][j] = -100
-                    continue
-
-        return node_label, list(edge_label.flatten())
+        return node_label, edge_label.flatten()
 
     def _create_examples(self, records, meta_records, get_proof):
         examples = []
         for (i, (record, meta_record)) in enumerate(zip(records, meta_records)):
             #print(i)
-            assert record["id"] == meta_record["id"]
-            context = record["context"]
-            sentence_scramble = record["meta"]["sentenceScramble"]
-            for (j, question) in enumerate(record["questions"]):
-                # Uncomment to train/evaluate at a certain depth
-                #if question["meta"]["QDep"] != 5:
-                #    continue
-                # Uncomment to test at a specific subset of Birds-Electricity dataset
-                #if not record["id"].startswith("AttPosElectricityRB4"):
-                #    continue
-                id = question["id"]
-                label = question["label"]
-                qdep = question["meta"]["QDep"]
-                qlen = question["meta"]["QLen"]
-                question = question["text"]
-                meta_data = meta_record["questions"]["Q"+str(j+1)]
-
-                assert (question == meta_data["question"])
-
-                proofs = meta_data["proofs"]
-                nfact = meta_record["NFact"]
-                nrule = meta_record["NRule"]
-                if get_proof:
-                    node_label, edge_label = self._get_node_edge_label_constrained(proofs, sentence_scramble, nfact, nrule)
-                else:
-                    node_label, edge_label = None, None
-
-                examples.append(RRInputExample(id, context, question, node_label, edge_label, label, qdep, qlen))
+            examples.extend(self._record_examples(record, meta_record, get_proof))
 
         return examples
+
+    def _record_examples(self, record, meta_record, get_proof):
+        assert record["id"] == meta_record["id"]
+        context = record["context"]
+        sentence_scramble = record["meta"]["sentenceScramble"]
+        nfact = meta_record["NFact"]
+        nrule = meta_record["NRule"]
+        structures = self._get_record_structures(sentence_scramble, nfact, nrule) if get_proof else None
+        for (j, question) in enumerate(record["questions"]):
+            # Uncomment to train/evaluate at a certain depth
+            #if question["meta"]["QDep"] != 5:
+            #    continue
+            # Uncomment to test at a specific subset of Birds-Electricity dataset
+            #if not record["id"].startswith("AttPosElectricityRB4"):
+            #    continue
+            id = question["id"]
+            label = question["label"]
+            qdep = question["meta"]["QDep"]
+            qlen = question["meta"]["QLen"]
+            question = question["text"]
+            meta_data = meta_record["questions"]["Q"+str(j+1)]
+
+            assert (question == meta_data["question"])
+
+            proofs = meta_data["proofs"]
+            if get_proof:
+                node_label, edge_label = self._get_node_edge_label_constrained(
+                    proofs, sentence_scramble, nfact, nrule, structures
+                )
+            else:
+                node_label, edge_label = None, None
+
+            yield RRInputExample(id, context, question, node_label, edge_label, label, qdep, qlen)
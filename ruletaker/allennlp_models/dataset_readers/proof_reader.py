@@ -18,13 +18,16 @@ from allennlp.data.token_indexers import PretrainedTransformerIndexer, SingleIdT
 from allennlp.data.tokenizers import Token, PretrainedTransformerTokenizer, SpacyTokenizer
 from allennlp.data.dataloader import allennlp_collate
 
+from .batch_encoding import encode_texts, encode_id_arrays, tokens_from_ids
+from .parallel import ParallelTokenizationMixin
 from .processors import RRProcessor
+from .proof_utils import LazyMetadata, token_texts
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 # TagSpanType = ((int, int), str)
 
 @DatasetReader.register("proof_reader")
-class ProofReader(DatasetReader):
+class ProofReader(DatasetReader, ParallelTokenizationMixin):
     """
     Parameters
     ----------
@@ -41,6 +44,7 @@ class ProofReader(DatasetReader):
         sample: int = -1,
         retriever_variant: str = None,
         max_depth: int = 5,
+        num_workers: int = 0,
     ) -> None:
         super().__init__()
         
@@ -67,6 +71,7 @@ class ProofReader(DatasetReader):
         self._skip_id_regex = skip_id_regex
         self._retriever_variant = retriever_variant
         self._max_depth = max_depth
+        self._init_workers(num_workers)
 
     @overrides
     def _read(self, file_path: str):
@@ -74,11 +79,16 @@ class ProofReader(DatasetReader):
         return instances
 
     def _read_internal(self, file_path: str):
+        # Negatives are sampled here, in order, so reads stay reproducible
+        # however tokenization is spread over num_workers processes
+        return self._instances_from_records(self._read_records(file_path))
+
+    def _read_records(self, file_path: str):
         debug = -1
 
         data_dir = '/'.join(file_path.split('/')[:-1])
         dset = file_path.split('/')[-1].split('.')[0]
-        examples = RRProcessor().get_examples(data_dir, dset)
+        examples = RRProcessor().iter_examples(data_dir, dset)
 
         for example in examples:
             question = example.question.strip()
@@ -108,7 +118,7 @@ class ProofReader(DatasetReader):
 
                 # Yield positive example
                 qid_ = qid + f'-P-{n}'
-                yield self.text_to_instance(
+                yield dict(
                     item_id=qid_,
                     question_text=question,
                     context=support_item,
@@ -120,7 +130,7 @@ class ProofReader(DatasetReader):
                 # a context item which does not contribute to the proof
                 neg = non_support.pop(np.random.choice(len(non_support)))
                 qid_ = qid + f'-N-{n}'
-                yield self.text_to_instance(
+                yield dict(
                     item_id=qid_,
                     question_text=question,
                     context=neg,
@@ -138,22 +148,22 @@ class ProofReader(DatasetReader):
         debug: int = -1,
         qdep = None,
         qa_only: bool = False,
+        qa_ids = None,
     ) -> Instance:
         # pylint: disable=arguments-differ
         fields: Dict[str, Field] = {}
 
         # Tokenize for the qa model
-        qa_tokens, segment_ids = self.transformer_features_from_qa(question_text, context)
+        qa_tokens, segment_ids = self.transformer_features_from_qa(question_text, context, qa_ids)
         qa_field = TextField(qa_tokens, self._token_indexers)
         fields['phrase'] = qa_field
 
-        metadata = {
+        metadata = LazyMetadata({
             "id": item_id,
             "question_text": question_text,
-            "tokens": [x.text for x in qa_tokens],
             "context": context,
             "QDep": qdep,
-        }
+        }, lazy={"tokens": (token_texts, qa_tokens)})
 
         if label is not None:
             # We'll assume integer labels don't need indexing
@@ -169,11 +179,34 @@ class ProofReader(DatasetReader):
 
         return Instance(fields)
 
-    def transformer_features_from_qa(self, question: str, context: str):
+    def _encode_records(self, records):
+        ''' Tokenize the qa inputs of a chunk of records with one batched
+            tokenizer call (pretrained transformer tokenizers only).
+        '''
+        if not isinstance(self._tokenizer, PretrainedTransformerTokenizer):
+            return super()._encode_records(records)
+        texts = []
+        for record in records:
+            question, context = self._add_prefixes(record['question_text'], record['context'])
+            texts.append((question, context) if context is not None else question)
+        qa_ids = encode_id_arrays(self._tokenizer_internal, texts, self._max_pieces)
+        return [(record, {'qa_ids': ids}) for record, ids in zip(records, qa_ids)]
+
+    def _add_prefixes(self, question: str, context: str):
         if self._add_prefix is not None:
             question = self._add_prefix.get("q", "") + question
             context = self._add_prefix.get("c", "") + context
- 
+        return question, context
+
+    def transformer_features_from_qa(self, question: str, context: str, qa_ids=None):
+        ''' qa_ids are the (token ids, type ids) _encode_records made of the
+            same inputs, if any.
+        '''
+        if qa_ids is not None:
+            tokens = tokens_from_ids(*qa_ids, self._tokenizer_internal.convert_ids_to_tokens)
+            return tokens, [0] * len(tokens)
+
+        question, context = self._add_prefixes(question, context)
         if isinstance(self._tokenizer, PretrainedTransformerTokenizer) \
             and context is not None:
             tokens = self._tokenizer.tokenize_sentence_pair(question, context)
@@ -216,6 +249,23 @@ class ProofReader(DatasetReader):
 
         return allennlp_collate(instances)
 
+    def batch_indices_from_qa(self, sentences, vocab=None):
+        ''' Batched alternative to transformer_indices_from_qa: one tokenizer
+            call for all (question, context) pairs, returning padded id
+            tensors without building Instances.
+        '''
+        if self._retriever_variant == 'spacy':
+            return self.transformer_indices_from_qa(sentences, vocab)
+
+        texts = []
+        for question, context in sentences:
+            if self._add_prefix is not None:
+                question = self._add_prefix.get("q", "") + question
+                if context is not None:
+                    context = self._add_prefix.get("c", "") + context
+            texts.append((question, context) if context is not None else question)
+        return {'phrase': {'tokens': encode_texts(self._tokenizer_internal, texts, self._max_pieces)}}
+
     def decode(self, input_id, mode='qa', vocab=None):
         ''' Helper to decode a tokenized sequence.
         '''
@@ -1,16 +1,60 @@
+import sys
+from functools import lru_cache
+
+import numpy as np
+
 
 class RRInputExample(object):
+    __slots__ = ('id', 'context', 'question', 'node_label', 'edge_label', 'label', 'qdep', 'qlen')
+
     def __init__(self, id, context, question, node_label, edge_label, label, qdep, qlen):
         self.id = id
-        self.context = context
+        self.context = intern_context(context)
         self.question = question
-        self.node_label = node_label
-        self.edge_label = edge_label
+        self.node_label = as_label_array(node_label)
+        self.edge_label = as_label_array(edge_label)
         self.label = label
         self.qdep = qdep
         self.qlen = qlen
 
 
+def intern_context(context):
+    ''' Questions on the same theory share one context string.
+    '''
+    return sys.intern(context) if isinstance(context, str) else context
+
+
+def as_label_array(labels):
+    return None if labels is None else np.asarray(labels, dtype=np.int8)
+
+
+def token_texts(tokens):
+    return [x.text for x in tokens]
+
+
+class LazyMetadata(dict):
+    ''' Instance metadata whose logging-only entries are not stored, but
+        computed on access from (fn, *args) entries in `lazy`.
+    '''
+    __slots__ = ('_lazy',)
+
+    def __init__(self, *args, lazy=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lazy = lazy or {}
+
+    def __missing__(self, key):
+        if key not in self._lazy:
+            raise KeyError(key)
+        fn, *args = self._lazy[key]
+        return fn(*args)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self._lazy
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+
 class Node:
     def __init__(self, head):
         self.head = head
@@ -31,6 +75,7 @@ def get_proof_graph(proof_str):
     proof_str = proof_str.replace(")", " ) ")
     proof_str = proof_str.split()
 
+    seen_nodes = set()
     should_join = False
     for i in range(len(proof_str)):
 
@@ -60,7 +105,8 @@ def get_proof_graph(proof_str):
             should_join = True
         else:
             # terminal
-            if x not in all_nodes:
+            if x not in seen_nodes:
+                seen_nodes.add(x)
                 all_nodes.append(x)
 
             if should_join:
@@ -91,4 +137,17 @@ def get_proof_graph_with_fail(proof_str):
         if nodes[i+1] != "FAIL":
             all_edges.append((nodes[i+1], nodes[i]))
 
-    return all_nodes, all_edges
\ No newline at end of file
+    return all_nodes, all_edges
+
+
+@lru_cache(maxsize=1 << 16)
+def parse_proof(proofs):
+    ''' Parse the first proof of a proof string into its nodes and unique
+        edges. Memoized as the same proof strings recur across questions.
+    '''
+    proof = proofs.split("OR")[0]
+    if "FAIL" in proof:
+        nodes, edges = get_proof_graph_with_fail(proof)
+    else:
+        nodes, edges = get_proof_graph(proof)
+    return tuple(nodes), tuple(dict.fromkeys(edges))
@@ -1,9 +1,12 @@
 from typing import Dict, Any
 import json
 import logging
+import os
 import random
 import re
 
+import numpy as np
+import torch
 from torch import Tensor
 from overrides import overrides
 
@@ -11,20 +14,25 @@ from allennlp.common.file_utils import cached_path
 from allennlp.data.dataset_readers.dataset_reader import DatasetReader
 from allennlp.data.fields import (
     Field, TextField, LabelField, MetadataField, SequenceLabelField,
-    ListField
+    ListField, ArrayField
 )
 from allennlp.data.instance import Instance
 from allennlp.data.token_indexers import PretrainedTransformerIndexer, SingleIdTokenIndexer
 from allennlp.data.tokenizers import Token, PretrainedTransformerTokenizer, SpacyTokenizer
 from allennlp.data.dataloader import allennlp_collate
 
+from .batch_encoding import encode_texts, group_rows, truncate_pair
+from .context_store import ContextStore
+from .parallel import ParallelTokenizationMixin
 from .processors import RRProcessor
+from .proof_utils import LazyMetadata, as_label_array, intern_context, token_texts
+from .instance_cache import TokenizedInstanceCache, cache_key, TOKENS, TOKEN_LISTS, ARRAY, ARRAY_ROWS
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 # TagSpanType = ((int, int), str)
 
 @DatasetReader.register("retriever_reasoning")
-class RetrievalReasoningReader(DatasetReader):
+class RetrievalReasoningReader(DatasetReader, ParallelTokenizationMixin):
     """
     Parameters
     ----------
@@ -46,6 +54,10 @@ class RetrievalReasoningReader(DatasetReader):
         shortest_proof: int = 1,
         concat_q_and_c: bool = None,
         true_samples_only: bool = False,
+        tensor_rollout: bool = False,
+        cache_dir: str = None,
+        num_workers: int = 0,
+        context_store_size: int = 1024,
     ) -> None:
         super().__init__()
         
@@ -82,6 +94,19 @@ class RetrievalReasoningReader(DatasetReader):
         self._longest = longest_proof
         self._shortest = shortest_proof
         self._true_samples_only = true_samples_only
+        self._tensor_rollout = tensor_rollout
+        self._pretrained_model = pretrained_model
+        self._cache_dir = cache_dir
+        self._init_workers(num_workers)
+        self._context_store = ContextStore(context_store_size)
+        if self._cache_dir is not None and retriever_variant == 'spacy':
+            raise ValueError(
+                "cache_dir is only supported for pretrained transformer retrievers.\nInvestigate!"
+            )
+        if self._tensor_rollout and not (self._concat and 'roberta' in pretrained_model):
+            raise ValueError(
+                "tensor_rollout requires concat_q_and_c and a roberta qa model.\nInvestigate!"
+            )
 
     @overrides
     def _read(self, file_path: str):
@@ -93,7 +118,7 @@ class RetrievalReasoningReader(DatasetReader):
 
         data_dir = '/'.join(file_path.split('/')[:-1])
         dset = file_path.split('/')[-1].split('.')[0]
-        examples = RRProcessor().get_examples(data_dir, dset)
+        examples = RRProcessor().iter_examples(data_dir, dset)
 
         for example in examples:
             yield self.text_to_instance(
@@ -112,10 +137,37 @@ class RetrievalReasoningReader(DatasetReader):
 
         data_dir = '/'.join(file_path.split('/')[:-1])
         dset = file_path.split('/')[-1].split('.')[0]
-        examples = RRProcessor().get_examples(data_dir, dset)
+
+        # Warm start: rebuild instances from the tokenized cache
+        cache = self._get_cache(data_dir, dset)
+        if cache is not None and cache.exists():
+            logger.info(f"Reading tokenized instances from cache at {cache.path}")
+            for record, tokens in cache.read(self._id_to_token_fns()):
+                yield self.text_to_instance(**record, debug=debug, tokens=tokens)
+            return
+        writer = cache.writer(self._cached_fields()) if cache is not None else None
+
+        # Tokenization is spread over num_workers processes, in order
+        records = self._read_records(data_dir, dset)
+        try:
+            for record, tokens in self._parallel_map('_tokenize_records', records):
+                if writer is not None:
+                    writer.add(record, tokens)
+
+                yield self.text_to_instance(**record, debug=debug, tokens=tokens)
+
+            if writer is not None:
+                writer.finalize()
+        finally:
+            # A partially read dataset leaves no cache entry
+            if writer is not None:
+                writer.close()
+
+    def _read_records(self, data_dir, dset):
+        examples = RRProcessor().iter_examples(data_dir, dset)
 
         for example in examples:
-            example.qlen = sum(example.node_label[:-1])
+            example.qlen = int(example.node_label[:-1].sum())
             
             if self._true_samples_only:
                 # Filter so only positive correct questions and negative
@@ -134,16 +186,58 @@ class RetrievalReasoningReader(DatasetReader):
             if not (self._shortest <= int(example.qlen) <= self._longest):
                 continue
 
-            yield self.text_to_instance(
+            record = dict(
                 item_id=example.id,
                 question_text=example.question.strip(),
                 context=example.context,
                 label=example.label,
-                debug=debug,
                 qdep=example.qdep,
                 qlen=example.qlen,
                 node_label=example.node_label
             )
+            yield record
+
+    def _tokenize_records(self, records):
+        return [(record, self.tokenize_instance(record['question_text'], record['context'])) for record in records]
+
+    def _get_cache(self, data_dir, dset):
+        if self._cache_dir is None:
+            return None
+        file_paths = [
+            os.path.join(data_dir, dset + ".jsonl"), os.path.join(data_dir, "meta-" + dset + ".jsonl")
+        ]
+        options = {
+            "pretrained_model": self._pretrained_model,
+            "retriever_variant": self._retriever_variant,
+            "max_pieces": self._max_pieces,
+            "add_prefix": self._add_prefix,
+            "concat_q_and_c": self._concat,
+            "longest_proof": self._longest,
+            "shortest_proof": self._shortest,
+            "true_samples_only": self._true_samples_only,
+            "tensor_rollout": self._tensor_rollout,
+        }
+        return TokenizedInstanceCache(self._cache_dir, cache_key(file_paths, options))
+
+    def _cached_fields(self):
+        return {
+            'phrase': TOKENS,
+            'retrieval': TOKEN_LISTS,
+            'sentences': TOKEN_LISTS,
+            'rollout_prefix': ARRAY,
+            'rollout_sentences': ARRAY_ROWS,
+        }
+
+    def _id_to_token_fns(self):
+        ''' Map the cached ids of each field back with the tokenizer which
+            produced them: concat retrieval rows are qa tokenizer pairs.
+        '''
+        retrieval = self._tokenizer_qamodel_internal if self._concat else self._tokenizer_retriever_internal
+        return {
+            'phrase': self._tokenizer_qamodel_internal.convert_ids_to_tokens,
+            'retrieval': retrieval.convert_ids_to_tokens,
+            'sentences': self._tokenizer_qamodel_internal.convert_ids_to_tokens,
+        }
 
     @overrides
     def text_to_instance(self,  # type: ignore
@@ -157,41 +251,52 @@ class RetrievalReasoningReader(DatasetReader):
         qlen: int = None,
         qa_only: bool = False,
         node_label: list = [],
+        rollout_fields: bool = True,
+        tokens: Dict[str, Any] = None,
     ) -> Instance:
         # pylint: disable=arguments-differ
         fields: Dict[str, Field] = {}
+        context = intern_context(context)
+
+        if tokens is None:
+            tokens = self.tokenize_instance(
+                question_text, context, already_retrieved, qa_only, rollout_fields
+            )
 
-        # Tokenize for the qa model
-        qa_tokens, _ = self.transformer_features_from_qa(question_text, context)
+        # Tokens for the qa model
+        qa_tokens = tokens['phrase']
         qa_field = TextField(qa_tokens, self._token_indexers_qamodel)
         fields['phrase'] = qa_field
 
         if not qa_only:
-            # Tokenize context sentences seperately
-            retrieval_listfield = self.listfield_features_from_qa(
-                question_text, context, already_retrieved, self._tokenizer_retriever
-            )
-            qa_listfield = self.listfield_features_from_qa(
-                question_text, context, already_retrieved, self._tokenizer_qamodel
-            )
-            fields['retrieval'] = ListField(
-                [TextField(toks, self._token_indexers_retriever) for toks in retrieval_listfield]
-            )
-            fields['sentences'] = ListField(
-                [TextField(toks, self._token_indexers_qamodel) for toks in qa_listfield]
-            )
+            fields['retrieval'] = ListField(self.sentence_fields(
+                'retrieval', question_text, context, tokens['retrieval'], self._token_indexers_retriever
+            ))
+            fields['sentences'] = ListField(self.sentence_fields(
+                'sentences', question_text, context, tokens['sentences'], self._token_indexers_qamodel
+            ))
             exact_match = self._get_exact_match(question_text, context)
 
-        metadata = {
+            # Proof sentences (node_label without the NAF node), for batched recall metrics
+            labels = as_label_array(node_label)
+            proof_mask = labels[:-1] if labels is not None and len(labels) else np.zeros(0, dtype=np.int8)
+            fields['proof_mask'] = ArrayField(proof_mask.astype(np.bool_), padding_value=0, dtype=np.bool_)
+
+            if 'rollout_prefix' in tokens:
+                # Pre-tokenized spans so the model can build rollout queries in-tensor
+                pad = self.pad_idx(mode='retriever')
+                fields['rollout_prefix'] = ArrayField(tokens['rollout_prefix'], padding_value=pad, dtype=np.int64)
+                fields['rollout_sentences'] = ArrayField(tokens['rollout_sentences'], padding_value=pad, dtype=np.int64)
+
+        metadata = LazyMetadata({
             "id": item_id,
             "question_text": question_text,
-            "tokens": [x.text for x in qa_tokens],
             "context": context,
             "QDep": qdep,
-            "node_label": node_label,
+            "node_label": as_label_array(node_label),
             "exact_match": exact_match if not qa_only else None,
             "QLen": qlen,
-        }
+        }, lazy={"tokens": (token_texts, qa_tokens)})
 
         if label is not None:
             # We'll assume integer labels don't need indexing
@@ -207,6 +312,32 @@ class RetrievalReasoningReader(DatasetReader):
 
         return Instance(fields)
 
+    def tokenize_instance(self, question_text, context, already_retrieved='', qa_only=False, rollout_fields=True):
+        ''' Run all tokenizers needed for an instance. Returns a dict of
+            field name -> tokens (or id arrays for the rollout fields).
+        '''
+        tokens = {}
+        tokens['phrase'], _ = self.transformer_features_from_qa(question_text, context)
+
+        if not qa_only:
+            # Tokenize context sentences seperately
+            tokens['retrieval'] = self.listfield_features_from_qa(
+                question_text, context, already_retrieved, self._tokenizer_retriever
+            )
+            if self._concat:
+                # Both are the qa tokenizer's question + sentence pairs
+                tokens['sentences'] = tokens['retrieval']
+            else:
+                tokens['sentences'] = self.listfield_features_from_qa(
+                    question_text, context, already_retrieved, self._tokenizer_qamodel
+                )
+
+            if self._tensor_rollout and rollout_fields:
+                tokens['rollout_prefix'], tokens['rollout_sentences'] = \
+                    self.rollout_features_from_qa(question_text, context)
+
+        return tokens
+
     def transformer_features_from_qa(self, question: str, context: str):
         if self._add_prefix is not None:
             question = self._add_prefix.get("q", "") + question
@@ -220,26 +351,160 @@ class RetrievalReasoningReader(DatasetReader):
         return tokens, segment_ids
 
     def _get_exact_match(self, question, context):
-        context_lst = [toks.strip() + '.' for toks in context.split('.')[:-1]]
-        exact_match = context_lst.index(question) if question in context_lst else -1
-        return exact_match
+        # First index of each sentence, built once per context
+        sentence_idxs = self._context_store.get(
+            context, 'sentence_idxs',
+            lambda: {s: i for i, s in reversed(list(enumerate(toks.strip() + '.' for toks in context.split('.')[:-1])))},
+        )
+        return sentence_idxs.get(question, -1)
 
     def listfield_features_from_qa(self, question: str, context: str, already_retrieved, tokenizer):
         ''' Tokenize the context items seperately and return as a list.
         '''
-        if self._concat:
+        if self._concat and not already_retrieved:
+            # Context sentences are tokenized once per context
+            tokens = self._concat_features(question, context)
+        elif self._concat:
             tokens = []
             for toks in context.split('.')[:-1]:
                 toks_ = toks.strip() + '.'
                 aug_context = (already_retrieved + ' ' + toks_).strip()
                 trans_features = self.transformer_features_from_qa(question, aug_context)
                 tokens.append(trans_features[0])
+        elif self._num_context_items(question, context):
+            # Same items as splitting question + context, but the context
+            # sentences are tokenized once per context
+            tokens = [tokenizer.tokenize(item + '.') for item in question.split('.')[:-1]]
+            tokens += self._context_store.get(
+                context, ('tokens', id(tokenizer)),
+                lambda: [tokenizer.tokenize(item + '.') for item in context.split('.')[:-1]],
+            )
         else:
             to_tokenize = (question + (context if context is not None else "")).split('.')[:-1]
             to_tokenize = [toks + '.' for toks in to_tokenize]
             tokens = [tokenizer.tokenize(item) for item in to_tokenize]
         return tokens
 
+    def _concat_features(self, question, context):
+        ''' The concat listfield items, i.e. transformer_features_from_qa
+            of the question and each context sentence, built from the
+            question and the sentences tokenized as pair segments (the
+            sentences once per context). Rows reference the same Token
+            objects rather than copies.
+        '''
+        prefix = self._add_prefix or {}
+        template = self._pair_template()
+        q_type, c_type = [t for item, t in template if item is None]
+        specials = len(template) - 2
+
+        q_tokens = self._segment_tokens(prefix.get("q", "") + question, q_type)
+        sentences = self._context_store.get(context, 'concat_sentences', lambda: [
+            self._segment_tokens(prefix.get("c", "") + toks.strip() + '.', c_type)
+            for toks in context.split('.')[:-1]
+        ])
+
+        rows = []
+        for s_tokens in sentences:
+            q, c = truncate_pair(q_tokens, s_tokens, max(len(q_tokens) + len(s_tokens) + specials - self._max_pieces, 0))
+            segments = iter([q, c])
+            row = []
+            for item, _ in template:
+                if item is None:
+                    row.extend(next(segments))
+                else:
+                    row.append(item)
+            rows.append(row)
+        return rows
+
+    def _pair_template(self):
+        ''' (special Token, or None for a segment, type id) of each position
+            of a qa tokenizer sentence pair, e.g. <s> q </s></s> c </s>.
+        '''
+        if getattr(self, '_pair_template_', None) is None:
+            tokenizer = self._tokenizer_qamodel_internal
+            ids = tokenizer.build_inputs_with_special_tokens([-1], [-2])
+            type_ids = tokenizer.create_token_type_ids_from_sequences([-1], [-2])
+            self._pair_template_ = [
+                (None if i < 0 else Token(text=tokenizer.convert_ids_to_tokens(i), text_id=i, type_id=t), t)
+                for i, t in zip(ids, type_ids)
+            ]
+        return self._pair_template_
+
+    def _segment_tokens(self, text, type_id):
+        ''' Tokens of text as one segment of a qa tokenizer pair, i.e. with a
+            leading space as RoBERTa encodes each segment.
+        '''
+        tokenizer = self._tokenizer_qamodel_internal
+        ids = tokenizer.encode(text if text[:1].isspace() else ' ' + text, add_special_tokens=False)
+        return [
+            Token(text=t, text_id=i, type_id=type_id) for t, i in zip(tokenizer.convert_ids_to_tokens(ids), ids)
+        ]
+
+    def _num_context_items(self, question, context):
+        ''' Number of trailing listfield items which only depend on the
+            context (and so can be shared between its questions).
+        '''
+        if self._concat or context is None or not question.endswith('.'):
+            return 0
+        return context.count('.')
+
+    def sentence_fields(self, name, question, context, tokens, token_indexers):
+        ''' TextFields for the items of a listfield. Items which only depend
+            on the context are the same field objects in every instance
+            built from that context.
+        '''
+        n_shared = self._num_context_items(question, context)
+        if not n_shared or n_shared > len(tokens):
+            return [TextField(toks, token_indexers) for toks in tokens]
+
+        n_own = len(tokens) - n_shared
+        fields = [TextField(toks, token_indexers) for toks in tokens[:n_own]]
+        fields += self._context_store.get(
+            context, ('fields', name),
+            lambda: [TextField(toks, token_indexers) for toks in tokens[n_own:]],
+        )
+        return fields
+
+    def rollout_features_from_qa(self, question: str, context: str):
+        ''' Tokenize the question prefix "<s> q </s></s>" and each context
+            sentence once, with the qa model tokenizer as the concat
+            listfield does. Sentences are encoded with a leading space, as
+            RoBERTa does for every segment of a sentence pair, so the spans
+            can be concatenated into the same ids as tokenizing the
+            "q + retrieved + candidate" string (truncated to max_pieces by
+            build_rollout_rows).
+        '''
+        tokenizer = self._tokenizer_qamodel_internal
+        if self._add_prefix is not None:
+            question = self._add_prefix.get("q", "") + question
+        q_ids = tokenizer.encode(' ' + question.strip(), add_special_tokens=False)
+        prefix_ids = tokenizer.build_inputs_with_special_tokens(q_ids, [])[:-1]     # Drop closing </s>
+        if self._add_prefix is not None and self._add_prefix.get("c"):
+            prefix_ids += tokenizer.encode(' ' + self._add_prefix["c"].strip(), add_special_tokens=False)
+
+        array = self._context_store.get(context, 'rollout_sentences', lambda: self._rollout_sentences(context))
+        return np.array(prefix_ids, dtype=self._token_id_dtype()), array
+
+    def _rollout_sentences(self, context):
+        tokenizer = self._tokenizer_qamodel_internal
+        sentence_ids = [
+            tokenizer.encode(' ' + toks.strip() + '.', add_special_tokens=False)
+            for toks in context.split('.')[:-1]
+        ]
+        array = np.full(
+            (len(sentence_ids), max(len(ids) for ids in sentence_ids)),
+            self.pad_idx(mode='retriever'), dtype=self._token_id_dtype()
+        )
+        for n, ids in enumerate(sentence_ids):
+            array[n, :len(ids)] = ids
+        array.setflags(write=False)     # Shared by every question about this context
+        return array
+
+    def _token_id_dtype(self):
+        ''' Rollout ids are stored compactly and widened when batched.
+        '''
+        return np.uint16 if len(self._tokenizer_qamodel_internal) <= 2**16 else np.int32
+
     def transformer_indices_from_qa(self, sentences, vocab):
         ''' Convert question + context strings into a batch
             which is ready for the qa model.
@@ -252,7 +517,8 @@ class RetrievalReasoningReader(DatasetReader):
                 question_text = question, 
                 context = context,
                 already_retrieved = already_retrieved,
-                qa_only = False
+                qa_only = False,
+                rollout_fields = False,
             )
             instance.index_fields(vocab)
             data.append(instance)
@@ -278,6 +544,80 @@ class RetrievalReasoningReader(DatasetReader):
 
         return allennlp_collate(data)
 
+    def batch_indices_from_qa(self, sentences, vocab=None, retrieval=True):
+        ''' Batched alternative to transformer_indices_from_qa. Each field is
+            tokenized for all (question, already_retrieved, context) tuples
+            in one tokenizer call and returned as padded id tensors, without
+            building Instances (or the unused sentences field).
+        '''
+        if retrieval and self._retriever_variant == 'spacy':
+            # No batched tokenizer for spacy, build the fields as usual
+            return self.transformer_indices_from_qa(sentences, vocab)
+
+        batch = {'phrase': {'tokens': self._encode_qa_pairs([(q, c) for q, _, c in sentences])}}
+        if retrieval:
+            batch['retrieval'] = {'tokens': self.retrieval_rows(sentences, vocab)}
+
+        return batch
+
+    def retrieval_rows(self, sentences, vocab=None):
+        ''' Only the retrieval field of batch_indices_from_qa: padded
+            [bsz, n_items, seq_len] tensors of the listfield items.
+        '''
+        if self._retriever_variant == 'spacy':
+            return self.transformer_indices_from_qa(sentences, vocab)['retrieval']['tokens']
+
+        pad = self.pad_idx(mode='retriever')
+        texts, counts = [], []
+        for question, already_retrieved, context in sentences:
+            if self._concat:
+                items = [
+                    (question, (already_retrieved + ' ' + toks.strip() + '.').strip())
+                    for toks in context.split('.')[:-1]
+                ]
+            else:
+                items = [toks + '.' for toks in (question + (context or "")).split('.')[:-1]]
+            texts.extend(items)
+            counts.append(len(items))
+
+        if self._concat:
+            rows = self._encode_qa_pairs(texts, pad)
+        else:
+            rows = encode_texts(self._tokenizer_retriever_internal, texts, self._max_pieces)
+        return group_rows(rows, counts, pad)
+
+    def batch_encode(self, sentences):
+        ''' Batched alternative to encode_batch, see batch_indices_from_qa.
+        '''
+        batch = {'phrase': {'tokens': self._encode_qa_pairs([(q, r) for q, r, _ in sentences])}}
+        batch['label'] = torch.tensor([int(label) for _, _, label in sentences], dtype=torch.long)
+        batch['metadata'] = [
+            {
+                "id": "",
+                "question_text": question,
+                "context": already_retrieved,
+                "QDep": None,
+                "node_label": [],
+                "exact_match": None,
+                "QLen": None,
+                "label": int(label),
+            }
+            for question, already_retrieved, label in sentences
+        ]
+        return batch
+
+    def _encode_qa_pairs(self, pairs, pad_idx=None):
+        ''' transformer_features_from_qa for a batch of (question, context) pairs.
+        '''
+        texts = []
+        for question, context in pairs:
+            if self._add_prefix is not None:
+                question = self._add_prefix.get("q", "") + question
+                if context is not None:
+                    context = self._add_prefix.get("c", "") + context
+            texts.append((question, context) if context is not None else question)
+        return encode_texts(self._tokenizer_qamodel_internal, texts, self._max_pieces, pad_idx)
+
     def decode(self, input_id, mode='qa', vocab=None):
         ''' Helper to decode a tokenized sequence.
         '''
@@ -291,6 +631,10 @@ class RetrievalReasoningReader(DatasetReader):
 
         return ' '.join([func(inp) for inp in input_id.tolist()])
 
+    @property
+    def max_pieces(self):
+        return self._max_pieces
+
     def pad_idx(self, mode):
         if mode == 'qa':
             return self._tokenizer_qamodel_internal.pad_token_id
@@ -299,6 +643,14 @@ class RetrievalReasoningReader(DatasetReader):
         else:
             raise NotImplementedError
 
+    def eos_idx(self, mode):
+        if mode == 'qa':
+            return self._tokenizer_qamodel_internal.sep_token_id
+        elif mode == 'retriever':
+            return self._tokenizer_retriever_internal.sep_token_id
+        else:
+            raise NotImplementedError
+
     def encode_token(self, tok, mode):
         if mode == 'qa':
             return self._tokenizer_qamodel.tokenizer.encoder[tok]
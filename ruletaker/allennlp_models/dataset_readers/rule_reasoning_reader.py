@@ -14,11 +14,15 @@ from allennlp.data.instance import Instance
 from allennlp.data.token_indexers import PretrainedTransformerIndexer
 from allennlp.data.tokenizers import Token, PretrainedTransformerTokenizer
 
+from .batch_encoding import encode_id_arrays, tokens_from_ids
+from .parallel import ParallelTokenizationMixin
+from .proof_utils import LazyMetadata, token_texts
+
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 # TagSpanType = ((int, int), str)
 
 @DatasetReader.register("rule_reasoning")
-class RuleReasoningReader(DatasetReader):
+class RuleReasoningReader(DatasetReader, ParallelTokenizationMixin):
     """
     Parameters
     ----------
@@ -32,7 +36,8 @@ class RuleReasoningReader(DatasetReader):
                  skip_id_regex: str = None,
                  scramble_context: bool = False,
                  use_context_full: bool = False,
-                 sample: int = -1) -> None:
+                 sample: int = -1,
+                 num_workers: int = 0) -> None:
         super().__init__()
         # TODO edit this class
         self._tokenizer = PretrainedTransformerTokenizer(pretrained_model, max_length=max_pieces)
@@ -47,6 +52,7 @@ class RuleReasoningReader(DatasetReader):
         self._sample = sample
         self._syntax = syntax
         self._skip_id_regex = skip_id_regex
+        self._init_workers(num_workers)
 
     @overrides
     def _read(self, file_path: str):
@@ -54,6 +60,10 @@ class RuleReasoningReader(DatasetReader):
         return instances
 
     def _read_internal(self, file_path: str):
+        # Tokenization is spread over num_workers processes
+        return self._instances_from_records(self._read_records(file_path))
+
+    def _read_records(self, file_path: str):
         # if `file_path` is a URL, redirect to the cache
         file_path = cached_path(file_path)
         counter = self._sample + 1
@@ -107,7 +117,7 @@ class RuleReasoningReader(DatasetReader):
                         if label is not None:
                             label = ["False", "True", "Unknown"].index(label)
 
-                    yield self.text_to_instance(
+                    yield dict(
                         item_id=q_id,
                         question_text=text,
                         context=context,
@@ -120,20 +130,20 @@ class RuleReasoningReader(DatasetReader):
                          question_text: str,
                          label: int = None,
                          context: str = None,
-                         debug: int = -1) -> Instance:
+                         debug: int = -1,
+                         qa_ids=None) -> Instance:
         # pylint: disable=arguments-differ
         fields: Dict[str, Field] = {}
 
-        qa_tokens, segment_ids = self.transformer_features_from_qa(question_text, context)
+        qa_tokens, segment_ids = self.transformer_features_from_qa(question_text, context, qa_ids)
         qa_field = TextField(qa_tokens, self._token_indexers)
         fields['phrase'] = qa_field
 
-        metadata = {
+        metadata = LazyMetadata({
             "id": item_id,
             "question_text": question_text,
-            "tokens": [x.text for x in qa_tokens],
             "context": context
-        }
+        }, lazy={"tokens": (token_texts, qa_tokens)})
 
         if label is not None:
             # We'll assume integer labels don't need indexing
@@ -149,10 +159,32 @@ class RuleReasoningReader(DatasetReader):
 
         return Instance(fields)
 
-    def transformer_features_from_qa(self, question: str, context: str):
+    def _encode_records(self, records):
+        ''' Tokenize the qa inputs of a chunk of records with one batched
+            tokenizer call.
+        '''
+        texts = []
+        for record in records:
+            question, context = self._add_prefixes(record['question_text'], record['context'])
+            texts.append((question, context) if context is not None else question)
+        qa_ids = encode_id_arrays(self._tokenizer_internal, texts, self._max_pieces)
+        return [(record, {'qa_ids': ids}) for record, ids in zip(records, qa_ids)]
+
+    def _add_prefixes(self, question: str, context: str):
         if self._add_prefix is not None:
             question = self._add_prefix.get("q", "") + question
             context = self._add_prefix.get("c", "") + context
+        return question, context
+
+    def transformer_features_from_qa(self, question: str, context: str, qa_ids=None):
+        ''' qa_ids are the (token ids, type ids) _encode_records made of the
+            same inputs, if any.
+        '''
+        if qa_ids is not None:
+            tokens = tokens_from_ids(*qa_ids, self._tokenizer_internal.convert_ids_to_tokens)
+            return tokens, [0] * len(tokens)
+
+        question, context = self._add_prefixes(question, context)
         if context is not None:
             tokens = self._tokenizer.tokenize_sentence_pair(question, context)
         else:
@@ -1,4 +1,8 @@
-from random import shuffle
+import math
+from random import shuffle, uniform
+from typing import Optional
+
+import torch.distributed as dist
 from torch.utils import data
 
 from allennlp.data.samplers import SequentialSampler, Sampler, BasicBatchSampler, BatchSampler
@@ -19,24 +23,52 @@ class CustomSequentialSampler(SequentialSampler):
             QLen
         '''
         self.QLens = {}
+        self.lengths = []
         for n,d in enumerate(data_source):
+            # Lets the trainer find the instance of each example (e.g. for the replay buffer)
+            d.fields['metadata'].metadata['sampler_idx'] = n
             qlen = d.fields['metadata'].metadata['QLen']
             if qlen in self.QLens:
                 self.QLens[qlen].append(n)
             else:
                 self.QLens[qlen] = [n]
+            self.lengths.append(self._instance_length(d))
+
+    @staticmethod
+    def _instance_length(instance):
+        ''' (# context sentences, longest sentence in tokens), i.e. the
+            shape of the instance's retrieval tensor.
+        '''
+        if 'retrieval' in instance.fields:
+            sentences = instance.fields['retrieval'].field_list
+            return len(sentences), max((len(s.tokens) for s in sentences), default=0)
+        return 1, len(instance.fields['phrase'].tokens)
+
+
+def shard(ids):
+    ''' This worker's share of ids in distributed training (all of them
+        otherwise). ids are repeated as needed so every worker gets the
+        same number.
+    '''
+    if not (dist.is_available() and dist.is_initialized()) or not ids:
+        return ids
+    world_size = dist.get_world_size()
+    total = math.ceil(len(ids) / world_size) * world_size
+    return (ids * world_size)[:total][dist.get_rank()::world_size]
 
 
 @BatchSampler.register("custom")
 class CustomBasicBatchSampler(BasicBatchSampler):
     ''' Wraps the CustomSequentialSampler so it 
         samples batches.
+
+        In distributed training each QLen bucket is sharded across the
+        workers. Binary classification samples are sharded by the trainer
+        (with their pseudolabels).
     '''
     def __init__(self, sampler: Sampler, batch_size: int, drop_last: bool):
         super().__init__(sampler, batch_size, drop_last)
         self.req_QLens = []
-        self.batch = []
-        self.batches = []
         self._mode = 'retrieval'
 
     def __iter__(self):
@@ -44,23 +76,16 @@ class CustomBasicBatchSampler(BasicBatchSampler):
         for idx in self.get_samples():
             batch.append(idx)
             if len(batch) == self.batch_size:
-                self._save_batch(batch)
                 yield batch
                 batch = []
         if len(batch) > 0 and not self.drop_last:
-            self._save_batch(batch)
             yield batch
             batch = []
 
-    def _save_batch(self, batch):
-        if self._mode == 'retrieval':
-            self.batch.extend(batch)
-            self.batches.extend(batch)
-
     def get_samples(self):
         if self._mode == 'retrieval':
             # return self.sampler.QLens[self.QLen]
-            ids = flatten_list([self.sampler.QLens[k] for k in self.req_QLens if k in self.sampler.QLens])
+            ids = flatten_list([shard(self.sampler.QLens[k]) for k in self.req_QLens if k in self.sampler.QLens])
             shuffle(ids)
             return ids
         elif self._mode == 'binary_classification':
@@ -71,3 +96,112 @@ class CustomBasicBatchSampler(BasicBatchSampler):
     def set_mode(self, mode: str):
         assert mode in ['binary_classification', 'retrieval']
         self._mode = mode
+
+
+
+@BatchSampler.register("custom_token_budget")
+class TokenBudgetBatchSampler(CustomBasicBatchSampler):
+    ''' Like CustomBasicBatchSampler but, in retrieval mode, batches are
+        built per QLen bucket from instances of similar length and sized so
+        the padded retrieval tensor (bsz, context_len, sentence_len) stays
+        under max_tokens. max_instances (optional) caps the instances per
+        batch. Binary classification batches are batch_size fixed-size
+        batches, as with CustomBasicBatchSampler, since their order is
+        aligned with the replay buffer pseudolabels.
+
+        With concat_q_and_c readers the retrieval rows grow by a sentence at
+        each rollout step, so pass the reader's max_pieces: rows are then
+        budgeted at their length after QLen steps (see _row_length).
+
+        Each epoch's batches are planned once, so len() is the number of
+        batches the next iteration yields. drop_last is not supported, as
+        retrieval batches have no fixed size.
+    '''
+    def __init__(self,
+        sampler: Sampler,
+        batch_size: int,
+        max_tokens: int,
+        max_instances: Optional[int] = None,
+        drop_last: bool = False,
+        padding_noise: float = 0.1,
+        max_pieces: Optional[int] = None,
+    ):
+        if drop_last:
+            raise ValueError("drop_last is not supported by the custom_token_budget batch sampler.\nInvestigate!")
+        super().__init__(sampler, batch_size, drop_last)
+        self.max_tokens = max_tokens
+        self.max_instances = max_instances
+        self.padding_noise = padding_noise
+        self.max_pieces = max_pieces
+        self._planned = None        # (req_QLens, batches) of the next iteration
+
+    def __iter__(self):
+        if self._mode != 'retrieval':
+            yield from super().__iter__()
+            return
+
+        try:
+            yield from self._plan()
+        finally:
+            # The next epoch gets new batches (and padding noise)
+            self._planned = None
+
+    def __len__(self):
+        if self._mode != 'retrieval':
+            return super().__len__()
+        return len(self._plan())
+
+    def _plan(self):
+        ''' The shuffled retrieval batches of the next iteration, made on
+            first use by __len__ or __iter__ so both see the same batches.
+        '''
+        key = tuple(self.req_QLens)
+        if self._planned is None or self._planned[0] != key:
+            batches = self._make_batches(noise=self.padding_noise)
+            shuffle(batches)
+            self._planned = (key, batches)
+        return self._planned[1]
+
+    def _make_batches(self, noise):
+        batches = []
+        for qlen in self.req_QLens:
+            ids = list(shard(self.sampler.QLens.get(qlen, [])))
+            shuffle(ids)
+            # Sort by length with some noise so batches differ across epochs
+            ids.sort(key=lambda i: tuple(l * (1 + uniform(-noise, noise)) for l in self.sampler.lengths[i]))
+            batches.extend(self._pack(ids, qlen))
+        return batches
+
+    def _row_length(self, length, qlen):
+        ''' Longest retrieval row of an instance during a rollout of qlen
+            steps. Concat rows "q + retrieved + candidate" are at most qlen
+            times the longest initial "q + candidate" row, and at most
+            max_pieces.
+        '''
+        if self.max_pieces is None:
+            return length
+        return min(max(qlen, 1) * length, self.max_pieces)
+
+    def _pack(self, ids, qlen=1):
+        ''' Greedily pack (length-sorted) ids into batches whose padded
+            size fits the token budget. An instance larger than the budget
+            gets a batch of its own.
+        '''
+        batches, batch = [], []
+        max_sentences, max_len = 0, 0
+        for idx in ids:
+            n_sentences, length = self.sampler.lengths[idx]
+            length = self._row_length(length, qlen)
+            max_sentences_, max_len_ = max(max_sentences, n_sentences), max(max_len, length)
+            is_full = (
+                (len(batch) + 1) * max_sentences_ * max_len_ > self.max_tokens
+                or (self.max_instances is not None and len(batch) == self.max_instances)
+            )
+            if batch and is_full:
+                batches.append(batch)
+                batch, max_sentences_, max_len_ = [], n_sentences, length
+            batch.append(idx)
+            max_sentences, max_len = max_sentences_, max_len_
+        if batch:
+            batches.append(batch)
+        return batches
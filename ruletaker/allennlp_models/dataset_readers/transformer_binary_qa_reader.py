@@ -15,11 +15,14 @@ from allennlp.data.instance import Instance
 from allennlp.data.token_indexers import PretrainedTransformerIndexer, SingleIdTokenIndexer, TokenIndexer
 from allennlp.data.tokenizers import Tokenizer, PretrainedTransformerTokenizer, SpacyTokenizer
 
+from .batch_encoding import encode_id_arrays, tokens_from_ids
+from .parallel import ParallelTokenizationMixin
+
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
 @DatasetReader.register("transformer_binary_qa")
-class TransformerBinaryReader(DatasetReader):
+class TransformerBinaryReader(DatasetReader, ParallelTokenizationMixin):
     """
     Supports reading artisets for both transformer models (e.g., pretrained_model="roberta-base" and
     combine_input_fields=True) and NLI models with separate premise and hypothesis (set combine_input_fields=False).
@@ -34,7 +37,8 @@ class TransformerBinaryReader(DatasetReader):
                  max_pieces: int = 512,
                  add_prefix: bool = False,
                  combine_input_fields: bool = True,
-                 sample: int = -1) -> None:
+                 sample: int = -1,
+                 num_workers: int = 0) -> None:
         super().__init__()
 
         if pretrained_model != None:
@@ -46,12 +50,17 @@ class TransformerBinaryReader(DatasetReader):
             self._token_indexers = token_indexers or {"tokens": SingleIdTokenIndexer()}
 
         self._sample = sample
+        self._max_pieces = max_pieces
         self._add_prefix = add_prefix
         self._combine_input_fields = combine_input_fields
         self._debug_prints = -1
+        self._init_workers(num_workers)
 
     @overrides
     def _read(self, file_path: str):
+        return self._instances_from_records(self._read_records(file_path))
+
+    def _read_records(self, file_path: str):
         self._debug_prints = 5
         cached_file_path = cached_path(file_path)
 
@@ -80,7 +89,7 @@ class TransformerBinaryReader(DatasetReader):
             metadata = {} if "metadata" not in item_json else item_json["metadata"]
             context = item_json["context"] if "context" in item_json else None
 
-            yield self.text_to_instance(
+            yield dict(
                     item_id=item_id,
                     question=statement_text,
                     answer_id=item_json["answer"],
@@ -95,10 +104,11 @@ class TransformerBinaryReader(DatasetReader):
                          question: str,
                          answer_id: int = None,
                          context: str = None,
-                         org_metadata: dict = {}) -> Instance:
+                         org_metadata: dict = {},
+                         qa_ids=None) -> Instance:
         fields: Dict[str, Field] = {}
         if self._combine_input_fields:
-            qa_tokens = self.transformer_features_from_qa(question, context)
+            qa_tokens = self.transformer_features_from_qa(question, context, qa_ids)
             qa_field = TextField(qa_tokens, self._token_indexers)
             fields['phrase'] = qa_field
         else:
@@ -132,13 +142,35 @@ class TransformerBinaryReader(DatasetReader):
         fields["metadata"] = MetadataField(new_metadata)
         return Instance(fields)
 
-    def transformer_features_from_qa(self, question: str, context: str):
+    def _encode_records(self, records):
+        """
+        Tokenize the combined inputs of a chunk of records with one batched tokenizer call
+        (transformer models only).
+        """
+        if not (self._combine_input_fields and isinstance(self._tokenizer, PretrainedTransformerTokenizer)):
+            return super()._encode_records(records)
+        texts = [self._qa_texts(record['question'], record['context']) for record in records]
+        qa_ids = encode_id_arrays(self._tokenizer.tokenizer, texts, self._max_pieces)
+        return [(record, {'qa_ids': ids}) for record, ids in zip(records, qa_ids)]
+
+    def _qa_texts(self, question: str, context: str):
         if self._add_prefix:
             question = "Q: " + question
             if context is not None and len(context) > 0:
                 context = "C: " + context
         if context is not None and len(context) > 0:
-            tokens = self._tokenizer.tokenize_sentence_pair(question, context)
+            return question, context
+        return question
+
+    def transformer_features_from_qa(self, question: str, context: str, qa_ids=None):
+        """
+        qa_ids are the (token ids, type ids) _encode_records made of the same inputs, if any.
+        """
+        if qa_ids is not None:
+            return tokens_from_ids(*qa_ids, self._tokenizer.tokenizer.convert_ids_to_tokens)
+        texts = self._qa_texts(question, context)
+        if isinstance(texts, tuple):
+            tokens = self._tokenizer.tokenize_sentence_pair(*texts)
         else:
-            tokens = self._tokenizer.tokenize(question)
+            tokens = self._tokenizer.tokenize(texts)
         return tokens
@@ -0,0 +1,53 @@
+import torch
+
+
+def subset_weights(n, device=None):
+    ''' A random int64 weight for each of n sentences. The sum of the weights
+        of a set of sentences identifies the set (up to a negligible chance of
+        collision) whatever the order they were retrieved in.
+    '''
+    generator = torch.Generator().manual_seed(0)
+    return torch.randint(1, 2 ** 56, (n,), generator=generator).to(device)
+
+
+def merge_duplicate_subsets(scores, keys):
+    ''' Merge the [bsz, m] hypotheses with equal keys (the same retrieved
+        set): the best of each set gets the log-sum-exp of the set's scores,
+        the others -inf.
+    '''
+    m = scores.size(-1)
+    same = keys.unsqueeze(-1) == keys.unsqueeze(-2)       # [bsz, m, m]
+
+    # Log-sum-exp over each hypothesis' set
+    merged = torch.logsumexp(scores.unsqueeze(1).masked_fill(~same, -float('inf')), dim=-1)
+
+    # The best of a set (the first of equal bests) is not beaten by another of the set
+    score_i, score_j = scores.unsqueeze(-1), scores.unsqueeze(-2)
+    idx = torch.arange(m, device=scores.device)
+    earlier = idx.view(1, 1, m) < idx.view(1, m, 1)
+    beaten = (same & ((score_j > score_i) | ((score_j == score_i) & earlier))).any(-1)
+    return merged.masked_fill(beaten, -float('inf'))
+
+
+def beam_step(beam_scores, beam_keys, log_probs, weights, beam_size):
+    ''' One step of beam search over retrievals.
+        :param beam_scores: [bsz, b] accumulated log-probs of the beams
+        :param beam_keys: [bsz, b] subset keys of the beams (see subset_weights)
+        :param log_probs: [bsz, b, n] log-probs of retrieving each sentence next
+        :return scores, keys, parents, actions: [bsz, beam_size] of the best
+            continuations, with the beams they extend and the sentences they add
+    '''
+    bsz, b, n = log_probs.shape
+    scores = (beam_scores.unsqueeze(-1) + log_probs).view(bsz, b * n)
+    keys = (beam_keys.unsqueeze(-1) + weights.view(1, 1, n)).view(bsz, b * n)
+    scores = merge_duplicate_subsets(scores, keys)
+    scores, idx = scores.topk(min(beam_size, b * n), dim=-1)
+    return scores, keys.gather(1, idx), idx // n, idx % n
+
+
+def best_beam_rows(rows, parents, actions):
+    ''' The [bsz, seq_len] query+retrievals of the best (first) beam, from
+        the [bsz, b, n, seq_len] candidate rows of its parents.
+    '''
+    best = torch.arange(rows.size(0), device=rows.device)
+    return rows[best, parents[:, 0], actions[:, 0]]
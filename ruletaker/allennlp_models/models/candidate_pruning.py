@@ -0,0 +1,61 @@
+import torch
+
+from .prefix_encoder import split_shared_prefix
+
+
+def lexical_overlap_scores(rows, pad_idx):
+    ''' Cheap first stage relevance of [bsz, n, seq_len] concatenated
+        query+candidate rows: the tokens of each candidate (the part after the
+        prefix shared by all rows) which also occur in the query, each
+        weighted by 1 / the number of candidates it occurs in, so that
+        function words and punctuation count for little.
+
+        Returns [bsz, n] scores, -inf for padding rows.
+    '''
+    prefix, prefix_mask, _, suffix, suffix_mask = split_shared_prefix(rows, pad_idx)
+
+    in_query = ((suffix.unsqueeze(-1) == prefix[:, None, None, :]) & prefix_mask[:, None, None, :]).any(-1)
+
+    df = candidate_frequency(suffix, suffix_mask).clamp(min=1)
+
+    weights = (in_query & suffix_mask).float() / df.float()
+    scores = weights.sum(-1)
+    return scores.masked_fill((rows == pad_idx).all(-1), -float('inf'))
+
+
+def candidate_frequency(suffix, suffix_mask):
+    ''' Number of candidates each token of the [bsz, n, L] candidate tokens
+        occurs in (0 where masked), in O(n * L log(n * L)): tokens are
+        numbered per batch element with torch.unique, then each candidate
+        counts once for each distinct token number it holds.
+    '''
+    if suffix.numel() == 0:
+        return torch.zeros_like(suffix)
+    bsz = suffix.size(0)
+    # Same token in different batch elements -> different keys, masked -> -1
+    offset = torch.arange(bsz, device=suffix.device).view(bsz, 1, 1) * (suffix.max() + 1)
+    keys = torch.where(suffix_mask, suffix + offset, torch.full_like(suffix, -1))
+    _, token_ids = torch.unique(keys, return_inverse=True)
+
+    # First occurrence of each token id within a candidate
+    sorted_ids, _ = token_ids.sort(-1)
+    first = torch.ones_like(sorted_ids, dtype=torch.bool)
+    first[..., 1:] = sorted_ids[..., 1:] != sorted_ids[..., :-1]
+    counts = torch.zeros(int(token_ids.max()) + 1, dtype=torch.long, device=suffix.device)
+    counts.scatter_add_(0, sorted_ids.flatten(), first.flatten().long())
+    return counts[token_ids] * suffix_mask.long()
+
+
+def prune_candidates(rows, pad_idx, topk):
+    ''' Indices [bsz, topk] of the candidates with the highest
+        lexical_overlap_scores. Ties keep the earlier candidate.
+    '''
+    scores = lexical_overlap_scores(rows, pad_idx)
+    n = scores.size(-1)
+
+    # Rank by score then position (topk does not break ties by position)
+    idx = torch.arange(n, device=scores.device)
+    score_i, score_j = scores.unsqueeze(-1), scores.unsqueeze(-2)
+    earlier = idx.view(1, 1, n) < idx.view(1, n, 1)
+    rank = ((score_j > score_i) | ((score_j == score_i) & earlier)).sum(-1)
+    return rank.argsort(-1)[:, :topk]
@@ -5,6 +5,7 @@ import sys
 import time
 import wandb
 import random
+from contextlib import nullcontext
 
 import torch
 from torch.nn.modules.linear import Linear
@@ -19,9 +20,19 @@ from allennlp.training.metrics import CategoricalAccuracy
 from .retriever_embedders import (
     SpacyRetrievalEmbedder, TransformerRetrievalEmbedder
 )
-from .utils import safe_log, right_pad, batch_lookup, EPSILON, make_dot, set_dropout, one_hot, lmap, lfilter
+from .utils import (
+    safe_log, right_pad, batch_lookup, EPSILON, make_dot, set_dropout, one_hot, lmap, lfilter,
+    build_rollout_rows
+)
 from .transformer_binary_qa_model import TransformerBinaryQA
+from .prediction_sink import PredictionSink
+from .qa_metrics import BucketedQAMetrics
+from .metrics_sink import get_metrics_sink
 from .baseline import Baseline
+from .score_cache import RetrievalScoreCache, cached_row_outputs
+from .rollout_prefetch import Deferred, RolloutPrefetcher
+from .candidate_pruning import prune_candidates
+from .beam_search import subset_weights, beam_step, best_beam_rows
 
 torch.manual_seed(0)
 
@@ -35,15 +46,23 @@ class GumbelSoftmaxRetrieverReasoner(Model):
         requires_grad: bool = True,
         transformer_weights_model: str = None,
         num_labels: int = 2,
-        predictions_file=None,
+        predictions_file='predictions.jsonl',
         layer_freeze_regexes: List[str] = None,
         regularizer: Optional[RegularizerApplicator] = None,
         topk: int = 5,
         sentence_embedding_method: str = 'mean',
         dataset_reader = None,
+        tensor_rollout: bool = False,
+        shared_prefix_encoding: bool = False,
+        prefetch_workers: int = 0,
+        prefetch_backend: str = 'thread',
+        prune_topk: int = None,
+        beam_size: int = 1,
     ) -> None:
         super().__init__(qa_model.vocab, regularizer)
         self.qa_model = qa_model
+        # Validation predictions go to predictions_file (relative to the serialization dir)
+        self.qa_model._prediction_sink = PredictionSink(predictions_file)
         self.qa_model._loss = nn.CrossEntropyLoss(reduction='none')
         self.qa_vocab = qa_model.vocab
         self.vocab = vocab
@@ -67,11 +86,42 @@ class GumbelSoftmaxRetrieverReasoner(Model):
         self._flag = False
         self._replay_memory = None
         self._mode = 'retrieval'
+        self._tensor_rollout = tensor_rollout
+        self._shared_prefix_encoding = shared_prefix_encoding
+        self._stage_timer = None        # set by CustomTrainer(profile_stages=True)
+        if shared_prefix_encoding and variant == 'spacy':
+            raise ValueError("shared_prefix_encoding requires a transformer retriever.\nInvestigate!")
+
+        # Background tokenization of the next rollout step (unused with tensor_rollout)
+        self._prefetcher = None
+        if prefetch_workers > 0 and not tensor_rollout:
+            if variant == 'spacy':
+                raise ValueError("prefetch_workers requires a transformer retriever.\nInvestigate!")
+            self._prefetcher = RolloutPrefetcher(
+                dataset_reader, self.qa_vocab, num_workers=prefetch_workers, backend=prefetch_backend
+            )
+
+        # Only the prune_topk candidates with the most lexical overlap with the
+        # query are scored by the retriever, the rest get no probability mass
+        self._prune_topk = prune_topk
+        if prune_topk is not None and variant == 'spacy':
+            raise ValueError("prune_topk requires a transformer retriever.\nInvestigate!")
+        self._prune_hits = 0
+        self._prune_gold = 0
+
+        # Beam search over the retrievals at evaluation (greedy with 1)
+        if beam_size < 1:
+            raise ValueError(f"Invalid beam_size: {beam_size}.\nInvestigate!")
+        self._beam_size = beam_size
         # self.b = 0.0
         self.b = Baseline()
 
         self.define_modules()
-        self.answers = {}
+
+        # Running accuracy by proof length
+        self.answers = BucketedQAMetrics()
+        self._log_interval = 100
+        self._num_logged = 0
 
     def forward(self, 
         label: torch.LongTensor = None,
@@ -96,38 +146,53 @@ class GumbelSoftmaxRetrieverReasoner(Model):
         # ids = [m['id'] for m in metadata]
         # # print(ids)
 
+        rollout = self.get_rollout_inputs(kwargs)
+
         # Storage tensors
         policies, actions, unscaled_retrieval_losses = [],[],[]
         
         # Retrieval rollout phase
-        for t in range(self.num_rollout_steps):
-            policy = self.get_retrieval_distr(qr, metadata)            
-            action = self.gs(policy, tau=1) if self.training else one_hot(policy, policy.argmax(-1))
-            if flag:
-                action = one_hot(action, torch.tensor([0]*action.size(0)).view(-1,1).cuda())
-            loss = self.retriever_loss(policy, action.argmax(-1))
-
-            policies.append(policy)
-            actions.append(action)
-            unscaled_retrieval_losses.append(loss)
-
-            q = qr.gather(1, action.argmax(-1).view(-1, 1, 1).repeat(1, 1, qr.size(-1))).squeeze(1)
-            if t == self.num_rollout_steps:
-                metadata = self.prep_next_batch(qr, metadata, actions, t, False)
-            else:
-                qr, metadata = self.prep_next_batch(qr, metadata, actions, t, True)
-
-
-            if True:
-                a = action.argmax(-1)
-                p = policy.argmax(-1)
-                p_ = policy.softmax(-1)
-                argmax_ps = p_.gather(1, p.unsqueeze(1)).squeeze()
-                action_ps = p_.gather(1, a.unsqueeze(1)).squeeze()
+        if not self.training and self._beam_size > 1:
+            policies, actions, q = self.beam_search(qr, metadata, rollout)
+            unscaled_retrieval_losses = [self.retriever_loss(p, a.argmax(-1)) for p, a in zip(policies, actions)]
+        else:
+            for t in range(self.num_rollout_steps):
+                with self.stage('retrieval_scoring'):
+                    policy = self.get_retrieval_distr(qr, metadata)
+                action = self.gs(policy, tau=1) if self.training else one_hot(policy, policy.argmax(-1))
+                if flag:
+                    action = one_hot(action, torch.tensor([0]*action.size(0)).view(-1,1).cuda())
+                policies.append(policy)
+                actions.append(action)
+
+                # Start building the next step's query+retrievals, then issue the rest of this step
+                with self.stage('retokenize'):
+                    next_batch = self.prefetch_next_batch(
+                        qr, metadata, actions, t, t != self.num_rollout_steps, rollout
+                    )
+
+                loss = self.retriever_loss(policy, action.argmax(-1))
+                unscaled_retrieval_losses.append(loss)
+
+                q = qr.gather(1, action.argmax(-1).view(-1, 1, 1).repeat(1, 1, qr.size(-1))).squeeze(1)
+
+                if True:
+                    a = action.argmax(-1)
+                    p = policy.argmax(-1)
+                    p_ = policy.softmax(-1)
+                    argmax_ps = p_.gather(1, p.unsqueeze(1)).squeeze()
+                    action_ps = p_.gather(1, a.unsqueeze(1)).squeeze()
+
+                with self.stage('retokenize'):
+                    if t == self.num_rollout_steps:
+                        metadata = next_batch.result()
+                    else:
+                        qr, metadata = next_batch.result()
             
         # Query answering phase
         self.update_meta(q, metadata, actions)
-        output = self.answer(q, label, metadata)
+        with self.stage('qa_forward'):
+            output = self.answer(q, label, metadata)
 
         # Scale retrieval losses by final loss
         qa_loss = output['loss'].detach()
@@ -146,36 +211,47 @@ class GumbelSoftmaxRetrieverReasoner(Model):
         output['sampled_actions'] = torch.cat([a.unsqueeze(0) for a in actions]).argmax(dim=-1)
 
         correct = (output["label_probs"].argmax(-1) == label)
-        self.log_results(qlens, correct)
-        print(f'\n\n{qa_loss.mean().item():.3f}\t{retrieval_losses.mean().item():.3f}\t{(correct).float().mean().item()}')
+        self.log_results(qlens, correct, qa_loss, retrieval_losses)
 
         if self._replay_memory is not None:
             self.add_correct_to_buffer(correct, metadata)
 
         return output
 
-    def log_results(self, qlens, correct):
-        for d, c in zip(qlens, correct):
-            if d not in self.answers:
-                self.answers[d] = []
-            self.answers[d].append(c.item())
-
-        for d in self.answers.keys():
-            all_score = self.answers[d].count(True) / len(self.answers[d])
-            last_100 = self.answers[d][-100:].count(True) / len(self.answers[d][-100:])
-            print(f'\nL: {d}\tAll: {all_score:.4f}\tLast 100: {last_100:.2f}\tN: {len(self.answers[d])}')
+    def log_results(self, qlens, correct, qa_loss, retrieval_losses):
+        ''' Accuracy by proof length and the losses, to the metrics sink. The
+            accuracies since the start of training are printed every
+            log_interval batches.
+        '''
+        qlens = torch.tensor(qlens)
+        prefix = 'train' if self.training else 'val'
+        self.answers(qlens, correct)
+        sink = get_metrics_sink()
+        sink.log_buckets(f'{prefix}_rollout_', qlens, correct)
+        sink.log({f'{prefix}_qa_loss': qa_loss, f'{prefix}_retrieval_loss': retrieval_losses}, commit=False)
+
+        self._num_logged += 1
+        if self._num_logged % self._log_interval == 0:
+            print('\n' + '\t'.join(f'{k}: {v:.4f}' for k, v in self.answers.get_metric().items()))
+
+    def stage(self, name):
+        ''' Timing span for a stage of the forward pass (a no-op unless
+            the trainer is profiling stages).
+        '''
+        if self._stage_timer is None:
+            return nullcontext()
+        return self._stage_timer.span(name)
 
     def get_retrieval_distr(self, qr, meta=None):
         ''' Compute the probability of retrieving each item given
             the current query+retrieval (i.e. p(zj | zi, y))
         '''
-        e_q = self.get_context_embs(qr)
-        sim = self.W(e_q).squeeze(-1)
+        sim = self.score_candidates(qr, meta, lambda rows: self.W(self.get_context_embs(rows)).squeeze(-1))
 
         # Ensure padding receives 0 probability mass
         similarity = torch.where(
             qr.max(dim=2).values == self.retriever_pad_idx,     # Identify rows which contain all padding
-            torch.tensor(-float("inf")).to(e_q.device), 
+            torch.tensor(-float("inf")).to(sim.device), 
             sim,
         )
 
@@ -185,7 +261,114 @@ class GumbelSoftmaxRetrieverReasoner(Model):
             raise ValueError('All retrievals are -inf for a sample. This will lead to nan loss')
 
         return similarity
-        
+
+    def score_candidates(self, qr, meta, score_fn):
+        ''' score_fn(rows) for the [bsz, n, seq_len] query+candidate rows. With
+            prune_topk, only the top candidates by lexical overlap are scored
+            and the others are -inf.
+        '''
+        if self._prune_topk is None or self._prune_topk >= qr.size(1):
+            return score_fn(qr)
+
+        keep = prune_candidates(qr, self.retriever_pad_idx, self._prune_topk)
+        if meta is not None:
+            self.update_prune_recall(qr, meta, keep)
+        rows = qr.gather(1, keep.unsqueeze(-1).expand(-1, -1, qr.size(-1)))
+        scores = score_fn(rows)
+        return scores.new_full(qr.shape[:2], -float('inf')).scatter(1, keep, scores)
+
+    def update_prune_recall(self, qr, meta, keep):
+        ''' Count the proof sentences still to be retrieved which survive pruning.
+        '''
+        gold = torch.zeros(qr.shape[:2], dtype=torch.bool)
+        for i, m in enumerate(meta):
+            nodes = torch.as_tensor(m['node_label'][:-1]).bool()[:qr.size(1)]      # [:-1] because final node is NAF node
+            gold[i, :len(nodes)] = nodes
+        gold = gold.to(qr.device) & (qr.max(dim=2).values != self.retriever_pad_idx)
+        kept = torch.zeros_like(gold).scatter(1, keep, True)
+        self._prune_hits += (gold & kept).sum()
+        self._prune_gold += gold.sum()
+
+    def beam_search(self, qr, metadata, rollout=None):
+        ''' Beam search over the retrievals (for evaluation): keeps the
+            beam_size retrieved sets with the highest accumulated log-prob,
+            merging beams which retrieved the same sentences in a different
+            order. The candidates of all beams are scored in one retriever call.
+            Returns the policies and actions of the best beam and its final
+            query+retrievals.
+        '''
+        bsz, n = qr.shape[:2]
+        weights = subset_weights(n, qr.device)
+        scores = torch.zeros(bsz, 1, device=qr.device)
+        keys = torch.zeros(bsz, 1, dtype=torch.long, device=qr.device)
+        history = torch.zeros(bsz, 1, 0, dtype=torch.long, device=qr.device)      # Retrieved sentence idxs
+        policies = torch.zeros(bsz, 1, 0, n, device=qr.device)
+        rows = qr.unsqueeze(1)     # [bsz, beams, n, seq_len]
+
+        for t in range(self.num_rollout_steps):
+            b = rows.size(1)
+            with self.stage('retrieval_scoring'):
+                # No metadata: prune recall is only counted for the greedy rollout
+                policy = self.get_retrieval_distr(rows.view(bsz * b, n, rows.size(-1))).view(bsz, b, n)
+            scores, keys, parents, actions = beam_step(
+                scores, keys, policy.float().log_softmax(-1), weights, self._beam_size
+            )
+            history = torch.cat([
+                history.gather(1, parents.unsqueeze(-1).expand(-1, -1, t)), actions.unsqueeze(-1)
+            ], dim=-1)
+            policies = torch.cat([
+                policies.gather(1, parents[..., None, None].expand(-1, -1, t, n)),
+                policy.float().gather(1, parents.unsqueeze(-1).expand(-1, -1, n)).unsqueeze(2),
+            ], dim=2)
+            if t < self.num_rollout_steps - 1:
+                with self.stage('retokenize'):
+                    rows = self.beam_rows(qr, metadata, history, rollout)
+
+        # Final query+retrievals of the best beam
+        q = best_beam_rows(rows, parents, actions)
+
+        for meta, sentence_idxs, score in zip(metadata, history[:, 0].tolist(), scores[:, 0].tolist()):
+            meta['context_str'] = f"q: {meta['question_text']} c: {self.retrieved_context(meta, sentence_idxs)}"
+            meta['beam_score'] = score
+
+        best_policies = [policies[:, 0, t] for t in range(self.num_rollout_steps)]
+        best_actions = [one_hot(p, history[:, 0, t]) for t, p in enumerate(best_policies)]
+        return best_policies, best_actions, q
+
+    def beam_rows(self, qr, metadata, history, rollout=None):
+        ''' [bsz, beams, n, seq_len] query+retrieval rows of each beam, given
+            the [bsz, beams, t] sentences it retrieved.
+        '''
+        bsz, b, _ = history.shape
+        n = qr.size(1)
+        retrieved = torch.zeros(bsz, b, n, dtype=torch.bool, device=qr.device).scatter(2, history, True)
+
+        if rollout is not None:
+            rows = build_rollout_rows(
+                rollout['prefix'].repeat_interleave(b, dim=0),
+                rollout['sentences'].repeat_interleave(b, dim=0),
+                retrieved.view(bsz * b, n),
+                self.retriever_pad_idx, self.dataset_reader.eos_idx(mode='qa'), self.dataset_reader.max_pieces,
+            )
+            return rows.view(bsz, b, n, -1)
+
+        sentences = [
+            (meta['question_text'], self.retrieved_context(meta, sentence_idxs), meta['context'])
+            for meta, beams in zip(metadata, history.tolist()) for sentence_idxs in beams
+        ]
+        if self._prefetcher is not None:
+            rows = self._prefetcher.submit(sentences, qr.device).result()
+        else:
+            rows = self.dataset_reader.retrieval_rows(sentences, self.qa_vocab)[self.tok_name].to(qr.device)
+        rows = rows.masked_fill(retrieved.view(bsz * b, n, 1), self.retriever_pad_idx)
+        return rows.view(bsz, b, n, -1)
+
+    def retrieved_context(self, meta, sentence_idxs):
+        ''' The retrieved sentences of the context, in context order. '''
+        return ''.join(
+            toks + '.' for n, toks in enumerate(meta['context'].split('.')[:-1]) if n in sentence_idxs
+        ).strip()
+
     def answer(self, qr, label, metadata):
         return self.get_query_embs(qr, label, metadata)
     
@@ -194,6 +377,8 @@ class GumbelSoftmaxRetrieverReasoner(Model):
         return self.qa_model(qr_, label, metadata)
 
     def get_context_embs(self, c):
+        if self._shared_prefix_encoding:
+            return self.retriever_model.forward_shared_prefix(c)
         return self.retriever_model(c)
 
     def gs(self, logits, tau=1):
@@ -209,19 +394,52 @@ class GumbelSoftmaxRetrieverReasoner(Model):
             meta['topk'] = topk.tolist()
             meta['query_retrieval'] = qr.tolist()
 
-    def prep_next_batch(self, qr, metadata, actions, t, return_qr):
+    def get_rollout_inputs(self, kwargs):
+        ''' Pre-tokenized prefix and sentence spans for the in-tensor
+            rollout (see RetrievalReasoningReader.rollout_features_from_qa).
+        '''
+        if not self._tensor_rollout:
+            return None
+        if 'rollout_prefix' not in kwargs or 'rollout_sentences' not in kwargs:
+            raise ValueError(
+                "tensor_rollout requires the dataset reader to be built with tensor_rollout = true.\nInvestigate!"
+            )
+        return {'prefix': kwargs['rollout_prefix'].long(), 'sentences': kwargs['rollout_sentences'].long()}
+
+    def prep_next_batch(self, qr, metadata, actions, t, return_qr, rollout=None):
         ''' Concatenate the latest retrieval to the current 
             query+retrievals. Also update the tensors for the next
             rollout pass.
         '''
+        return self.prefetch_next_batch(qr, metadata, actions, t, return_qr, rollout).result()
+
+    def prefetch_next_batch(self, qr, metadata, actions, t, return_qr, rollout=None):
+        ''' prep_next_batch, returned as a Deferred. The metadata is updated
+            straight away, while the new query+retrievals are tokenized on
+            the prefetcher's workers (if any) until result() is called.
+        '''
         # Get indexes of retrieval items
         retrievals = torch.cat([a.unsqueeze(0) for a in actions]).argmax(-1).T
 
+        if rollout is not None:
+            # Build the next query+retrievals directly from the cached spans
+            if not return_qr:
+                return Deferred(lambda: metadata)
+            retrieved = torch.zeros(rollout['sentences'].shape[:2], dtype=torch.bool, device=qr.device)
+            retrieved.scatter_(1, retrievals, True)
+            qr_ = build_rollout_rows(
+                rollout['prefix'], rollout['sentences'], retrieved,
+                self.retriever_pad_idx, self.dataset_reader.eos_idx(mode='qa'), self.dataset_reader.max_pieces,
+            )
+            return Deferred(lambda: (qr_, metadata))
+
         # Concatenate query + retrival to make new query_retrieval matrix of idxs        
+        # The sentences to tokenize depend on this step's action, so wait for
+        # it here, once for the whole batch
         sentences = []
-        for topk, meta in zip(retrievals, metadata):
+        for topk, meta in zip(retrievals.tolist(), metadata):
             question = meta['question_text']
-            sentence_idxs = [int(i) for i in topk.tolist()[:t+1] if i != self.x]
+            sentence_idxs = [i for i in topk[:t+1] if i != self.x]
             context_rtr = [
                 toks + '.' for n, toks in enumerate(meta['context'].split('.')[:-1]) 
                 if n in sentence_idxs
@@ -230,14 +448,20 @@ class GumbelSoftmaxRetrieverReasoner(Model):
             sentences.append((question, ''.join(context_rtr).strip(), meta['context']))
 
         if not return_qr:
-            return metadata
+            return Deferred(lambda: metadata)
 
-        batch = self.dataset_reader.transformer_indices_from_qa(sentences, self.qa_vocab)
-        qr_ = batch['retrieval']['tokens']['token_ids'].to(qr.device)
-        qr_ = qr_.scatter(
-            1, retrievals.unsqueeze(-1).repeat(1, 1, qr_.size(-1)), self.retriever_pad_idx
-        )
-        return qr_, metadata
+        if self._prefetcher is not None:
+            rows = self._prefetcher.submit(sentences, qr.device)
+        else:
+            rows = Deferred(lambda: self.dataset_reader.retrieval_rows(sentences, self.qa_vocab)[self.tok_name].to(qr.device))
+
+        def next_qr():
+            qr_ = rows.result()
+            qr_ = qr_.scatter(
+                1, retrievals.unsqueeze(-1).repeat(1, 1, qr_.size(-1)), self.retriever_pad_idx
+            )
+            return qr_, metadata
+        return Deferred(next_qr)
 
     def baseline_loss(self, b, x):
         # return -torch.zeros_like(x).fill_(-torch.log(torch.tensor(1-b)))
@@ -280,7 +504,14 @@ class GumbelSoftmaxRetrieverReasoner(Model):
         
     def get_metrics(self, reset: bool) -> Dict[str, float]:
         if self._mode == 'retrieval':
-            return self.qa_model.get_metrics(reset=reset)
+            metrics = self.qa_model.get_metrics(reset=reset)
+            if self._prefetcher is not None:
+                metrics.update(self._prefetcher.get_metrics(reset=reset))
+            if self._prune_topk is not None:
+                metrics[f'prune_recall@{self._prune_topk}'] = float(self._prune_hits) / max(float(self._prune_gold), 1)
+                if reset:
+                    self._prune_hits, self._prune_gold = 0, 0
+            return metrics
         elif self._mode == 'binary_classification':
             return self.retriever_model.get_metrics(reset=reset)
         else:
@@ -296,13 +527,21 @@ class ProgressiveDeepeningGumbelSoftmaxRetsrieverReasoner(GumbelSoftmaxRetriever
         requires_grad: bool = True,
         transformer_weights_model: str = None,
         num_labels: int = 2,
-        predictions_file = None,
+        predictions_file = 'predictions.jsonl',
         layer_freeze_regexes: List[str] = None,
         regularizer: Optional[RegularizerApplicator] = None,
         topk: int = 5,
         sentence_embedding_method: str = 'mean',
         dataset_reader = None,
         mode = 'retrieval',
+        tensor_rollout: bool = False,
+        score_cache_size: int = 0,
+        score_cache_memory_mb: float = None,
+        shared_prefix_encoding: bool = False,
+        prefetch_workers: int = 0,
+        prefetch_backend: str = 'thread',
+        prune_topk: int = None,
+        beam_size: int = 1,
     ) -> None:
         super().__init__(
             qa_model,
@@ -317,10 +556,22 @@ class ProgressiveDeepeningGumbelSoftmaxRetsrieverReasoner(GumbelSoftmaxRetriever
             topk,
             sentence_embedding_method,
             dataset_reader,
+            tensor_rollout,
+            shared_prefix_encoding,
+            prefetch_workers,
+            prefetch_backend,
+            prune_topk,
+            beam_size,
         )
         self._mode = mode
         self._state = True
 
+        # Cache of retriever scores for repeated query+retrieval rows. Only
+        # used while the retriever weights are fixed (eval or frozen).
+        self._score_cache = None
+        if score_cache_size > 0:
+            self._score_cache = RetrievalScoreCache(score_cache_size, score_cache_memory_mb)
+
     def forward_retreival(self, 
         label: torch.LongTensor = None,
         metadata: List[Dict[str, Any]] = None,
@@ -337,41 +588,57 @@ class ProgressiveDeepeningGumbelSoftmaxRetsrieverReasoner(GumbelSoftmaxRetriever
         # # Helper code
         qlens = [m['QLen'] for m in metadata]
 
+        rollout = self.get_rollout_inputs(kwargs)
+
         # Storage tensors
         policies, actions, unscaled_retrieval_losses = [],[],[]
         
         # Retrieval rollout phase
-        for t in range(self.num_rollout_steps):
-            policy = self.get_retrieval_distr(qr, metadata)            
-            action = self.gs(policy, tau=1) if self.training else one_hot(policy, policy.argmax(-1))
-            loss = self.retriever_loss(policy, action.argmax(-1))
-
-            policies.append(policy)
-            actions.append(action)
-            unscaled_retrieval_losses.append(loss)
-
-            q = qr.gather(1, action.argmax(-1).view(-1, 1, 1).repeat(1, 1, qr.size(-1))).squeeze(1)
-            if t == self.num_rollout_steps:
-                metadata = self.prep_next_batch(qr, metadata, actions, t, False)
-            else:
-                qr, metadata = self.prep_next_batch(qr, metadata, actions, t, True)
-
-            if True:
-                a = action.argmax(-1)
-                p = policy.argmax(-1)
-                p_ = policy.softmax(-1)
-                argmax_ps = p_.gather(1, p.unsqueeze(1)).squeeze()
-                action_ps = p_.gather(1, a.unsqueeze(1)).squeeze()
+        if not self.training and self._beam_size > 1:
+            policies, actions, q = self.beam_search(qr, metadata, rollout)
+            unscaled_retrieval_losses = [self.retriever_loss(p, a.argmax(-1)) for p, a in zip(policies, actions)]
+        else:
+            for t in range(self.num_rollout_steps):
+                with self.stage('retrieval_scoring'):
+                    policy = self.get_retrieval_distr(qr, metadata)
+                action = self.gs(policy, tau=1) if self.training else one_hot(policy, policy.argmax(-1))
+                policies.append(policy)
+                actions.append(action)
+
+                # Start building the next step's query+retrievals, then issue the rest of this step
+                with self.stage('retokenize'):
+                    next_batch = self.prefetch_next_batch(
+                        qr, metadata, actions, t, t != self.num_rollout_steps, rollout
+                    )
+
+                loss = self.retriever_loss(policy, action.argmax(-1))
+                unscaled_retrieval_losses.append(loss)
+
+                q = qr.gather(1, action.argmax(-1).view(-1, 1, 1).repeat(1, 1, qr.size(-1))).squeeze(1)
+
+                if True:
+                    a = action.argmax(-1)
+                    p = policy.argmax(-1)
+                    p_ = policy.softmax(-1)
+                    argmax_ps = p_.gather(1, p.unsqueeze(1)).squeeze()
+                    action_ps = p_.gather(1, a.unsqueeze(1)).squeeze()
+
+                with self.stage('retokenize'):
+                    if t == self.num_rollout_steps:
+                        metadata = next_batch.result()
+                    else:
+                        qr, metadata = next_batch.result()
             
         # Query answering phase
         self.update_meta(q, metadata, actions)
-        output = self.answer(q, label, metadata)
+        with self.stage('qa_forward'):
+            output = self.answer(q, label, metadata)
 
         # Scale retrieval losses by qa output
         qa_loss = output['loss'].detach()
         qa_scale = torch.gather(output['label_probs'].detach(), dim=1, index=label.unsqueeze(1))
         unscaled_retrieval_losses_ = torch.cat([u.unsqueeze(1) for u in unscaled_retrieval_losses], dim=1)
-        retrieval_losses = (qa_scale - self.b) * unscaled_retrieval_losses_ / unscaled_retrieval_losses_.size(1)      # NOTE: originals
+        retrieval_losses = (qa_scale - self.b()) * unscaled_retrieval_losses_ / unscaled_retrieval_losses_.size(1)      # NOTE: originals
         total_loss = retrieval_losses
         output['loss'] = total_loss.mean()
 
@@ -380,8 +647,7 @@ class ProgressiveDeepeningGumbelSoftmaxRetsrieverReasoner(GumbelSoftmaxRetriever
         output['sampled_actions'] = torch.cat([a.unsqueeze(0) for a in actions]).argmax(dim=-1)
 
         correct = (output["label_probs"].argmax(-1) == label)
-        self.log_results(qlens, correct)
-        print(f'\n\n{qa_loss.mean().item():.3f}\t{retrieval_losses.mean().item():.3f}\t{(correct).float().mean().item()}')
+        self.log_results(qlens, correct, qa_loss, retrieval_losses)
 
         self.add_correct_to_buffer(correct, metadata) #[mem for mem in self._replay_memory.memory if mem['QLen'] == 2][0]
 
@@ -394,13 +660,15 @@ class ProgressiveDeepeningGumbelSoftmaxRetsrieverReasoner(GumbelSoftmaxRetriever
         **kwargs,
     ) -> torch.Tensor:
         self._d = label.device
-        query, constructed_labels = self.prep_batch(metadata)
+        with self.stage('retokenize'):
+            query, constructed_labels = self.prep_batch(metadata)
         batch = {
             'phrase': {'tokens': {'token_ids': query, 'type_ids': torch.zeros_like(query)}}, 
             'label': constructed_labels, 
             'metadata': metadata
         }
-        output = self.retriever_model(**batch)
+        with self.stage('qa_forward'):
+            output = self.retriever_model(**batch)
         return output
 
     def __call__(self, *args, **kwargs):
@@ -422,7 +690,7 @@ class ProgressiveDeepeningGumbelSoftmaxRetsrieverReasoner(GumbelSoftmaxRetriever
     def add_correct_to_buffer(self, outcomes, metadata):
         ''' Add the correctly answered questions to the replay buffer
         '''
-        for outcome, meta in zip(outcomes, metadata):
+        for outcome, meta in zip(outcomes.tolist(), metadata):
             if outcome and meta['QLen'] == self.num_rollout_steps:
                 self._replay_memory.push(meta)
 
@@ -458,7 +726,7 @@ class ProgressiveDeepeningGumbelSoftmaxRetsrieverReasoner(GumbelSoftmaxRetriever
 
             self._state = not self._state
 
-        batch = self.dataset_reader.transformer_indices_from_qa(sentences, self.qa_vocab)
+        batch = self.dataset_reader.batch_indices_from_qa(sentences, self.qa_vocab, retrieval=False)
         query = batch['phrase']['tokens']['token_ids'].to(self._d)
         labels_ = torch.tensor(labels).to(self._d)
 
@@ -466,9 +734,40 @@ class ProgressiveDeepeningGumbelSoftmaxRetsrieverReasoner(GumbelSoftmaxRetriever
 
     def get_context_embs(self, c):
         # return self.retriever_model(c)
-        c_ = {'tokens': {'token_ids': c, 'type_ids': torch.zeros_like(c)}}
-        output = self.retriever_model(c_)
-        return output['label_logits'].view(c.size(0), c.size(1), -1)
+        rows = c.view(-1, c.size(-1))
+        if self._score_cache is not None and self._score_cache_active():
+            scores = cached_row_outputs(self._score_cache, rows, self.retriever_pad_idx, self._score_rows)
+        elif self._shared_prefix_encoding:
+            return self.retriever_model.forward_shared_prefix(c)
+        else:
+            scores = self._score_rows(rows)
+        return scores.view(c.size(0), c.size(1), -1)
+
+    def _score_rows(self, rows):
+        rows_ = {'tokens': {'token_ids': rows, 'type_ids': torch.zeros_like(rows)}}
+        return self.retriever_model(rows_)['label_logits']
+
+    def _retriever_trainable(self):
+        return any(p.requires_grad for p in self.retriever_model.parameters())
+
+    def _score_cache_active(self):
+        return not self.training or not self._retriever_trainable()
+
+    def train(self, mode: bool = True):
+        ''' Cached retrieval scores are stale once the retriever is updated.
+        '''
+        score_cache = getattr(self, '_score_cache', None)
+        if mode and score_cache is not None and self._retriever_trainable():
+            score_cache.empty()
+        return super().train(mode)
+
+    def get_metrics(self, reset: bool) -> Dict[str, float]:
+        metrics = super().get_metrics(reset)
+        if self._score_cache is not None:
+            metrics['score_cache_hit_rate'] = self._score_cache.hit_rate()
+            if reset:
+                self._score_cache.reset_stats()
+        return metrics
 
     def define_modules(self):
         self.retriever_model = TransformerBinaryQA(vocab=self.vocab, pretrained_model=self.variant, num_labels=1)
@@ -489,7 +788,7 @@ class ProgressiveDeepeningGumbelSoftmaxRetsrieverReasoner(GumbelSoftmaxRetriever
         ''' Compute the probability of retrieving each item given
             the current query+retrieval (i.e. p(zj | zi, y))
         '''
-        e_q = self.get_context_embs(qr).squeeze(-1)
+        e_q = self.score_candidates(qr, meta, lambda rows: self.get_context_embs(rows).squeeze(-1))
         # e_q = e_q[...,0]
         # e_q = self.W(e_q).squeeze(-1)
         # e_q = e_q.max(-1).values
@@ -40,7 +40,7 @@ class PolicyGradientsAgent(RLFramework):
         requires_grad: bool = True,
         transformer_weights_model: str = None,
         num_labels: int = 2,
-        predictions_file=None,
+        predictions_file='predictions.jsonl',
         layer_freeze_regexes: List[str] = None,
         regularizer: Optional[RegularizerApplicator] = None,
         topk: int = 5,
@@ -228,7 +228,7 @@ class PolicyGradientsAgent(RLFramework):
             ]).strip()
             meta['context_str'] = f"q: {question} c: {context_str}"
             sentences.append((question, context_str))
-        batch = self.pn.dataset_reader.transformer_indices_from_qa(sentences, self.pn.qa_vocab)
+        batch = self.pn.dataset_reader.batch_indices_from_qa(sentences, self.pn.qa_vocab)
         query_retrieval_ = batch['phrase']['tokens']['token_ids'].to(device)
 
         return query_retrieval_, context_, metadata
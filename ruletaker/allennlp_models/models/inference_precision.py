@@ -0,0 +1,89 @@
+import logging
+import time
+from contextlib import nullcontext
+
+import torch
+
+from .metrics_sink import metrics_sink_disabled
+from .prediction_sink import predictions_disabled
+
+logger = logging.getLogger(__name__)
+
+PRECISIONS = ['fp32', 'bf16', 'fp16', 'auto']
+
+
+def autocast_dtype(precision, device):
+    ''' Autocast dtype of `precision` on device, None for full fp32.
+        'auto' is bf16 on CPU and fp16 on GPUs without bf16 support. Before
+        torch 1.10 (no torch.autocast) 'auto' is fp32 on CPU and fp16 on GPU.
+    '''
+    if precision == 'fp32':
+        return None
+    if precision == 'bf16':
+        return torch.bfloat16
+    if precision == 'fp16':
+        return torch.float16
+    if not hasattr(torch, 'autocast'):
+        return torch.float16 if device.type == 'cuda' else None
+    if device.type == 'cuda' and not torch.cuda.is_bf16_supported():
+        return torch.float16
+    return torch.bfloat16
+
+
+def autocast(precision, device):
+    dtype = autocast_dtype(precision, device)
+    if dtype is None:
+        return nullcontext()
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device_type=device.type, dtype=dtype)
+    # Older torch only autocasts to fp16 on GPU
+    if device.type == 'cuda' and dtype == torch.float16:
+        return torch.cuda.amp.autocast()
+    raise ValueError(
+        f"inference_precision = {precision} on {device.type} requires torch.autocast (torch >= 1.10).\nInvestigate!"
+    )
+
+
+def quantize_linear(module):
+    ''' Copy of module with its Linear layers dynamically quantized to int8
+        (CPU only, inference only).
+    '''
+    return torch.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def inference_models(model):
+    ''' The submodules of model (itself included) with an inference precision.
+    '''
+    return [m for m in model.modules() if hasattr(m, 'set_inference_mode')]
+
+
+def validation_precision_delta(model, data_loader, cuda_device=-1, metric='EM'):
+    ''' Validation `metric` of the configured inference precision/quantization
+        against full fp32, along with the time of each pass. The passes write
+        no predictions or logged metrics, so the prediction files of the
+        validation epochs keep their numbering.
+    '''
+    from allennlp.training import util as training_util
+
+    models = inference_models(model)
+    configured = [(m._inference_precision, m._quantize_inference) for m in models]
+    if all(precision == 'fp32' and not quantize for precision, quantize in configured):
+        return {}
+
+    results = {}
+    with predictions_disabled(model), metrics_sink_disabled():
+        for name, modes in [('fp32', [('fp32', False)] * len(models)), ('inference', configured)]:
+            for m, (precision, quantize) in zip(models, modes):
+                m.set_inference_mode(precision, quantize)
+            start = time.perf_counter()
+            metrics = training_util.evaluate(model, data_loader, cuda_device=cuda_device)
+            results[f'{name}_{metric}'] = metrics[metric]
+            results[f'{name}_seconds'] = time.perf_counter() - start
+
+    results[f'inference_{metric}_delta'] = results[f'inference_{metric}'] - results[f'fp32_{metric}']
+    logger.info(
+        f"Validation {metric} fp32: {results[f'fp32_{metric}']:.4f} ({results['fp32_seconds']:.1f}s), "
+        f"configured inference mode: {results[f'inference_{metric}']:.4f} ({results['inference_seconds']:.1f}s), "
+        f"delta: {results[f'inference_{metric}_delta']:+.4f}"
+    )
+    return results
@@ -0,0 +1,181 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+
+from .qa_metrics import BucketedQAMetrics
+
+logger = logging.getLogger(__name__)
+
+
+class JsonlBackend:
+    ''' Appends each flushed set of metrics as a line of a JSONL file.
+    '''
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, 'a')
+
+    def write(self, metrics, step):
+        self._file.write(json.dumps({'step': step, 'time': time.time(), **metrics}) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class WandbBackend:
+    def write(self, metrics, step):
+        import wandb
+        wandb.log(metrics)
+
+    def close(self):
+        pass
+
+
+class MetricsSink:
+    ''' Running means of logged scalars and per-bucket accuracy/recall
+        counts, kept on device and written to the backends every flush_every
+        committed steps. Nothing is read back from the device until a flush,
+        which (with background=True) is done by a separate thread.
+
+        Bucket metrics are cumulative under their usual names (<prefix>acc,
+        <prefix>acc_<bucket>, ...) until reset(prefix), and over the steps
+        since the last flush with a _noncuml suffix (<prefix>acc_noncuml, ...).
+    '''
+    def __init__(self, backends=None, flush_every: int = 100, background: bool = False):
+        self._backends = backends or []
+        self._flush_every = flush_every
+        self._sums = {}
+        self._counts = {}
+        self._buckets = {}
+        self._cumulative = {}
+        self._step = 0
+        self._queue = None
+        self._thread = None
+        if background:
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._worker, daemon=True)
+            self._thread.start()
+
+    @property
+    def enabled(self):
+        return len(self._backends) > 0
+
+    def log(self, metrics, commit: bool = True):
+        ''' Add scalars (tensors are detached, not read). A commit ends a step.
+        '''
+        if not self.enabled:
+            return
+        for name, value in metrics.items():
+            if torch.is_tensor(value):
+                value = value.detach().float().mean()
+            self._sums[name] = self._sums.get(name, 0.) + value
+            self._counts[name] = self._counts.get(name, 0) + 1
+        if commit:
+            self._step += 1
+            if self._step % self._flush_every == 0:
+                self.flush()
+
+    def log_buckets(self, prefix, buckets, correct, labels=None, retrieved=None, proof_mask=None, bucket_name=''):
+        ''' Accumulate accuracy (and retrieval recall) by bucket, see BucketedQAMetrics.
+        '''
+        if not self.enabled:
+            return
+        key = (prefix, bucket_name)
+        for metrics in (self._buckets, self._cumulative):
+            if key not in metrics:
+                metrics[key] = BucketedQAMetrics()
+            metrics[key](buckets, correct, labels, retrieved, proof_mask)
+
+    def reset(self, prefix):
+        ''' Start the cumulative bucket metrics of the prefixes starting with
+            prefix over (e.g. at the end of a validation pass).
+        '''
+        for key in [key for key in self._cumulative if key[0].startswith(prefix)]:
+            del self._cumulative[key]
+
+    def flush(self):
+        if not self._sums and not self._buckets:
+            return
+        sums, counts, buckets = self._sums, self._counts, self._buckets
+        self._sums, self._counts, self._buckets = {}, {}, {}
+        # Later steps must not change what this flush writes
+        cumulative = {key: self._cumulative[key].copy() for key in buckets}
+        if self._queue is not None:
+            self._queue.put((sums, counts, buckets, cumulative, self._step))
+        else:
+            self._write(sums, counts, buckets, cumulative, self._step)
+
+    def _write(self, sums, counts, buckets, cumulative, step):
+        metrics = {name: float(value) / counts[name] for name, value in sums.items()}
+        for (prefix, bucket_name), bucket_metrics in buckets.items():
+            metrics.update(cumulative[prefix, bucket_name].get_metric(prefix=prefix, bucket_name=bucket_name))
+            metrics.update(bucket_metrics.get_metric(prefix=prefix, bucket_name=bucket_name, suffix='_noncuml'))
+        for backend in self._backends:
+            try:
+                backend.write(metrics, step)
+            except Exception:
+                logger.exception(f"Failed to write metrics to {type(backend).__name__}")
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            self._write(*item)
+            self._queue.task_done()
+
+    def close(self):
+        self.flush()
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            self._queue = None
+        for backend in self._backends:
+            backend.close()
+        self._backends = []
+
+
+_SINK = None
+
+
+def configure_metrics_sink(log_file: str = None, flush_every: int = 100, background: bool = False, wandb: bool = True):
+    ''' Set the sink used by the models: wandb (if WANDB_LOG is true and
+        wandb, i.e. on the master in distributed training) and/or a local
+        JSONL file.
+    '''
+    global _SINK
+    if _SINK is not None:
+        _SINK.close()
+    backends = []
+    if wandb and os.environ.get('WANDB_LOG') == 'true':
+        backends.append(WandbBackend())
+    if log_file is not None:
+        backends.append(JsonlBackend(log_file))
+    _SINK = MetricsSink(backends, flush_every=flush_every, background=background)
+    return _SINK
+
+
+def get_metrics_sink():
+    if _SINK is None:
+        return configure_metrics_sink()
+    return _SINK
+
+
+@contextmanager
+def metrics_sink_disabled():
+    ''' Swap in a sink without backends, so nothing is logged until exit.
+    '''
+    global _SINK
+    sink = _SINK
+    _SINK = MetricsSink()
+    try:
+        yield
+    finally:
+        _SINK = sink
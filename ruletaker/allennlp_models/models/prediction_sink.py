@@ -0,0 +1,139 @@
+import json
+import logging
+import os
+from contextlib import contextmanager
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class PredictionSink:
+    ''' Streams the predictions of evaluation forward passes to JSONL files,
+        one file per epoch (<path root>_epoch_<n><ext>, with the trainer's
+        epoch, see set_epoch). Nothing is kept in memory beyond flush_every
+        rows and nothing is written while training. Disabled when path is
+        None. A relative path is only written once set_directory has given
+        it a directory (the serialization dir).
+
+        The logits/probs/predictions of a batch are moved to the host in one
+        transfer.
+    '''
+    def __init__(self, path: str = None, flush_every: int = 1000):
+        self._path = path
+        self._flush_every = flush_every
+        self._buffer = []
+        self._file = None
+        self._epoch = None
+
+    @property
+    def enabled(self):
+        return self._path is not None and os.path.isabs(self._path)
+
+    def set_directory(self, directory):
+        ''' Resolve a relative path against directory (the serialization dir).
+        '''
+        if self._path is not None and not os.path.isabs(self._path):
+            self._path = os.path.join(directory, self._path)
+
+    def set_epoch(self, epoch):
+        ''' Name the files of the following evaluation passes after epoch.
+        '''
+        self._epoch = epoch
+
+    def current_path(self):
+        root, ext = os.path.splitext(self._path)
+        if self._epoch is None:
+            return f'{root}{ext or ".jsonl"}'
+        return f'{root}_epoch_{self._epoch}{ext or ".jsonl"}'
+
+    def write(self, metadata, label_logits, label_probs, answer_index, fields_fn):
+        ''' Add the predictions of a batch. fields_fn(example, prediction)
+            gives the other fields of an example's row.
+        '''
+        if not self.enabled:
+            return
+        num_logits = label_logits.size(1)
+        batch = torch.cat(
+            [label_logits.detach().float(), label_probs.detach().float(), answer_index.detach().float().unsqueeze(1)], dim=1
+        ).cpu().tolist()
+        for example, row in zip(metadata, batch):
+            prediction = int(row[-1])
+            self._buffer.append({
+                'logits': row[:num_logits],
+                'label_probs': row[num_logits:-1],
+                'prediction': prediction,
+                **fields_fn(example, prediction),
+            })
+        if len(self._buffer) >= self._flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        if self._file is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.current_path())), exist_ok=True)
+            self._file = open(self.current_path(), 'w')
+        for row in self._buffer:
+            self._file.write(json.dumps(row) + '\n')
+        self._file.flush()
+        self._buffer = []
+
+    def close(self):
+        ''' End of an evaluation pass. Returns the file written, if any.
+        '''
+        if not self.enabled:
+            return None
+        self.flush()
+        path = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            path = self.current_path()
+            logger.info(f"Predictions written to {path}")
+        return path
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_file'] = None
+        state['_buffer'] = []
+        return state
+
+
+def _prediction_sinks(model):
+    sinks = {}
+    for module in model.modules():
+        sink = getattr(module, '_prediction_sink', None)
+        if isinstance(sink, PredictionSink):
+            sinks[id(sink)] = sink
+    return list(sinks.values())
+
+
+def set_prediction_directory(model, directory):
+    ''' Resolve the relative prediction files of model (and its submodules).
+    '''
+    for sink in _prediction_sinks(model):
+        sink.set_directory(directory)
+
+
+def set_prediction_epoch(model, epoch):
+    ''' Name the prediction files of model (and its submodules) after epoch.
+    '''
+    for sink in _prediction_sinks(model):
+        sink.set_epoch(epoch)
+
+
+@contextmanager
+def predictions_disabled(model):
+    ''' Disable the prediction sinks of model (and its submodules), e.g. for
+        extra evaluation passes which should not get a predictions file.
+    '''
+    paths = {}
+    for sink in _prediction_sinks(model):
+        paths[sink] = sink._path
+        sink._path = None
+    try:
+        yield
+    finally:
+        for sink, path in paths.items():
+            sink._path = path
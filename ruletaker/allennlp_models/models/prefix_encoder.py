@@ -0,0 +1,114 @@
+import math
+
+import torch
+
+
+def split_shared_prefix(rows, pad_idx):
+    ''' Split [bsz, n, seq_len] candidate rows into the prefix shared by all
+        (non-padding) candidates of an example and each candidate's suffix.
+        At least one token is always left in every suffix.
+
+        Returns (prefix [bsz, P], prefix_mask, prefix_len [bsz],
+                 suffix [bsz, n, S], suffix_mask).
+    '''
+    bsz, n, seq_len = rows.shape
+    token_mask = rows != pad_idx
+    row_mask = token_mask.any(-1)
+    lengths = token_mask.long().sum(-1)
+
+    # Longest common prefix against the first valid candidate of each example
+    ref_idx = row_mask.long().argmax(-1)
+    ref = rows.gather(1, ref_idx.view(-1, 1, 1).expand(-1, 1, seq_len)).squeeze(1)
+    same = (rows == ref.unsqueeze(1)) | ~row_mask.unsqueeze(-1)
+    common = same.all(1) & (ref != pad_idx)
+    prefix_len = common.long().cumprod(-1).sum(-1)
+    min_len = lengths.masked_fill(~row_mask, seq_len).min(-1).values
+    prefix_len = torch.min(prefix_len, min_len - 1).clamp(min=1)
+
+    P = int(prefix_len.max())
+    positions = torch.arange(seq_len, device=rows.device)
+    prefix = ref[:, :P]
+    prefix_mask = positions[:P].unsqueeze(0) < prefix_len.unsqueeze(1)
+
+    S = int((lengths - prefix_len.unsqueeze(1)).max())
+    suffix_pos = prefix_len.view(-1, 1, 1) + positions[:S].view(1, 1, -1)
+    suffix = rows.gather(2, suffix_pos.clamp(max=seq_len - 1).expand(-1, n, -1))
+    suffix_mask = suffix_pos < lengths.unsqueeze(-1)
+    suffix = suffix.masked_fill(~suffix_mask, pad_idx)
+
+    return prefix.masked_fill(~prefix_mask, pad_idx), prefix_mask, prefix_len, suffix, suffix_mask
+
+
+def _split_heads(x, attn):
+    return x.view(*x.shape[:-1], attn.num_attention_heads, attn.attention_head_size).transpose(1, 2)
+
+
+def _attend(layer, hidden, keys, values, key_mask):
+    ''' One BERT layer for queries `hidden` over (already projected) keys and
+        values. Mirrors BertLayer.forward, reusing its submodules.
+    '''
+    attn = layer.attention.self
+    queries = _split_heads(attn.query(hidden), attn)
+    scores = queries @ keys.transpose(-1, -2) / math.sqrt(attn.attention_head_size)
+    scores = scores + (1.0 - key_mask[:, None, None, :].to(scores.dtype)) * -10000.0
+    probs = attn.dropout(scores.softmax(-1))
+    context = (probs @ values).transpose(1, 2).contiguous()
+    context = context.view(*context.shape[:-2], attn.all_head_size)
+
+    attention_output = layer.attention.output(context, hidden)
+    return layer.output(layer.intermediate(attention_output), attention_output)
+
+
+def _keys_values(layer, hidden):
+    attn = layer.attention.self
+    return _split_heads(attn.key(hidden), attn), _split_heads(attn.value(hidden), attn)
+
+
+def encode_with_shared_prefix(transformer, rows, pad_idx):
+    ''' Encode [bsz, n, seq_len] candidate rows with a BERT/RoBERTa encoder,
+        running the prefix shared by an example's candidates only once.
+
+        The prefix is encoded on its own and its per-layer keys/values are
+        cached. Each candidate then only runs its first token (<s>/[CLS]) and
+        its suffix through the encoder, attending to [itself; cached prefix].
+        This is an approximation of full encoding: prefix tokens do not see
+        the candidate, although the first token (used for classification) does.
+
+        Returns the final hidden states of [first token; suffix] per candidate,
+        shape [bsz, n, 1 + S, hidden], and the matching mask.
+    '''
+    bsz, n, _ = rows.shape
+    prefix, prefix_mask, prefix_len, suffix, suffix_mask = split_shared_prefix(rows, pad_idx)
+    embeddings, layers = transformer.embeddings, transformer.encoder.layer
+
+    # RoBERTa positions start after its padding index
+    position_offset = getattr(embeddings, 'padding_idx', -1) + 1
+    positions = torch.arange(prefix.size(1), device=rows.device)
+
+    # Shared prefix pass, caching the keys/values each layer sees
+    hidden = embeddings(input_ids=prefix, position_ids=positions.unsqueeze(0).expand_as(prefix) + position_offset)
+    cache = []
+    for layer in layers:
+        keys, values = _keys_values(layer, hidden)
+        cache.append((keys, values))
+        hidden = _attend(layer, hidden, keys, values, prefix_mask)
+
+    # Per-candidate pass over [first token; suffix]. The first prefix token is
+    # replaced by each candidate's own copy, so it is dropped from the cache.
+    S = suffix.size(-1)
+    input_ids = torch.cat([prefix[:, None, :1].expand(-1, n, -1), suffix], -1).view(bsz * n, 1 + S)
+    position_ids = torch.cat([
+        torch.zeros_like(prefix_len).view(-1, 1, 1).expand(-1, n, 1),
+        prefix_len.view(-1, 1, 1) + torch.arange(S, device=rows.device).view(1, 1, -1).expand(bsz, n, -1),
+    ], -1).view(bsz * n, 1 + S) + position_offset
+    query_mask = torch.cat([suffix_mask.new_ones(bsz, n, 1), suffix_mask], -1).view(bsz * n, 1 + S)
+    key_mask = torch.cat([query_mask, prefix_mask[:, 1:].repeat_interleave(n, 0)], -1)
+
+    hidden = embeddings(input_ids=input_ids, position_ids=position_ids)
+    for layer, (prefix_keys, prefix_values) in zip(layers, cache):
+        keys, values = _keys_values(layer, hidden)
+        keys = torch.cat([keys, prefix_keys[:, :, 1:].repeat_interleave(n, 0)], 2)
+        values = torch.cat([values, prefix_values[:, :, 1:].repeat_interleave(n, 0)], 2)
+        hidden = _attend(layer, hidden, keys, values, key_mask)
+
+    return hidden.view(bsz, n, 1 + S, -1), query_mask.view(bsz, n, 1 + S)
@@ -0,0 +1,119 @@
+import numpy as np
+import torch
+
+# Columns of the running counters
+_COUNT, _CORRECT, _RECALL_SUM, _RECALL_COUNT = range(4)
+
+
+def proof_mask_from_metadata(metadata, device=None):
+    ''' [bsz, max # sentences] bool mask of each example's proof sentences
+        (node_label without the final NAF node). The reader's collated
+        `proof_mask` field is the same tensor.
+    '''
+    labels = [m['node_label'] for m in metadata]
+    n = max([len(l) - 1 for l in labels if l is not None] + [0])
+    mask = np.zeros((len(labels), n), dtype=np.bool_)
+    for i, l in enumerate(labels):
+        if l is not None and len(l) > 1:
+            mask[i, :len(l) - 1] = l[:-1]
+    return torch.from_numpy(mask).to(device)
+
+
+def retrieved_from_metadata(metadata, device=None):
+    ''' [bsz, max k] retrieved sentence indices (metadata 'topk'), -1 padded.
+    '''
+    topks = [m.get('topk') or [] for m in metadata]
+    retrieved = np.full((len(topks), max([len(t) for t in topks] + [1])), -1, dtype=np.int64)
+    for i, t in enumerate(topks):
+        retrieved[i, :len(t)] = t
+    return torch.from_numpy(retrieved).to(device)
+
+
+def retrieval_recall(retrieved, proof_mask):
+    ''' Per example fraction of the proof sentences among the [bsz, k]
+        retrieved indices (-1 = none), and whether it is defined (the example
+        has a proof).
+    '''
+    n = proof_mask.size(1)
+    hit = torch.zeros(proof_mask.size(0), n + 1, dtype=torch.bool, device=proof_mask.device)
+    hit.scatter_(1, retrieved.masked_fill((retrieved < 0) | (retrieved >= n), n), True)     # None -> extra column
+    hits = (hit[:, :n] & proof_mask).sum(-1)
+    num_proof = proof_mask.sum(-1)
+    return hits.float() / num_proof.clamp(min=1).float(), num_proof > 0
+
+
+class BucketedQAMetrics:
+    ''' Running accuracy and retrieval recall, overall and per bucket (e.g.
+        QLen or QDep), in counters on the device of the inputs. The counters
+        are only read (one host sync) by get_metric.
+
+        Recall is averaged over the examples with a true label and a proof,
+        buckets beyond max_bucket are counted in max_bucket.
+    '''
+    def __init__(self, max_bucket: int = 16):
+        self._max_bucket = max_bucket
+        self._counts = None
+        self._bucketed = False
+
+    def __call__(self, buckets, correct, labels=None, retrieved=None, proof_mask=None):
+        ''' buckets: [bsz] ints (or None), correct: [bsz] bool,
+            labels: [bsz], retrieved: [bsz, k], proof_mask: [bsz, n].
+        '''
+        device = correct.device
+        if self._counts is None or self._counts.device != device:
+            self._counts = torch.zeros(self._max_bucket + 1, 4, device=device)
+        if buckets is None:
+            buckets = torch.zeros_like(correct, dtype=torch.long)
+        else:
+            self._bucketed = True
+        buckets = torch.as_tensor(buckets, device=device).long().clamp(0, self._max_bucket)
+
+        update = torch.zeros(correct.size(0), 4, device=device)
+        update[:, _COUNT] = 1
+        update[:, _CORRECT] = correct.float()
+        if retrieved is not None and proof_mask is not None:
+            recall, defined = retrieval_recall(retrieved.to(device), proof_mask.to(device))
+            if labels is not None:
+                defined = defined & labels.bool()
+            update[:, _RECALL_SUM] = recall * defined
+            update[:, _RECALL_COUNT] = defined.float()
+        self._counts.index_add_(0, buckets, update)
+
+    def get_metric(self, reset: bool = False, prefix: str = '', bucket_name: str = '', suffix: str = ''):
+        ''' {prefix_acc, prefix_ret_recall, prefix_acc_<bucket>, prefix_ret_recall_<bucket>},
+            with suffix after acc / ret_recall.
+        '''
+        if self._counts is None:
+            return {}
+        # A copy, as .cpu() of a CPU tensor is the tensor itself
+        counts = self._counts.to('cpu', copy=True)
+        if reset:
+            self._counts.zero_()
+
+        def ratio(num, den):
+            return float(num / den) if den > 0 else None
+
+        total = counts.sum(0)
+        metrics = {
+            f'{prefix}acc{suffix}': ratio(total[_CORRECT], total[_COUNT]),
+            f'{prefix}ret_recall{suffix}': ratio(total[_RECALL_SUM], total[_RECALL_COUNT]),
+        }
+        for bucket, row in enumerate(counts.tolist() if self._bucketed else []):
+            if row[_COUNT] > 0:
+                metrics[f'{prefix}acc{suffix}_{bucket_name}{bucket}'] = row[_CORRECT] / row[_COUNT]
+            if row[_RECALL_COUNT] > 0:
+                metrics[f'{prefix}ret_recall{suffix}_{bucket_name}{bucket}'] = row[_RECALL_SUM] / row[_RECALL_COUNT]
+        return {k: v for k, v in metrics.items() if v is not None}
+
+    def reset(self):
+        if self._counts is not None:
+            self._counts.zero_()
+
+    def copy(self):
+        ''' A copy of the counters as they are now (a device copy, no sync).
+        '''
+        metrics = BucketedQAMetrics(self._max_bucket)
+        metrics._bucketed = self._bucketed
+        if self._counts is not None:
+            metrics._counts = self._counts.clone()
+        return metrics
@@ -1,7 +1,11 @@
+import glob
+import math
+import os
 import random
-from collections import namedtuple, deque
+from collections import namedtuple
 
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
@@ -11,26 +15,208 @@ Transition = namedtuple('Transition',
                         ('state', 'action', 'next_state', 'reward'))
 
 
+class SumTree:
+    ''' Binary tree over `capacity` non-negative priorities in which each
+        node holds the sum of its children. Updates and prefix-sum lookups
+        are O(log capacity).
+    '''
+    def __init__(self, capacity: int):
+        self._size = 1
+        while self._size < capacity:
+            self._size *= 2
+        self._tree = torch.zeros(2 * self._size, dtype=torch.float64)
+
+    def total(self):
+        return float(self._tree[1])
+
+    def update(self, idx: int, priority: float):
+        node = idx + self._size
+        delta = priority - float(self._tree[node])
+        while node >= 1:
+            self._tree[node] += delta
+            node //= 2
+
+    def find(self, mass: float):
+        ''' Index of the leaf in which the cumulative priority reaches mass.
+        '''
+        node = 1
+        while node < self._size:
+            left = 2 * node
+            if mass < self._tree[left]:
+                node = left
+            else:
+                mass -= float(self._tree[left])
+                node = left + 1
+        return node - self._size
+
+    def clear(self):
+        self._tree.zero_()
+
+
+def all_gather_rows(tensors):
+    ''' Concatenate (in rank order) every worker's [n, ...] tensors, where n
+        may differ across workers but is the same for each worker's tensors.
+    '''
+    # nccl only gathers GPU tensors
+    device = torch.device('cuda', torch.cuda.current_device()) if dist.get_backend() == 'nccl' else torch.device('cpu')
+    world_size = dist.get_world_size()
+    size = torch.tensor([len(tensors[0])], device=device)
+    sizes = [torch.zeros_like(size) for _ in range(world_size)]
+    dist.all_gather(sizes, size)
+    sizes = [int(s) for s in sizes]
+
+    gathered_tensors = []
+    for tensor in tensors:
+        padded = tensor.new_zeros((max(sizes), *tensor.shape[1:]), device=device)
+        padded[:len(tensor)] = tensor
+        gathered = [torch.zeros_like(padded) for _ in range(world_size)]
+        dist.all_gather(gathered, padded)
+        gathered_tensors.append(torch.cat([g[:n] for g, n in zip(gathered, sizes)]).cpu())
+    return gathered_tensors
+
+
 class ReplayMemory:
-    def __init__(self, capacity=1e5):
-        self._capacity = capacity
+    ''' Ring buffer of the trajectories of correctly answered questions: the
+        sampler index of the question, its retrieved sentence indices (topk,
+        -1 padded up to max_trajectory_len) and a priority, in preallocated
+        tensors. Sampling is proportional to priority (sum-tree). New entries
+        get the highest priority seen so far.
+
+        With spill_dir, the contents are written to disk each time the buffer
+        is full, before the oldest entries are overwritten (see spilled()).
+    '''
+    def __init__(self, capacity=1e5, max_trajectory_len: int = 16, spill_dir: str = None):
+        self._capacity = int(capacity)
+        self._max_trajectory_len = max_trajectory_len
+        self._spill_dir = spill_dir
+        self._sampler_idx = torch.zeros(self._capacity, dtype=torch.long)
+        self._topk = torch.full((self._capacity, max_trajectory_len), -1, dtype=torch.int32)
+        self._priority = torch.zeros(self._capacity, dtype=torch.float32)
+        self._tree = SumTree(self._capacity)
+        self._num_spilled = 0
         self.empty()
 
-    def push(self, sample):
-        '''Save a transition'''
-        self.memory.append(sample)
+    def push(self, sample, priority: float = None):
+        '''Save a transition (a metadata dict with sampler_idx and topk)'''
+        topk = sample['topk']
+        if len(topk) > self._max_trajectory_len:
+            raise ValueError(
+                f"Trajectory of length {len(topk)} exceeds max_trajectory_len = {self._max_trajectory_len}.\nInvestigate!"
+            )
+        if self._size == self._capacity and self._pos == 0:
+            self._spill()
+
+        idx = self._pos
+        if priority is None:
+            priority = self._max_priority
+        self._sampler_idx[idx] = sample['sampler_idx']
+        self._topk[idx].fill_(-1)
+        self._topk[idx, :len(topk)] = torch.as_tensor(topk, dtype=torch.int32)
+        self._priority[idx] = priority
+        self._tree.update(idx, priority)
+        self._max_priority = max(self._max_priority, priority)
+
+        self._pos = (self._pos + 1) % self._capacity
+        self._size = min(self._size + 1, self._capacity)
 
     def sample(self, batch_size):
-        return random.sample(self.memory, batch_size)
+        ''' batch_size entries drawn (with replacement) in proportion to their
+            priorities, one from each of batch_size equal slices of the total.
+        '''
+        total = self._tree.total()
+        segment = total / batch_size
+        idxs = [
+            min(self._tree.find(segment * (i + random.random())), self._size - 1)
+            for i in range(batch_size)
+        ]
+        return [self._entry(i) for i in idxs]
+
+    def update_priorities(self, idxs, priorities):
+        for idx, priority in zip(idxs, priorities):
+            priority = float(priority)
+            self._priority[idx] = priority
+            self._tree.update(idx, priority)
+            self._max_priority = max(self._max_priority, priority)
 
     def __len__(self):
-        return len(self.memory)
-    
+        return self._size
+
     def empty(self):
-        self.memory = deque([], maxlen=int(self._capacity))
+        self._pos = 0
+        self._size = 0
+        self._max_priority = 1.0
+        self._tree.clear()
+
+    def all_gather(self, shard: bool = False):
+        ''' Replace the contents of this worker's buffer with those of all
+            workers (in rank order), or with shard=True only this worker's
+            share of them. Shards are padded by wrapping around, as in the
+            sampler, so every worker gets the same number of entries. A no-op
+            outside distributed training.
+        '''
+        if not (dist.is_available() and dist.is_initialized()):
+            return
+        order = self._order()
+        sampler_idx, topk, priority = all_gather_rows([self._sampler_idx[order], self._topk[order], self._priority[order]])
+        if shard and len(sampler_idx) > 0:
+            rank, world_size = dist.get_rank(), dist.get_world_size()
+            total = math.ceil(len(sampler_idx) / world_size) * world_size
+            keep = (torch.arange(total) % len(sampler_idx))[rank::world_size]
+            sampler_idx, topk, priority = sampler_idx[keep], topk[keep], priority[keep]
+
+        self.empty()
+        for idx, row, p in zip(sampler_idx.tolist(), topk, priority.tolist()):
+            self.push({'sampler_idx': idx, 'topk': row[row >= 0].tolist()}, priority=p)
+
+    def _order(self):
+        # Buffer slots from oldest to newest
+        if self._size < self._capacity:
+            return torch.arange(self._size)
+        return (torch.arange(self._capacity) + self._pos) % self._capacity
+
+    def sampler_idxs(self, repeats: int = 1):
+        ''' [len * repeats] sampler indices, oldest first, each repeated. '''
+        return self._sampler_idx[self._order()].repeat_interleave(repeats)
+
+    def trajectories(self, repeats: int = 1):
+        ''' topk lists, oldest first, each repeated. '''
+        rows = self._topk[self._order()].repeat_interleave(repeats, dim=0)
+        lengths = (rows >= 0).sum(-1).tolist()
+        return [row[:n] for row, n in zip(rows.tolist(), lengths)]
+
+    def _entry(self, idx):
+        topk = self._topk[idx]
+        return {
+            'index': idx,
+            'sampler_idx': int(self._sampler_idx[idx]),
+            'topk': topk[topk >= 0].tolist(),
+            'priority': float(self._priority[idx]),
+        }
 
     def peek(self, idx=0):
-        return self.memory[idx]
+        return self._entry(int(self._order()[idx]))
 
     def __iter__(self):
-        yield from self.memory
+        for idx in self._order().tolist():
+            yield self._entry(idx)
+
+    def _spill(self):
+        if self._spill_dir is None:
+            return
+        os.makedirs(self._spill_dir, exist_ok=True)
+        order = self._order()
+        torch.save({
+            'sampler_idx': self._sampler_idx[order].clone(),
+            'topk': self._topk[order].clone(),
+            'priority': self._priority[order].clone(),
+        }, os.path.join(self._spill_dir, f'replay_{self._num_spilled:05d}.pt'))
+        self._num_spilled += 1
+
+    def spilled(self):
+        ''' Entries written to spill_dir, oldest first. '''
+        if self._spill_dir is None:
+            return
+        for path in sorted(glob.glob(os.path.join(self._spill_dir, 'replay_*.pt'))):
+            chunk = torch.load(path)
+            for sampler_idx, topk, priority in zip(chunk['sampler_idx'], chunk['topk'], chunk['priority']):
+                yield {'sampler_idx': int(sampler_idx), 'topk': topk[topk >= 0].tolist(), 'priority': float(priority)}
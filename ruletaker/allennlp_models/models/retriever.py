@@ -3,13 +3,11 @@ import logging
 import os
 import sys
 import time
-import wandb
 
 import torch
 from torch.nn.modules.linear import Linear
 from torch import nn
 
-from allennlp.common.util import sanitize
 from allennlp.data import Vocabulary
 from allennlp.models.archival import load_archive
 from allennlp.models.model import Model
@@ -20,6 +18,8 @@ from .retriever_embedders import (
     SpacyRetrievalEmbedder, TransformerRetrievalEmbedder
 )
 from .transformer_binary_qa_model import TransformerBinaryQA
+from .prediction_sink import PredictionSink
+from .metrics_sink import get_metrics_sink
 
 logger = logging.getLogger(__name__)
 
@@ -34,7 +34,7 @@ class RetrievalScorer(Model):
         requires_grad: bool = True,
         transformer_weights_model: str = None,
         num_labels: int = 2,
-        predictions_file=None,
+        predictions_file='predictions.jsonl',
         layer_freeze_regexes: List[str] = None,
         regularizer: Optional[RegularizerApplicator] = None,
         topk: int = 5,
@@ -44,7 +44,7 @@ class RetrievalScorer(Model):
         super().__init__(vocab, regularizer)
         self.vocab = vocab
         self.variant = variant
-        self._predictions = []
+        self._prediction_sink = PredictionSink(predictions_file)
 
         if variant == 'spacy':
             self.model = SpacyRetrievalEmbedder(
@@ -83,6 +83,7 @@ class RetrievalScorer(Model):
         metadata: List[Dict[str, Any]] = None,
         retrieval: List = None,
         sentences: List = None,
+        proof_mask: torch.Tensor = None,
     ) -> torch.Tensor:
         
         self._debug -= 1
@@ -104,59 +105,41 @@ class RetrievalScorer(Model):
             self._accuracy(label_logits, label)
             output_dict["loss"] = loss      # TODO this is shortcut to get predictions fast..
 
-            # Hack to use wandb logging
-            if os.environ['WANDB_LOG'] == 'true':
-                self.wandb_log(metadata, label_logits, label, loss)
-
-            for e, example in enumerate(metadata):
-                logits = sanitize(label_logits[e, :])
-                label_probs = sanitize(output_dict['label_probs'][e, :])
-                prediction = sanitize(output_dict['answer_index'][e])                    
-                prediction_dict = {
-                    'id': example['id'],
-                    'phrase': example['question_text'],
-                    'context': example['context'],
-                    'logits': logits,
-                    'label_probs': label_probs,
-                    'answer': example['label'],
-                    'prediction': prediction,
-                    'is_correct': (example['label'] == prediction) * 1.0,
-                    'q_depth': example['QDep'] if 'QDep' in example else None,
-                    'retrievals': example['topk'] if 'topk' in example else None,
-                }
-
-                if 'skills' in example:
-                    prediction_dict['skills'] = example['skills']
-                if 'tags' in example:
-                    prediction_dict['tags'] = example['tags']
-                self._predictions.append(prediction_dict)
+            if get_metrics_sink().enabled:
+                self.log_batch_metrics(metadata, output_dict['answer_index'], label, loss)
+
+            if not self.training:
+                self._prediction_sink.write(
+                    metadata, label_logits, output_dict['label_probs'], output_dict['answer_index'], self.prediction_fields
+                )
 
         return output_dict
 
-    def wandb_log(self, metadata, label_logits, label, loss):
+    def prediction_fields(self, example, prediction):
+        fields = {
+            'id': example['id'],
+            'phrase': example['question_text'],
+            'context': example['context'],
+            'answer': example['label'],
+            'is_correct': (example['label'] == prediction) * 1.0,
+            'q_depth': example['QDep'] if 'QDep' in example else None,
+            'retrievals': example['topk'] if 'topk' in example else None,
+        }
+        if 'skills' in example:
+            fields['skills'] = example['skills']
+        if 'tags' in example:
+            fields['tags'] = example['tags']
+        return fields
+
+    def log_batch_metrics(self, metadata, answer_index, label, loss):
+        ''' Accumulate loss and accuracy by question depth in the metrics sink
+            (written every few batches).
+        '''
         prefix = 'train' if self.training else 'val'
-
-        # Metrics by question depth
-        if 'QDep' in metadata[0]:
-            depth_accuracies = {}
-            q_depths = torch.tensor([m['QDep'] for m in metadata]).to(label.device)
-            for dep in q_depths.unique():
-                idxs = (q_depths == dep).nonzero().squeeze()
-                logits_ = label_logits[idxs]
-                labels_ = label[idxs]
-                ca = CategoricalAccuracy()
-                ca(logits_, labels_)
-                depth_accuracies[f"{prefix}_acc_{dep}"] = ca.get_metric()
-            wandb.log(depth_accuracies, commit=False)
-
-        # Aggregate metrics
-        c = CategoricalAccuracy()
-        c(label_logits, label)
-        wandb.log({
-            prefix+"_loss": loss, 
-            prefix+"_acc": self._accuracy.get_metric(), 
-            prefix+"_acc_noncuml": c.get_metric()
-        })
+        q_depths = torch.tensor([m['QDep'] for m in metadata]) if metadata[0].get('QDep') is not None else None
+        sink = get_metrics_sink()
+        sink.log_buckets(prefix + '_', q_depths, answer_index == label)
+        sink.log({prefix + '_loss': loss})
 
     def decode(self, idxs):
         idx2tok = self.vocab._index_to_token if self.variant == 'spacy' else self.vocab._index_to_token['tags']
@@ -164,11 +147,11 @@ class RetrievalScorer(Model):
 
     def get_metrics(self, reset: bool = False) -> Dict[str, float]:
         if reset == True and not self.training:
-            return {
-                'EM': self._accuracy.get_metric(reset),
-                'predictions': self._predictions,
-            }
-        else:
-            return {
-                'EM': self._accuracy.get_metric(reset),
-            }
\ No newline at end of file
+            self._prediction_sink.close()
+            # Validation accuracies are cumulative over a validation pass
+            sink = get_metrics_sink()
+            sink.flush()
+            sink.reset('val_')
+        return {
+            'EM': self._accuracy.get_metric(reset),
+        }
\ No newline at end of file
@@ -8,6 +8,8 @@ from transformers import AutoModel
 
 from allennlp.common.util import get_spacy_model
 
+from .prefix_encoder import encode_with_shared_prefix
+
 
 class BaseRetrievalEmbedder(nn.Module):
     def __init__(self, sentence_embedding_method, vocab, variant):
@@ -79,8 +81,24 @@ class TransformerRetrievalEmbedder(BaseRetrievalEmbedder):
         # Compute token embeddings
         # token_embs = self.embedder(input_ids, mask)[0]
         token_embs = self.embedder(input_ids)[0]
-        
+
         # Use CLS token for sentence embedding
-        sentence_embs = token_embs[:,0,:].squeeze().unsqueeze(0)
+        sentence_embs = token_embs[:,0,:]
+
+        return sentence_embs.view(*idxs.shape[:2], -1)
 
-        return sentence_embs.view(*idxs.shape[:2], -1)
\ No newline at end of file
+    def embed_rows(self, rows):
+        ''' CLS embeddings of [n, seq_len] rows with padding masked out, so
+            a row's embedding does not depend on how far it was padded. Used
+            by the sentence index path (embed_sentences) for the question and
+            context rows alike, forward is unmasked as before.
+        '''
+        mask = (rows != self.embedder.config.pad_token_id).long()
+        return self.embedder(rows, attention_mask=mask)[0][:, 0, :]
+
+    def forward_shared_prefix(self, idxs):
+        ''' As forward, but encodes the prefix shared by each example's
+            candidates once (an approximation, see encode_with_shared_prefix).
+        '''
+        hidden, _ = encode_with_shared_prefix(self.embedder, idxs, self.embedder.config.pad_token_id)
+        return hidden[:, :, 0]
@@ -0,0 +1,128 @@
+import multiprocessing as mp
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import torch
+
+# Reader (and vocab) of worker processes, so it is only pickled once per worker
+_READER = None
+
+
+def _init_worker(reader, vocab):
+    global _READER
+    _READER = (reader, vocab)
+
+
+def _encode_chunk(sentences):
+    reader, vocab = _READER
+    return reader.retrieval_rows(sentences, vocab)['token_ids'].numpy()
+
+
+class Deferred:
+    ''' The result of fn(), computed on the first call to result().
+    '''
+    def __init__(self, fn):
+        self._fn = fn
+        self._done = False
+        self._value = None
+
+    def result(self):
+        if not self._done:
+            self._value = self._fn()
+            self._done, self._fn = True, None
+        return self._value
+
+
+class RolloutPrefetcher:
+    ''' Tokenizes the next rollout step's query+retrieval rows on a pool of
+        threads or (spawned) processes while the current step's remaining
+        work is issued, in chunks of chunk_size examples. Rows are padded
+        into one tensor, pinned and copied to the device without blocking.
+        The rows depend on the step's action, so tokenization overlaps the
+        rest of the step but not the retriever forward which produces it.
+
+        Worker processes are spawned rather than forked, as the pool is
+        created mid-training, after CUDA has been initialized.
+
+        Tracks the number of chunks still being tokenized when the rows are
+        needed (queue depth) and the time spent waiting for them (stall).
+    '''
+    def __init__(self, dataset_reader, vocab=None, num_workers: int = 2,
+                 chunk_size: int = 4, backend: str = 'thread'):
+        assert backend in ['thread', 'process']
+        self._reader = dataset_reader
+        self._vocab = vocab
+        self._num_workers = num_workers
+        self._chunk_size = chunk_size
+        self._backend = backend
+        self._pool = None
+        self.reset()
+
+    def reset(self):
+        self._steps = 0
+        self._queue_depth = 0
+        self._stall_time = 0.
+
+    def _get_pool(self):
+        if self._pool is None:
+            if self._backend == 'thread':
+                self._pool = ThreadPoolExecutor(self._num_workers)
+            else:
+                self._pool = ProcessPoolExecutor(self._num_workers, mp_context=mp.get_context('spawn'),
+                                                 initializer=_init_worker, initargs=(self._reader, self._vocab))
+        return self._pool
+
+    def submit(self, sentences, device):
+        ''' Start tokenizing (question, already_retrieved, context) tuples.
+            Returns a Deferred of the [bsz, n_items, seq_len] rows on device.
+        '''
+        pool = self._get_pool()
+        if self._backend == 'thread':
+            # Threads share the reader, no need for the global
+            fn = lambda chunk: self._reader.retrieval_rows(chunk, self._vocab)['token_ids'].numpy()
+        else:
+            fn = _encode_chunk
+        chunks = [sentences[i:i + self._chunk_size] for i in range(0, len(sentences), self._chunk_size)]
+        futures = [pool.submit(fn, chunk) for chunk in chunks]
+        return Deferred(lambda: self._collect(futures, device))
+
+    def _collect(self, futures, device):
+        self._queue_depth += sum(not f.done() for f in futures)
+        start = time.perf_counter()
+        arrays = [f.result() for f in futures]
+        self._stall_time += time.perf_counter() - start
+        self._steps += 1
+
+        pad = self._reader.pad_idx(mode='retriever')
+        rows = torch.full(
+            (sum(len(a) for a in arrays), max(a.shape[1] for a in arrays), max(a.shape[2] for a in arrays)),
+            pad, dtype=torch.long,
+        )
+        offset = 0
+        for a in arrays:
+            rows[offset:offset + len(a), :a.shape[1], :a.shape[2]] = torch.from_numpy(a)
+            offset += len(a)
+
+        if torch.device(device).type == 'cuda':
+            rows = rows.pin_memory()
+        return rows.to(device, non_blocking=True)
+
+    def get_metrics(self, reset: bool = False):
+        steps = max(self._steps, 1)
+        metrics = {
+            'prefetch_queue_depth': self._queue_depth / steps,
+            'prefetch_stall_ms': 1000 * self._stall_time / steps,
+        }
+        if reset:
+            self.reset()
+        return metrics
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
@@ -0,0 +1,113 @@
+import hashlib
+from collections import OrderedDict
+
+import torch
+
+
+class RetrievalScoreCache:
+    ''' LRU cache of retriever outputs keyed by a 128-bit blake2b digest of
+        each (unpadded) token-id row. Values are detached tensors, kept on
+        the device they were computed on. Only valid while the retriever weights
+        are fixed, so the owner is responsible for calling empty() when they
+        change.
+    '''
+    # Rough per-entry bookkeeping cost (key digest, tensor and OrderedDict links)
+    _ENTRY_OVERHEAD_BYTES = 200
+
+    def __init__(self, max_entries: int = 1e6, max_memory_mb: float = None):
+        self._max_entries = int(max_entries)
+        self._max_bytes = max_memory_mb * 2**20 if max_memory_mb is not None else None
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.empty()
+
+    def __len__(self):
+        return len(self.memory)
+
+    def empty(self):
+        self.memory = OrderedDict()
+        self._bytes = 0
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @staticmethod
+    def keys(rows, pad_idx):
+        ''' Hash each row of a [n, seq_len] id tensor, ignoring trailing
+            padding so the same row padded to different lengths matches.
+        '''
+        lengths = (rows != pad_idx).long().cumsum(-1).argmax(-1) + 1
+        rows_ = rows.cpu().numpy().astype('<i8')
+        return [
+            hashlib.blake2b(row[:l].tobytes(), digest_size=16).digest() for row, l in zip(rows_, lengths.tolist())
+        ]
+
+    def lookup(self, keys):
+        ''' Returns the cached values (None for misses) and marks hits as
+            most recently used.
+        '''
+        values = []
+        for key in keys:
+            value = self.memory.get(key)
+            if value is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            values.append(value)
+        return values
+
+    def push(self, keys, values):
+        for key, value in zip(keys, values):
+            if key in self.memory:
+                continue
+            self.memory[key] = value
+            self._bytes += self._entry_size(value)
+        self._evict()
+
+    def _entry_size(self, value):
+        return value.element_size() * value.nelement() + self._ENTRY_OVERHEAD_BYTES
+
+    def _evict(self):
+        while self.memory and (
+            len(self.memory) > self._max_entries
+            or (self._max_bytes is not None and self._bytes > self._max_bytes)
+        ):
+            _, value = self.memory.popitem(last=False)
+            self._bytes -= self._entry_size(value)
+
+
+def cached_row_outputs(cache, rows, pad_idx, compute_fn):
+    ''' Compute compute_fn over the rows of a [n, seq_len] id tensor, only
+        running it on rows which are not cached (deduplicated within the batch).
+        compute_fn must map [m, seq_len] -> [m, d]. Only the ids go to the
+        host (for the keys), the outputs stay on the device.
+    '''
+    keys = cache.keys(rows, pad_idx)
+    cached = cache.lookup(keys)
+
+    missing = {}
+    for n, (key, value) in enumerate(zip(keys, cached)):
+        if value is None and key not in missing:
+            missing[key] = n
+
+    # Rows repeated within the batch are only computed once
+    duplicates = sum(value is None for value in cached) - len(missing)
+    cache.hits += duplicates
+    cache.misses -= duplicates
+
+    if missing:
+        miss_idxs = torch.tensor(list(missing.values()), device=rows.device)
+        computed = compute_fn(rows[miss_idxs]).detach().float()
+        new_values = list(computed.unbind(0))
+        cache.push(list(missing.keys()), new_values)
+        computed_by_key = dict(zip(missing.keys(), new_values))
+        cached = [value if value is not None else computed_by_key[key] for key, value in zip(keys, cached)]
+
+    return torch.stack(cached).to(rows.device)
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def row_lengths(rows, pad_idx):
+    ''' Length of each row of a [n, seq_len] id array up to its trailing padding.
+    '''
+    nonpad = rows != pad_idx
+    return np.where(nonpad.any(-1), nonpad.shape[-1] - nonpad[:, ::-1].argmax(-1), 0)
+
+
+def row_keys(rows, pad_idx):
+    ''' Stable (process independent) int64 hash of each unpadded row of a
+        [n, seq_len] id tensor. Rows which are all padding get key 0.
+    '''
+    rows_ = rows.cpu().numpy().astype(np.int64)
+    keys = np.zeros(len(rows_), dtype=np.int64)
+    for n, (row, l) in enumerate(zip(rows_, row_lengths(rows_, pad_idx))):
+        if l == 0:
+            continue
+        digest = hashlib.blake2b(row[:l].tobytes(), digest_size=8).digest()
+        keys[n] = int.from_bytes(digest, 'little', signed=True) or 1
+    return keys
+
+
+class SentenceEmbeddingIndex:
+    ''' Precomputed sentence embeddings, stored as a memory-mapped
+        [n_sentences, dim] matrix with a sorted array of row keys.
+
+        Layout of an index (<index_dir>/):
+            - keys.npy: (n_sentences,) sorted int64 row_keys
+            - embeddings.npy: (n_sentences, dim) float32 embeddings
+            - header.json: pad_idx and shape
+    '''
+    def __init__(self, index_dir: str):
+        self.path = index_dir
+        with open(os.path.join(index_dir, 'header.json')) as f:
+            self.header = json.load(f)
+        self.keys = np.load(os.path.join(index_dir, 'keys.npy'))
+        self.embeddings = np.load(os.path.join(index_dir, 'embeddings.npy'), mmap_mode='r')
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    @staticmethod
+    def exists(index_dir):
+        return index_dir is not None and os.path.isfile(os.path.join(index_dir, 'header.json'))
+
+    @classmethod
+    def build(cls, index_dir, batches, embed_fn, pad_idx, batch_size=256):
+        ''' Embed every unique row in an iterable of [n, seq_len] id tensors
+            with embed_fn ([m, seq_len] -> [m, dim]) and write the index.
+        '''
+        seen, keys, embeddings = set(), [], []
+        pending_keys, pending_rows = [], []
+
+        def flush():
+            rows = right_pad_rows(pending_rows, pad_idx)
+            with torch.no_grad():
+                embeddings.append(embed_fn(rows).float().cpu().numpy())
+            keys.extend(pending_keys)
+            pending_keys.clear()
+            pending_rows.clear()
+
+        for rows in batches:
+            lengths = row_lengths(rows.cpu().numpy(), pad_idx)
+            for key, row, l in zip(row_keys(rows, pad_idx), rows, lengths):
+                if key == 0 or key in seen:
+                    continue
+                seen.add(key)
+                pending_keys.append(key)
+                pending_rows.append(row[:l])
+                if len(pending_rows) == batch_size:
+                    flush()
+        if pending_rows:
+            flush()
+
+        keys = np.array(keys, dtype=np.int64)
+        order = np.argsort(keys)
+        if not embeddings:
+            raise ValueError(f"No sentences to index for {index_dir}")
+        embeddings = np.concatenate(embeddings)[order]
+
+        parent = os.path.dirname(os.path.abspath(index_dir))
+        os.makedirs(parent, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=parent)
+        np.save(os.path.join(tmp_dir, 'keys.npy'), keys[order])
+        np.save(os.path.join(tmp_dir, 'embeddings.npy'), embeddings.astype(np.float32))
+        with open(os.path.join(tmp_dir, 'header.json'), 'w') as f:
+            json.dump({'pad_idx': int(pad_idx), 'shape': list(embeddings.shape)}, f)
+        if os.path.isdir(index_dir):
+            shutil.rmtree(index_dir)
+        os.rename(tmp_dir, index_dir)
+        logger.info(f"Wrote {len(keys)} sentence embeddings to {index_dir}")
+
+        return cls(index_dir)
+
+    def lookup(self, rows, compute_fn=None):
+        ''' Embeddings for the rows of a [n, seq_len] id tensor. All-padding
+            rows get zeros; rows missing from the index are embedded with
+            compute_fn (or zeros if it is not given).
+        '''
+        keys = row_keys(rows, self.header['pad_idx'])
+        positions = np.searchsorted(self.keys, keys).clip(max=max(len(self.keys) - 1, 0))
+        found = (self.keys[positions] == keys) if len(self.keys) else np.zeros(len(keys), dtype=bool)
+        missing = ~found & (keys != 0)
+        self.hits += int(found.sum())
+        self.misses += int(missing.sum())
+
+        embs = np.zeros((len(keys), self.header['shape'][1]), dtype=np.float32)
+        embs[found] = self.embeddings[positions[found]]
+        embs = torch.from_numpy(embs).to(rows.device)
+        if missing.any() and compute_fn is not None:
+            missing_idxs = torch.from_numpy(missing.nonzero()[0]).to(rows.device)
+            embs[missing_idxs] = compute_fn(rows[missing_idxs]).float()
+        return embs
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+def right_pad_rows(rows, pad_idx):
+    max_len = max(len(row) for row in rows)
+    padded = rows[0].new_full((len(rows), max_len), pad_idx)
+    for n, row in enumerate(rows):
+        padded[n, :len(row)] = row
+    return padded
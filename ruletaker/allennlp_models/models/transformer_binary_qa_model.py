@@ -12,14 +12,18 @@ import json
 import torch
 from torch.nn.modules.linear import Linear
 
-from allennlp.common.util import sanitize
 from allennlp.data import Vocabulary
 from allennlp.models.archival import load_archive
 from allennlp.models.model import Model
 from allennlp.nn import RegularizerApplicator, util
 from allennlp.training.metrics import CategoricalAccuracy
 
-import wandb
+from .prefix_encoder import encode_with_shared_prefix
+from .inference_precision import PRECISIONS, autocast, quantize_linear
+from .prediction_sink import PredictionSink
+from .qa_metrics import proof_mask_from_metadata, retrieved_from_metadata
+from .metrics_sink import get_metrics_sink
+
 import os
 
 logger = logging.getLogger(__name__)
@@ -34,12 +38,20 @@ class TransformerBinaryQA(Model):
                  requires_grad: bool = True,
                  transformer_weights_model: str = None,
                  num_labels: int = 2,
-                 predictions_file=None,
+                 predictions_file='predictions.jsonl',
                  layer_freeze_regexes: List[str] = None,
-                 regularizer: Optional[RegularizerApplicator] = None) -> None:
+                 regularizer: Optional[RegularizerApplicator] = None,
+                 inference_precision: str = 'fp32',
+                 quantize_inference: bool = False) -> None:
         super().__init__(vocab, regularizer)
 
-        self._predictions = []
+        # Predictions of evaluation passes are streamed to predictions_file
+        # (relative to the serialization dir, None disables them)
+        self._prediction_sink = PredictionSink(predictions_file)
+
+        # Autocast precision and int8 dynamic quantization used in eval mode only
+        self._inference_cache = {}
+        self.set_inference_mode(inference_precision, quantize_inference)
 
         self._pretrained_model = pretrained_model
 
@@ -105,6 +117,7 @@ class TransformerBinaryQA(Model):
             label: torch.LongTensor = None,
             metadata: List[Dict[str, Any]] = None,
             index_tensor: torch.Tensor = None,
+            proof_mask: torch.Tensor = None,
         ) -> torch.Tensor:
 
         self._debug -= 1
@@ -113,30 +126,64 @@ class TransformerBinaryQA(Model):
 
         question_mask = (input_ids != self._padding_value).long()
 
+        with self.inference_autocast(input_ids.device):
+            label_logits, cls_output, pooled_output = self._classify(input_ids, segment_ids, question_mask)
+
+        if label_logits.size(1) == 2:
+            label_logits_ = label_logits
+        elif label_logits.size(1) == 1:
+            label_logits_ = torch.cat([(1-label_logits.sigmoid()).log(), label_logits.sigmoid().log()], axis=1)
+            assert ((label_logits_.softmax(-1)[:,1:2] - label_logits.sigmoid()) < 1e-5).all()
+
+        output_dict = {}
+        output_dict['label_logits'] = label_logits
+        output_dict['label_probs'] = torch.nn.functional.softmax(label_logits_, dim=1)
+        output_dict['answer_index'] = label_logits_.argmax(1)
+        output_dict['cls_output'] = cls_output
+        output_dict['pooled_output'] = pooled_output
+
+        if label is not None:
+            loss = self._loss(label_logits_, label)
+            self._accuracy(label_logits_, label)
+            output_dict["loss"] = loss
+            output_dict["label"] = label
+
+            if get_metrics_sink().enabled:
+                self.log_batch_metrics(metadata, output_dict['answer_index'], label, loss, proof_mask)
+
+            if not self.training:
+                self._prediction_sink.write(
+                    metadata, label_logits, output_dict['label_probs'], output_dict['answer_index'], self.prediction_fields
+                )
+
+        return output_dict
+
+    def _classify(self, input_ids, segment_ids, question_mask):
+        transformer_model = self.inference_transformer(input_ids.device)
         # Segment ids are not used by RoBERTa
         if 'roberta' in self._pretrained_model or 't5' in self._pretrained_model:
-            transformer_outputs, pooled_output = self._transformer_model(
+            transformer_outputs, pooled_output = transformer_model(
                 input_ids=util.combine_initial_dims(input_ids),
                 # token_type_ids=util.combine_initial_dims(segment_ids),
                 attention_mask=util.combine_initial_dims(question_mask),
             )
             cls_output = self._dropout(pooled_output)
         if 'albert' in self._pretrained_model:
-            transformer_outputs, pooled_output = self._transformer_model(
+            transformer_outputs, pooled_output = transformer_model(
                 input_ids=util.combine_initial_dims(input_ids),
                 # token_type_ids=util.combine_initial_dims(segment_ids),
                 attention_mask=util.combine_initial_dims(question_mask)
             )
             cls_output = self._dropout(pooled_output)
         elif 'xlnet' in self._pretrained_model:
-            transformer_outputs = self._transformer_model(
+            transformer_outputs = transformer_model(
                 input_ids=util.combine_initial_dims(input_ids),
                 token_type_ids=util.combine_initial_dims(segment_ids),
                 attention_mask=util.combine_initial_dims(question_mask)
             )
             cls_output = self.sequence_summary(transformer_outputs[0])
         elif 'bert' in self._pretrained_model:
-            last_layer, pooled_output = self._transformer_model(
+            last_layer, pooled_output = transformer_model(
                 input_ids=util.combine_initial_dims(input_ids),
                 token_type_ids=util.combine_initial_dims(segment_ids),
                 attention_mask=util.combine_initial_dims(question_mask)
@@ -146,90 +193,86 @@ class TransformerBinaryQA(Model):
             assert (ValueError)
 
         label_logits = self._classifier(cls_output)
-
-        if label_logits.size(1) == 2:
-            label_logits_ = label_logits
-        elif label_logits.size(1) == 1:
-            label_logits_ = torch.cat([(1-label_logits.sigmoid()).log(), label_logits.sigmoid().log()], axis=1)
-            assert ((label_logits_.softmax(-1)[:,1:2] - label_logits.sigmoid()) < 1e-5).all()
-
-        output_dict = {}
-        output_dict['label_logits'] = label_logits
-        output_dict['label_probs'] = torch.nn.functional.softmax(label_logits_, dim=1)
-        output_dict['answer_index'] = label_logits_.argmax(1)
-        output_dict['cls_output'] = cls_output
-        output_dict['pooled_output'] = pooled_output
-
-        if label is not None:
-            loss = self._loss(label_logits_, label)
-            self._accuracy(label_logits_, label)
-            output_dict["loss"] = loss
-            output_dict["label"] = label
-
-            # Hack to use wandb logging
-            if os.environ['WANDB_LOG'] == 'true':
-                self.wandb_log(metadata, label_logits, label, loss)
-
-            for e, example in enumerate(metadata):
-                logits = sanitize(label_logits[e, :])
-                label_probs = sanitize(output_dict['label_probs'][e, :])
-                prediction = sanitize(output_dict['answer_index'][e])                    
-                prediction_dict = {
-                    'id': example['id'],
-                    'phrase': example['question_text'],
-                    'context': example['context'],
-                    'logits': logits,
-                    'label_probs': label_probs,
-                    'answer': example['label'],
-                    'prediction': prediction,
-                    'is_correct': (example['label'] == prediction) * 1.0,
-                    'q_depth': example['QDep'] if 'QDep' in example else None,
-                    'q_length': example['QDep'] if 'QLen' in example else None,
-                    'retrievals': example['topk'] if 'topk' in example else None,
-                    'retrieval_recall': self.retrieval_recall(example) if 'node_label' in example and 'topk' in example else None
-                }
-
-                if 'skills' in example:
-                    prediction_dict['skills'] = example['skills']
-                if 'tags' in example:
-                    prediction_dict['tags'] = example['tags']
-                self._predictions.append(prediction_dict)
-
-        return output_dict
-
-    def wandb_log(self, metadata, label_logits, label, loss):
+        return label_logits.float(), cls_output.float(), pooled_output.float()
+
+    def forward_shared_prefix(self, input_ids):
+        ''' Logits for [bsz, n, seq_len] candidate rows, encoding the prefix
+            shared by each example's candidates once. Approximates forward(),
+            see encode_with_shared_prefix. RoBERTa/BERT only.
+        '''
+        if 'roberta' not in self._pretrained_model and (
+            'bert' not in self._pretrained_model or 'albert' in self._pretrained_model
+        ):
+            raise ValueError(f'Shared prefix encoding is not supported for {self._pretrained_model}')
+        transformer_model = self.inference_transformer(input_ids.device)
+        with self.inference_autocast(input_ids.device):
+            hidden, _ = encode_with_shared_prefix(transformer_model, input_ids, self._padding_value)
+            pooled_output = transformer_model.pooler(hidden.view(-1, *hidden.shape[2:]))
+            label_logits = self._classifier(self._dropout(pooled_output))
+        return label_logits.float().view(*input_ids.shape[:2], -1)
+
+    def set_inference_mode(self, precision: str = 'fp32', quantize: bool = False):
+        ''' Autocast precision (fp32, bf16, fp16 or auto) and whether to use
+            int8 dynamically quantized Linear layers (CPU only), in eval mode.
+        '''
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown inference_precision {precision}, expected one of {PRECISIONS}.\nInvestigate!")
+        self._inference_precision = precision
+        self._quantize_inference = quantize
+
+    def inference_autocast(self, device):
+        if self.training:
+            return autocast('fp32', device)
+        return autocast(self._inference_precision, device)
+
+    def inference_transformer(self, device):
+        ''' The transformer to run, its quantized copy when evaluating on CPU
+            with quantize_inference. The copy is made once per eval phase.
+        '''
+        if self.training or not self._quantize_inference or device.type != 'cpu':
+            return self._transformer_model
+        if 'transformer' not in self._inference_cache:
+            self._inference_cache['transformer'] = quantize_linear(self._transformer_model)
+        return self._inference_cache['transformer']
+
+    def train(self, mode: bool = True):
+        # The quantized copy is stale once the weights are updated
+        if mode:
+            self._inference_cache.clear()
+        return super().train(mode)
+
+    def prediction_fields(self, example, prediction):
+        fields = {
+            'id': example['id'],
+            'phrase': example['question_text'],
+            'context': example['context'],
+            'answer': example['label'],
+            'is_correct': (example['label'] == prediction) * 1.0,
+            'q_depth': example['QDep'] if 'QDep' in example else None,
+            'q_length': example['QLen'] if 'QLen' in example else None,
+            'retrievals': example['topk'] if 'topk' in example else None,
+            'retrieval_recall': self.retrieval_recall(example) if 'node_label' in example and 'topk' in example else None
+        }
+        if 'skills' in example:
+            fields['skills'] = example['skills']
+        if 'tags' in example:
+            fields['tags'] = example['tags']
+        return fields
+
+    def log_batch_metrics(self, metadata, answer_index, label, loss, proof_mask=None):
+        ''' Accumulate loss, accuracy and retrieval recall by proof length in
+            the metrics sink (written every few batches).
+        '''
         prefix = 'train' if self.training else 'val'
-
-        # Metrics by proof length
-        if 'QLen' in metadata[0]:
-            len_accs = {}
-            retrieval_recalls = {}
-            q_lens = torch.tensor([m['QLen'] for m in metadata]).to(label.device)
-            for len_ in q_lens.unique():
-                idxs = (q_lens == len_).nonzero().squeeze()
-
-                # Accuracy
-                logits_ = label_logits[idxs]
-                labels_ = label[idxs]
-                ca = CategoricalAccuracy()
-                ca(logits_, labels_)
-                len_accs[f"{prefix}_acc_{len_}"] = ca.get_metric()
-
-                # Retrieval recall
-                meta = [metadata[i] for i in (idxs if idxs.dim() else idxs.unsqueeze(0)).tolist()]
-                retrieval_recalls[f"{prefix}_ret_recall_{len_}"] = self.batch_retrieval_recall(meta)
-
-            wandb.log({**len_accs, **retrieval_recalls}, commit=False)
-
-        # Aggregate metrics
-        c = CategoricalAccuracy()
-        c(label_logits, label)
-        wandb.log({
-            prefix+"_loss": loss.mean(), 
-            prefix+"_acc": self._accuracy.get_metric(), 
-            prefix+"_acc_noncuml": c.get_metric(),
-            prefix+"_ret_recall": self.batch_retrieval_recall(metadata),
-        })
+        qlens = torch.tensor([m['QLen'] for m in metadata]) if metadata[0].get('QLen') is not None else None
+        retrieved = None
+        if 'topk' in metadata[0] and 'node_label' in metadata[0]:
+            retrieved = retrieved_from_metadata(metadata)
+            if proof_mask is None:
+                proof_mask = proof_mask_from_metadata(metadata)
+        sink = get_metrics_sink()
+        sink.log_buckets(prefix + '_', qlens, answer_index == label, label, retrieved, proof_mask)
+        sink.log({prefix + '_loss': loss})
 
     def retrieval_recall(self, example):
         proof_idxs = {n for n,i in enumerate(example['node_label'][:-1]) if i == 1}
@@ -239,23 +282,14 @@ class TransformerBinaryQA(Model):
         else:
             return -1
 
-    def batch_retrieval_recall(self, metadata):
-        recalls = []
-        for example in metadata:
-            if example['label']:
-                recall = self.retrieval_recall(example)
-                if recall != -1:
-                    recalls.append(recall)
-        return sum(recalls) / len(recalls) if recalls else None
-
     def get_metrics(self, reset: bool = False) -> Dict[str, float]:
         if reset == True and not self.training:
-            return {
-                'EM': self._accuracy.get_metric(reset),
-                'predictions': self._predictions,
-            }
-        else:
-            return {
-                'EM': self._accuracy.get_metric(reset),
-            }
+            self._prediction_sink.close()
+            # Validation accuracies are cumulative over a validation pass
+            sink = get_metrics_sink()
+            sink.flush()
+            sink.reset('val_')
+        return {
+            'EM': self._accuracy.get_metric(reset),
+        }
 
@@ -8,7 +8,6 @@ import torch
 from torch.nn.modules.linear import Linear
 from torch import nn
 
-from allennlp.common.util import sanitize
 from allennlp.data import Vocabulary
 from allennlp.models.archival import load_archive
 from allennlp.models.model import Model
@@ -18,6 +17,8 @@ from allennlp.training.metrics import CategoricalAccuracy
 from .retriever_embedders import (
     SpacyRetrievalEmbedder, TransformerRetrievalEmbedder
 )
+from .sentence_index import SentenceEmbeddingIndex
+from .prediction_sink import PredictionSink
 
 logger = logging.getLogger(__name__)
 
@@ -33,18 +34,21 @@ class TransformerBinaryQARetriever(Model):
         requires_grad: bool = True,
         # transformer_weights_model: str = None,
         num_labels: int = 2,
-        predictions_file=None,
+        predictions_file='predictions.jsonl',
         layer_freeze_regexes: List[str] = None,
         regularizer: Optional[RegularizerApplicator] = None,
         topk: int = 5,
         sentence_embedding_method: str = 'mean',
         dataset_reader = None,
         pretrained_retriever_model = None,
+        sentence_index_dir: str = None,
     ) -> None:
         super().__init__(qa_model.vocab, regularizer)
         self.qa_vocab = qa_model.vocab
         self.vocab = vocab
         self.qa_model = qa_model
+        # Validation predictions go to predictions_file (relative to the serialization dir)
+        self.qa_model._prediction_sink = PredictionSink(predictions_file)
         self.topk = topk
         self.variant = variant
         self.dataset_reader = dataset_reader
@@ -86,6 +90,13 @@ class TransformerBinaryQARetriever(Model):
                 f"Invalid retriever_variant = {variant}.\nInvestigate!"
             )
 
+        # Precomputed context sentence embeddings, see build_sentence_index
+        self.sentence_index = None
+        if SentenceEmbeddingIndex.exists(sentence_index_dir):
+            self.sentence_index = SentenceEmbeddingIndex(sentence_index_dir)
+        elif sentence_index_dir is not None:
+            logger.warning(f"No sentence index at {sentence_index_dir}, context sentences will be encoded per question")
+
         self._debug = -1
 
     def forward(self, 
@@ -94,6 +105,7 @@ class TransformerBinaryQARetriever(Model):
         metadata: List[Dict[str, Any]] = None,
         retrieval: List = None,
         sentences: List = None,
+        proof_mask: torch.Tensor = None,
     ) -> torch.Tensor:
 
         phrase_idxs = sentences['tokens']['token_ids']
@@ -118,6 +130,7 @@ class TransformerBinaryQARetriever(Model):
             phrase=batch['phrase'],
             label=label,
             metadata=metadata,
+            proof_mask=proof_mask,
         )
 
     def retrieve_topk_idxs(self, idxs, metadata=None):
@@ -135,7 +148,7 @@ class TransformerBinaryQARetriever(Model):
                 # of the context and question.
 
                 # Compute sentence embeddings
-                sentence_embs = self.retriever_model(idxs)
+                sentence_embs = self.embed_sentences(idxs)
 
                 # Compute similarity between context and query sentence embeddingss
                 query, context = sentence_embs[:,:1,:], sentence_embs[:,1:,:]
@@ -173,6 +186,40 @@ class TransformerBinaryQARetriever(Model):
         
         return topk_idxs
 
+    def embed_sentences(self, idxs):
+        ''' Embed the question (first row) and context sentences of each
+            example, reading context sentences from the sentence index if
+            one is loaded so only the question is encoded.
+        '''
+        if self.sentence_index is None:
+            return self.retriever_model(idxs)
+
+        bsz, n_rows, seq_len = idxs.shape
+        query = self.retriever_model.embed_rows(idxs[:, 0])
+        context = self.sentence_index.lookup(
+            idxs[:, 1:].reshape(-1, seq_len), self.retriever_model.embed_rows
+        )
+        return torch.cat([query.unsqueeze(1), context.view(bsz, n_rows - 1, -1)], dim=1)
+
+    def build_sentence_index(self, batches, index_dir: str, batch_size: int = 256):
+        ''' Precompute embeddings of every unique context sentence in
+            batches (as produced by the data loader) and load the index.
+        '''
+        if self.similarity is None or not isinstance(self.retriever_model, TransformerRetrievalEmbedder):
+            raise ValueError(
+                "A sentence index can only be built for similarity retrieval with a transformer embedder.\nInvestigate!"
+            )
+
+        def context_rows():
+            for batch in batches:
+                idxs = batch['retrieval']['tokens'][self.tok_name]
+                yield idxs[:, 1:].reshape(-1, idxs.size(-1)).to(self._get_prediction_device())
+
+        self.sentence_index = SentenceEmbeddingIndex.build(
+            index_dir, context_rows(), self.retriever_model.embed_rows, self.retriever_pad_idx, batch_size
+        )
+        return self.sentence_index
+
     def prepare_retrieved_batch(self, topk_idxs, metadata):
         ''' Retrieve the top k context sentences and prepare batch
             for use in the qa model.
@@ -193,11 +240,10 @@ class TransformerBinaryQARetriever(Model):
 
     def get_metrics(self, reset: bool = False) -> Dict[str, float]:
         if reset == True and not self.training:
-            return {
-                'EM': self.qa_model._accuracy.get_metric(reset),
-                'predictions': self.qa_model._predictions,
-            }
-        else:
-            return {
-                'EM': self.qa_model._accuracy.get_metric(reset),
-            }
+            self.qa_model._prediction_sink.close()
+        metrics = {
+            'EM': self.qa_model._accuracy.get_metric(reset),
+        }
+        if self.sentence_index is not None:
+            metrics['sentence_index_hit_rate'] = self.sentence_index.hit_rate()
+        return metrics
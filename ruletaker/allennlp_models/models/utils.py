@@ -92,6 +92,78 @@ def one_hot(make_as, x):
     return torch.zeros_like(make_as).scatter(1, x.unsqueeze(-1), 1)
 
 
+def build_rollout_rows(prefix, sentences, retrieved, pad_idx, eos_idx, max_length=None):
+    ''' Assemble the next query+retrieval rows from pre-tokenized spans
+        using only tensor ops (no string round-trip / re-tokenization).
+        :param prefix: [bsz, P] ids of "<s> q </s></s>", right padded
+        :param sentences: [bsz, n, L] ids of each context sentence, right padded
+        :param retrieved: [bsz, n] bool mask of the sentences retrieved so far
+        :param max_length: truncate rows as the tokenizer would ("longest_first")
+        :return rows: [bsz, n, T] ids of "<s> q </s></s> r_1 .. r_t s_j </s>" for
+            each candidate j (retrievals in context order). Rows of padding
+            or already retrieved candidates are all padding.
+    '''
+    bsz, n, L = sentences.shape
+    sentence_mask = sentences != pad_idx
+    candidate_mask = sentence_mask.any(-1) & ~retrieved
+
+    # Prefix + retrieved sentences are shared by every candidate row
+    shared = torch.cat([prefix, sentences.view(bsz, n * L)], dim=1)
+    shared_mask = torch.cat(
+        [prefix != pad_idx, (sentence_mask & retrieved.unsqueeze(-1)).view(bsz, n * L)], dim=1
+    )
+    eos = torch.full((bsz, n, 1), eos_idx, dtype=sentences.dtype, device=sentences.device)
+    tokens = torch.cat([shared.unsqueeze(1).expand(-1, n, -1), sentences, eos], dim=-1)
+    keep = torch.cat(
+        [shared_mask.unsqueeze(1).expand(-1, n, -1), sentence_mask, torch.ones_like(eos).bool()], dim=-1
+    ) & candidate_mask.unsqueeze(-1)
+    if max_length is not None:
+        keep = keep & ~truncated_tokens(prefix, keep, eos_idx, pad_idx, max_length)
+
+    # Left-align the kept tokens: scatter each to its running position and
+    # send dropped tokens to a spill column which is sliced off
+    T = tokens.size(-1)
+    positions = torch.where(keep, keep.long().cumsum(-1) - 1, torch.full_like(tokens, T))
+    rows = torch.full((bsz, n, T + 1), pad_idx, dtype=tokens.dtype, device=tokens.device)
+    rows.scatter_(-1, positions, tokens)
+    max_len = max(int(keep.sum(-1).max()), 1)
+
+    return rows[..., :max_len]
+
+
+def truncated_tokens(prefix, keep, eos_idx, pad_idx, max_length):
+    ''' [bsz, n, T] mask of the tokens of the build_rollout_rows rows which
+        a "longest_first" truncation to max_length drops: tokens are removed
+        one at a time from the end of the longer of the question and the
+        context (the context on ties).
+    '''
+    bsz, n, T = keep.shape
+    P = prefix.size(1)
+    is_sep = prefix == eos_idx
+    # The question is between <s> and the first separator, the prefix's
+    # context (if any) after the last one
+    question = (is_sep.long().cumsum(-1) == 0) & (torch.arange(P, device=prefix.device) > 0)
+    prefix_context = (is_sep.flip(-1).long().cumsum(-1).flip(-1) == 0) & (prefix != pad_idx)
+
+    zeros = torch.zeros(bsz, n, T - P, dtype=torch.bool, device=keep.device)
+    question = torch.cat([question.unsqueeze(1).expand(-1, n, -1), zeros], dim=-1) & keep
+    context = torch.cat([prefix_context.unsqueeze(1).expand(-1, n, -1), ~zeros], dim=-1)
+    context[..., -1] = False        # Closing </s>
+    context = context & keep
+
+    a, b = question.long().sum(-1), context.long().sum(-1)
+    excess = (keep.long().sum(-1) - max_length).clamp(min=0)
+    # Remove from the longer one until they are even, then alternately
+    diff = torch.min(excess, (a - b).abs())
+    a_ = a - torch.where(a > b, diff, torch.zeros_like(diff))
+    b_ = b - torch.where(a > b, torch.zeros_like(diff), diff)
+    rest = excess - diff
+    a_, b_ = a_ - rest // 2, b_ - (rest + 1) // 2
+
+    drop = question & (question.long().cumsum(-1) > a_.unsqueeze(-1))
+    return drop | (context & (context.long().cumsum(-1) > b_.unsqueeze(-1)))
+
+
 def lfilter(*args):
     return list(filter(*args))
 
@@ -25,6 +25,7 @@ from .retriever_embedders import (
 )
 from .utils import safe_log, right_pad, batch_lookup, EPSILON, make_dot, set_dropout, one_hot, lmap, lfilter
 from .transformer_binary_qa_model import TransformerBinaryQA
+from .prediction_sink import PredictionSink
 from .baseline import Baseline
 
 torch.manual_seed(0)
@@ -39,26 +40,35 @@ class ELBO(Model):
         requires_grad: bool = True,
         transformer_weights_model: str = None,
         num_labels: int = 2,
-        predictions_file=None,
+        predictions_file='predictions.jsonl',
         layer_freeze_regexes: List[str] = None,
         regularizer: Optional[RegularizerApplicator] = None,
         topk: int = 5,
         sentence_embedding_method: str = 'mean',
         dataset_reader = None,
+        num_samples: int = 1,
+        span_pooling: str = 'first_last',
     ) -> None:
         super().__init__(qa_model.vocab, regularizer)
         self.variant = variant
         self.qa_model = qa_model        # TODO: replace with fresh transformerbinaryqa
+        # Validation predictions go to predictions_file (relative to the serialization dir)
+        self.qa_model._prediction_sink = PredictionSink(predictions_file)
         self.qa_model._loss = nn.CrossEntropyLoss(reduction='none')
         self._loss = nn.CrossEntropyLoss(reduction='none')
         self.qa_vocab = qa_model.vocab
         self.dataset_reader = dataset_reader
-        self.infr_model = InferenceNetwork(variant=variant, vocab=vocab, dataset_reader=dataset_reader)
-        self.gen_model = GenerativeNetwork(variant=variant, vocab=vocab, dataset_reader=dataset_reader)
+        self.infr_model = InferenceNetwork(
+            variant=variant, vocab=vocab, dataset_reader=dataset_reader, span_pooling=span_pooling
+        )
+        self.gen_model = GenerativeNetwork(
+            variant=variant, vocab=vocab, dataset_reader=dataset_reader, span_pooling=span_pooling
+        )
         self.vocab = vocab
         self.regularizer = regularizer
         self.sentence_embedding_method = sentence_embedding_method
         self.n_z = topk
+        self.num_samples = num_samples      # Independent trajectories per example
         # self.kl_div = nn.KLDivLoss(reduction='none')
         self._beta = 1
 
@@ -79,38 +89,41 @@ class ELBO(Model):
         infr_logits = self.infr_model(phrase, label)
         gen_logits = self.gen_model(phrase)
         # TODO: make multi-label classification problem (so sigmoid rather than softmax output layer)
-        z = self._draw_samples(infr_logits)
+        # Draw all samples at once from the single infr_model encoding
+        z = self._draw_samples(infr_logits)        # shape: (bsz, num_samples, n_z)
         batch = self._prep_batch(z, metadata, label)
         qa_output = self.qa_model(**batch)
 
         # Compute log probabilites from logits and sample
-        infr_logprobs = -self._loss(infr_logits, z.squeeze(-1))
-        gen_logprobs = -self._loss(gen_logits, z.squeeze(-1))
+        infr_logprobs = self._sample_logprobs(infr_logits, z)
+        gen_logprobs = self._sample_logprobs(gen_logits, z)
 
         # kl_div = self.kl_div(infr_logits.log_softmax(-1), gen_logits.softmax(-1)).sum(-1)
-        qa_logprobs = -qa_output['loss'].detach()
+        qa_logprobs = -qa_output['loss'].detach().view(z.shape[:2])
         elbo = qa_logprobs - self._beta * (infr_logprobs - gen_logprobs)
         outputs = {"loss": -elbo.mean()}
         return outputs
 
     def _prep_batch(self, z, metadata, label):
-        ''' Concatenate the latest retrieval to the current 
-            query+retrievals. Also update the tensors for the next
-            rollout pass.
+        ''' Build the qa model inputs for every sampled subset so all
+            samples are scored in one padded forward pass. meta['context_str']
+            holds one string per sample.
         '''
         # Concatenate query + retrival to make new query_retrieval matrix of idxs        
         sentences = []
-        for topk, meta, e in zip(z, metadata, label):
+        for samples, meta, e in zip(z, metadata, label):
             question = meta['question_text']
-            sentence_idxs = topk.tolist()
-            context_rtr = [
-                toks + '.' for n, toks in enumerate(meta['context'].split('.')[:-1]) 
-                if n in sentence_idxs
-            ]
-            meta['context_str'] = f"q: {question} c: {''.join(context_rtr).strip()}"
-            sentences.append((question, ''.join(context_rtr).strip(), e))
-
-        batch = self.dataset_reader.encode_batch(sentences, self.qa_vocab)
+            context = meta['context'].split('.')[:-1]
+            meta['context_str'] = []
+            for sentence_idxs in samples.tolist():
+                context_rtr = [
+                    toks + '.' for n, toks in enumerate(context) 
+                    if n in sentence_idxs
+                ]
+                sentences.append((question, ''.join(context_rtr).strip(), e))
+                meta['context_str'].append(f"q: {question} c: {''.join(context_rtr).strip()}")
+
+        batch = self.dataset_reader.batch_encode(sentences)
         return self.dataset_reader.move(batch, self._d)
 
     def _gs(self, logits, tau=1):
@@ -118,22 +131,91 @@ class ELBO(Model):
         '''
         return F.gumbel_softmax(logits, tau=tau, hard=True, eps=1e-10, dim=-1)
 
-    def _draw_samples(self, p):
-        ''' Obtain samples from a distribution
-            - p: probability distribution
+    def _draw_samples(self, logits):
+        ''' Draw num_samples ordered subsets of n_z sentences per example,
+            without replacement, in one op (Gumbel-top-k).
+            - logits: unnormalized log probabilities, shape (bsz, # sentences)
+        '''
+        n_z = min(self.n_z, logits.size(-1))
+        gumbels = -torch.empty(
+            logits.size(0), self.num_samples, logits.size(-1), device=logits.device
+        ).exponential_().log()
+        perturbed = logits.detach().unsqueeze(1) + gumbels
+        return perturbed.topk(n_z, dim=-1).indices
+
+    def _sample_logprobs(self, logits, z):
+        ''' Log probability of each ordered sample without replacement
+            (Plackett-Luce): sum_i log p(z_i) - log(1 - sum_{j<i} p(z_j)).
+            Reduces to log p(z) when n_z == 1.
+        '''
+        logprobs = logits.log_softmax(-1).unsqueeze(1).expand(-1, z.size(1), -1)
+        chosen = logprobs.gather(-1, z)
+        taken = chosen.exp().cumsum(-1) - chosen.exp()
+        return (chosen - torch.log((1 - taken).clamp(min=EPSILON))).sum(-1)
+
+
+class SentenceSpanPooler(nn.Module):
+    ''' Pools token embeddings into one vector per context sentence for the
+        whole batch at once. Sentences are delimited by split_idx (the "."
+        token); the first split closes the question.
+        - first_last: concat embeddings of the first and last token of each span
+        - mean / max: pool over all tokens in each span
+    '''
+    def __init__(self, split_idx, method='first_last', question_offset=5):
+        super().__init__()
+        assert method in ['first_last', 'mean', 'max']
+        self.split_idx = split_idx
+        self.method = method
+        self.question_offset = question_offset      # Tokenizer adds five "decorative" tokens at the beginning of the context
+
+    def output_dim(self, input_dim):
+        return 2 * input_dim if self.method == 'first_last' else input_dim
+
+    def spans(self, x):
+        ''' Start and end (inclusive) token idxs of each sentence.
+            Returns starts, ends, mask each of shape (bsz, # sentences)
         '''
-        samples = torch.zeros(p.size(0), self.n_z, dtype=torch.long).to(self._d)
-        # TODO: look into this - don't think this is a valid thing to do...
-        for i in range(self.n_z):
-            samples[:, i] = self._gs(p).argmax(-1)
-            # TODO: mask out already sampled values
-        return samples
+        seq_len = x.size(1)
+        is_split = x == self.split_idx
+        n_splits = is_split.sum(-1)
+        max_num_sentences = int(n_splits.max()) - 1
+
+        # Sorted positions of the full stops in each row, padded with seq_len
+        positions = torch.arange(seq_len, device=x.device).expand_as(x)
+        split_idxs = torch.where(is_split, positions, torch.full_like(positions, seq_len))
+        split_idxs = split_idxs.sort(-1).values[:, :max_num_sentences + 1]
+
+        starts = split_idxs[:, :-1].clone()
+        starts[:, 0] += self.question_offset
+        ends = split_idxs[:, 1:] - 1        # -1 as this ignores the full stops
+        mask = torch.arange(max_num_sentences, device=x.device).unsqueeze(0) < (n_splits - 1).unsqueeze(1)
+
+        return starts.clamp(max=seq_len - 1), ends.clamp(max=seq_len - 1), mask
+
+    def forward(self, embs, x):
+        ''' embs: (bsz, seq_len, dim), x: (bsz, seq_len) token ids.
+            Returns (bsz, # sentences, output_dim), mask (bsz, # sentences)
+        '''
+        starts, ends, mask = self.spans(x)
+
+        if self.method == 'first_last':
+            gather = lambda idxs: embs.gather(1, idxs.unsqueeze(-1).expand(-1, -1, embs.size(-1)))
+            return torch.cat([gather(starts), gather(ends)], dim=-1), mask
+
+        positions = torch.arange(embs.size(1), device=embs.device).view(1, 1, -1)
+        token_mask = (positions >= starts.unsqueeze(-1)) & (positions <= ends.unsqueeze(-1)) & mask.unsqueeze(-1)
+        if self.method == 'mean':
+            token_mask = token_mask.to(embs.dtype)
+            pooled = token_mask.bmm(embs) / token_mask.sum(-1, keepdim=True).clamp(min=1)
+        else:
+            pooled = embs.unsqueeze(1).masked_fill(~token_mask.unsqueeze(-1), -float('inf')).max(2).values
+            pooled = pooled.masked_fill(~token_mask.any(-1, keepdim=True), 0.)     # Padding / empty spans
+        return pooled, mask
 
 
 class _BaseSentenceClassifier(Model):
-    def __init__(self, variant, vocab, dataset_reader, regularizer=None, num_labels=1):
+    def __init__(self, variant, vocab, dataset_reader, regularizer=None, num_labels=1, span_pooling='first_last'):
         super().__init__(vocab, regularizer)
-        self._predictions = []
 
         self.variant = variant
         self.dataset_reader = dataset_reader
@@ -144,17 +226,18 @@ class _BaseSentenceClassifier(Model):
         transformer_config.num_labels = num_labels
         self._output_dim = self.model.config.hidden_size
 
+        # Split sentences in the context based on full stop
+        self.split_idx = self.dataset_reader.encode_token('.', mode='retriever')
+        self._pooler = SentenceSpanPooler(self.split_idx, span_pooling)
+
         # unifing all model classification layer
-        self._W = Linear(self._output_dim * 2, num_labels)
+        self._W = Linear(self._pooler.output_dim(self._output_dim), num_labels)
         self._W.weight.data.normal_(mean=0.0, std=0.02)
         self._W.bias.data.zero_()
 
         self._accuracy = CategoricalAccuracy()
         self._loss = torch.nn.CrossEntropyLoss()
 
-        # Split sentences in the context based on full stop
-        self.split_idx = self.dataset_reader.encode_token('.', mode='retriever')
-
     def forward(self, x) -> torch.Tensor:
         ''' Forward pass of the network. Outputs a distribution over sentences z. 
 
@@ -167,36 +250,17 @@ class _BaseSentenceClassifier(Model):
         # Compute representations
         embs = self.model(x)[0]
 
-        # TODO: experiment with concatenating first and last token embs from sentence + mean pooling
-        # Concat first and last token idxs
-        max_num_sentences = (x == self.split_idx).nonzero()[:,0].bincount().max() - 1
-        node_reprs = torch.full((x.size(0), max_num_sentences), 0.).to(self._d)      # shape: (bsz, # sentences, 2, model_dim)
-        for b in range(x.size(0)):
-            # Create list of end idxs of each context item
-            end_idxs = (x[b] == self.split_idx).nonzero().squeeze().tolist()
-            q_end = end_idxs.pop(0)     # Remove first list item as it is the question
-            end_idxs.insert(0, q_end + 5)   # Tokenizer adds five "decorative" tokens at the beginning of the context
-
-            # Form tensor containing embedding of first and last token for each sentence
-            reprs = torch.zeros(len(end_idxs)-1, 2, embs.size(-1)).to(self._d)      # shape: (# context items, 2, model_dim)
-            for i in range(1, len(end_idxs)):
-                start_idx = end_idxs[i-1]
-                end_idx = end_idxs[i] - 1           # -1 as this ignores the full stops
-                
-                reprs[i-1, 0] = embs[b, start_idx]
-                reprs[i-1, 1] = embs[b, end_idx]
-
-            # Pass through classifier
-            reprs_ = reprs.view(reprs.size(0), -1)
-            node_logits = self._W(reprs_).squeeze(-1)                
-            node_reprs[b, :len(node_logits)] = node_logits
+        # Pool each sentence span and pass through classifier
+        reprs, mask = self._pooler(embs, x)      # shape: (bsz, # sentences, pooled_dim)
+        node_logits = self._W(reprs).squeeze(-1)
+        node_reprs = node_logits.masked_fill(~mask, 0.)
 
         return node_reprs.log_softmax(-1)
 
 
 class InferenceNetwork(_BaseSentenceClassifier):
-    def __init__(self, variant, vocab, dataset_reader, regularizer=None, num_labels=1):
-        super().__init__(variant, vocab, dataset_reader, regularizer, num_labels)
+    def __init__(self, variant, vocab, dataset_reader, regularizer=None, num_labels=1, span_pooling='first_last'):
+        super().__init__(variant, vocab, dataset_reader, regularizer, num_labels, span_pooling)
         self.e_true = torch.tensor(
             [self.dataset_reader.encode_token(tok, mode='retriever') for tok in '<s> ĠE : ĠTrue </s>'.split()]
         )
@@ -243,8 +307,8 @@ class InferenceNetwork(_BaseSentenceClassifier):
 
 
 class GenerativeNetwork(_BaseSentenceClassifier):
-    def __init__(self, variant, vocab, dataset_reader, regularizer=None, num_labels=1):
-        super().__init__(variant, vocab, dataset_reader, regularizer, num_labels)
+    def __init__(self, variant, vocab, dataset_reader, regularizer=None, num_labels=1, span_pooling='first_last'):
+        super().__init__(variant, vocab, dataset_reader, regularizer, num_labels, span_pooling)
 
     def forward(self, phrase, **kwargs) -> torch.Tensor:
         ''' Forward pass of the network. Outputs a distribution over sentences z. 
@@ -0,0 +1,73 @@
+"""
+The `build_sentence_index` subcommand precomputes the context sentence
+embeddings used by a similarity-based `transformer_binary_qa_retriever`.
+
+   $ allennlp build_sentence_index model.tar.gz dev.jsonl runs/index/dev
+"""
+
+import argparse
+import logging
+
+import torch
+from overrides import overrides
+
+from allennlp.commands.subcommand import Subcommand
+from allennlp.common.util import prepare_environment
+from allennlp.data import DatasetReader, DataLoader
+from allennlp.models.archival import load_archive
+
+logger = logging.getLogger(__name__)
+
+
+@Subcommand.register("build_sentence_index")
+class BuildSentenceIndex(Subcommand):
+    @overrides
+    def add_subparser(self, parser: argparse._SubParsersAction) -> argparse.ArgumentParser:
+        description = """Embed every unique context sentence of a dataset once and store the embeddings."""
+        subparser = parser.add_parser(self.name, description=description, help="Build a sentence embedding index.")
+
+        subparser.add_argument("archive_file", type=str, help="path to an archived trained model")
+        subparser.add_argument("input_file", type=str, help="path to the dataset to index")
+        subparser.add_argument("index_dir", type=str, help="directory to write the index to")
+
+        subparser.add_argument(
+            "--cuda-device", type=int, default=-1, help="id of GPU to use (if any)"
+        )
+
+        subparser.add_argument(
+            "--batch-size", type=int, default=256, help="number of sentences to embed at once"
+        )
+
+        subparser.add_argument(
+            "-o",
+            "--overrides",
+            type=str,
+            default="",
+            help="a JSON structure used to override the experiment configuration",
+        )
+
+        subparser.set_defaults(func=build_sentence_index_from_args)
+        return subparser
+
+
+def build_sentence_index_from_args(args: argparse.Namespace):
+    archive = load_archive(args.archive_file, cuda_device=args.cuda_device, overrides=args.overrides)
+    config = archive.config
+    prepare_environment(config)
+    model = archive.model
+    model.eval()
+
+    validation_dataset_reader_params = config.pop("validation_dataset_reader", None)
+    if validation_dataset_reader_params is not None:
+        dataset_reader = DatasetReader.from_params(validation_dataset_reader_params)
+    else:
+        dataset_reader = DatasetReader.from_params(config.pop("dataset_reader"))
+
+    logger.info(f"Reading sentences to index from {args.input_file}")
+    instances = dataset_reader.read(args.input_file)
+    instances.index_with(model.vocab)
+    data_loader = DataLoader(instances, batch_size=args.batch_size)
+
+    with torch.no_grad():
+        index = model.build_sentence_index(data_loader, args.index_dir, args.batch_size)
+    logger.info(f"Indexed {len(index)} unique sentences")
@@ -60,6 +60,7 @@ from allennlp.training import util as training_util
 
 from ruletaker.allennlp_models.train.custom_trainer import CustomTrainer
 from ruletaker.allennlp_models.models.replay_buffer import ReplayMemory
+from ruletaker.allennlp_models.models.inference_precision import inference_models, validation_precision_delta
 
 logger = logging.getLogger(__name__)
 
@@ -352,11 +353,16 @@ def train_model(
 
         master_addr = distributed_params.pop("master_address", "127.0.0.1")
         master_port = distributed_params.pop("master_port", 29500)
+        # gloo runs several CPU workers (cuda_devices: [-1, -1, ...]) on one box
+        backend = distributed_params.pop(
+            "backend", "nccl" if any(int(d) >= 0 for d in device_ids) else "gloo"
+        )
         num_procs = len(device_ids)
         world_size = num_nodes * num_procs
 
         logging.info(
-            f"Switching to distributed training mode since multiple GPUs are configured"
+            f"Switching to distributed training mode since multiple devices are configured "
+            f"(backend: {backend}) | "
             f"Master is at: {master_addr}:{master_port} | Rank of this node: {node_rank} | "
             f"Number of workers in this node: {num_procs} | Number of nodes: {num_nodes} | "
             f"World size: {world_size}"
@@ -395,6 +401,8 @@ def train_model(
                 master_port,
                 world_size,
                 device_ids,
+                dont_save_best_model,
+                backend,
             ),
             nprocs=num_procs,
         )
@@ -420,6 +428,7 @@ def _train_worker(
     world_size: int = 1,
     distributed_device_ids: List[str] = None,
     dont_save_best_model = False,
+    distributed_backend: str = "nccl",
 ) -> Optional[Model]:
     """
     Helper to train the configured model/experiment. In distributed mode, this is spawned as a
@@ -456,6 +465,8 @@ def _train_worker(
         The number of processes involved in distributed training.
     distributed_device_ids: `List[str]`, optional
         IDs of the devices used involved in distributed training.
+    distributed_backend: `str`, optional (default="nccl")
+        Backend of the process group, "gloo" for CPU workers.
 
     # Returns
 
@@ -502,9 +513,10 @@ def _train_worker(
         params["trainer"]["world_size"] = world_size
         params["trainer"]["distributed"] = True
 
-        torch.cuda.set_device(int(gpu_id))
+        if int(gpu_id) >= 0:
+            torch.cuda.set_device(int(gpu_id))
         dist.init_process_group(
-            backend="nccl",
+            backend=distributed_backend,
             init_method=f"tcp://{master_addr}:{master_port}",
             world_size=world_size,
             rank=global_rank,
@@ -606,6 +618,15 @@ class TrainModel(Registrable):
                 "To evaluate on the test set after training, pass the "
                 "'evaluate_on_test' flag, or use the 'allennlp evaluate' command."
             )
+
+        # Accuracy cost of the configured inference precision/quantization
+        validation_data_loader = getattr(self.trainer, '_validation_data_loader', None)
+        if validation_data_loader is not None:
+            precision_metrics = validation_precision_delta(
+                self.model, validation_data_loader, cuda_device=self.trainer.cuda_device,
+            )
+            for key, value in precision_metrics.items():
+                metrics["validation_" + key] = value
         common_util.dump_metrics(
             os.path.join(self.serialization_dir, "metrics.json"), metrics, log=False
         )
@@ -632,6 +653,10 @@ class TrainModel(Registrable):
         model: Lazy[Model] = None,
         retriever = None,
         retrieval_reasoning_model: Lazy[Model] = None,
+        inference_precision: str = 'fp32',
+        quantize_inference: bool = False,
+        replay_memory_capacity: int = 100000,
+        replay_spill_dir: str = None,
     ) -> "TrainModel":
         """
         This method is intended for use with our `FromParams` logic, to construct a `TrainModel`
@@ -696,6 +721,17 @@ class TrainModel(Registrable):
             If given, we will evaluate the final model on this data at the end of training.  Note
             that we do not recommend using this for actual test data in every-day experimentation;
             you should only very rarely evaluate your model on actual test data.
+        inference_precision: `str`, optional (default='fp32')
+            Autocast precision of the transformer QA/retriever models in eval mode: fp32, bf16,
+            fp16 or auto (bf16 on CPU, fp16 on GPUs without bf16 support).
+        quantize_inference: `bool`, optional (default=False)
+            Evaluate on CPU with int8 dynamically quantized Linear layers. When either option is
+            set, the validation accuracy with and without it is reported at the end of training.
+        replay_memory_capacity: `int`, optional (default=100000)
+            Number of trajectories kept by the replay buffer.
+        replay_spill_dir: `str`, optional (default=None)
+            If given, the replay buffer contents are saved here (relative to the serialization dir)
+            each time the buffer is full, rather than the oldest entries being dropped.
         """
 
         datasets = training_util.read_all_datasets(
@@ -729,6 +765,8 @@ class TrainModel(Registrable):
             vocab=vocabulary_,
             dataset_reader=dataset_reader,
         )
+        for m in inference_models(model_):
+            m.set_inference_mode(inference_precision, quantize_inference)
 
         # Initializing the model can have side effect of expanding the vocabulary.
         # Save the vocab only in the master. In the degenerate non-distributed
@@ -761,7 +799,9 @@ class TrainModel(Registrable):
         else:
             test_data_loader = None
 
-        replay_memory = ReplayMemory()
+        if replay_spill_dir is not None:
+            replay_spill_dir = os.path.join(serialization_dir, replay_spill_dir)
+        replay_memory = ReplayMemory(capacity=replay_memory_capacity, spill_dir=replay_spill_dir)
 
         # We don't need to pass serialization_dir and local_rank here, because they will have been
         # passed through the trainer by from_params already, because they were keyword arguments to
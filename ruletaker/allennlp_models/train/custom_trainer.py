@@ -39,6 +39,9 @@ from allennlp.training.tensorboard_writer import TensorboardWriter
 from allennlp.training.trainer import GradientDescentTrainer, Trainer, BatchCallback, EpochCallback
 
 from .utils import lrange, duplicate_list
+from .profiling import StageTimer
+from ..models.prediction_sink import set_prediction_directory, set_prediction_epoch
+from ..models.metrics_sink import configure_metrics_sink, get_metrics_sink
 
 import wandb
 
@@ -46,7 +49,9 @@ logger = logging.getLogger(__name__)
 
 @Trainer.register("custom_trainer", constructor="from_partial_objects")
 class CustomTrainer(GradientDescentTrainer):
-    def __init__(self, replay_memory, longest_proof, shortest_proof, topk, *args, **kwargs):
+    def __init__(self, replay_memory, longest_proof, shortest_proof, topk, *args,
+        profile_stages: bool = False, profiler_trace_steps: int = 0,
+        metrics_log_every: int = 100, metrics_log_background: bool = False, **kwargs):
         super().__init__(*args, **kwargs)
         self._replay_memory = replay_memory
         self._sampler = self.data_loader.batch_sampler.sampler
@@ -56,7 +61,27 @@ class CustomTrainer(GradientDescentTrainer):
         self.shortest_proof = shortest_proof
         self.topk = topk
 
+        # Opt-in per-stage timings, shared with the model so it can time its own stages
+        self._stage_timer = StageTimer(
+            enabled=profile_stages, cuda_sync=self._device.type == 'cuda', trace_steps=profiler_trace_steps
+        )
+        self.model._stage_timer = self._stage_timer
+
+        # Relative predictions_file paths are written to the serialization dir (by the master only)
+        if self._serialization_dir is not None and self._master:
+            set_prediction_directory(self.model, self._serialization_dir)
+
+        # Batch metrics of the models go to wandb (if enabled) and <serialization_dir>/metrics_log.jsonl
+        log_file = None
+        if self._serialization_dir is not None and self._master:
+            log_file = os.path.join(self._serialization_dir, 'metrics_log.jsonl')
+        configure_metrics_sink(
+            log_file, flush_every=metrics_log_every, background=metrics_log_background, wandb=self._master
+        )
+
     def _train_epoch(self, epoch: int) -> Dict[str, float]:
+        # The validation predictions of this epoch match its metrics_epoch_<epoch>.json, also on resume
+        set_prediction_epoch(self.model, epoch)
         for i in [4]:
         # for n,i in enumerate(range(self.shortest_proof, self.longest_proof+1)):
         #     print(f'\n\nBeginning epoch {n} / {self.longest_proof - self.shortest_proof}.\tProof lengths between {self.shortest_proof} - {i} \n\n')
@@ -72,11 +97,29 @@ class CustomTrainer(GradientDescentTrainer):
             if i == 1:
                 print(1)
             self._replay_memory.empty()
+        get_metrics_sink().flush()
         return retrieval_metrics
 
+    @property
+    def _device(self):
+        # cuda_device is an int or (in later allennlp versions) a torch.device
+        if isinstance(self.cuda_device, torch.device):
+            return self.cuda_device
+        return torch.device('cpu') if self.cuda_device < 0 else torch.device('cuda', self.cuda_device)
+
+    def dump_stage_timings(self, epoch, mode, batches_this_epoch):
+        ''' Write this epoch's stage timings to <serialization_dir>/stage_timings_epoch_{epoch}_{mode}.json
+        '''
+        self._stage_timer.stop_trace()
+        if self._serialization_dir is None or not self._master:
+            self._stage_timer.reset()
+            return
+        path = os.path.join(self._serialization_dir, f'stage_timings_epoch_{epoch}_{mode}.json')
+        self._stage_timer.dump(path, epoch=epoch, mode=mode, QLen=self.QLen, batches=batches_this_epoch)
+
     def set_qlen(self):
         self.data_loader.batch_sampler.req_QLens = lrange(1, self.QLen+1) #lrange(1, self.QLen+1) #[self.QLen]
-        self._pytorch_model.num_rollout_steps = self.QLen
+        self.model.num_rollout_steps = self.QLen
 
     def _train_binclass_epoch(self, epoch: int) -> Dict[str, float]:
         """ Trains one epoch and returns metrics.
@@ -94,12 +137,16 @@ class CustomTrainer(GradientDescentTrainer):
         train_reg_loss = 0.0
         # Set the model to "train" mode.
         self._pytorch_model.train()
-        self._pytorch_model.set_mode(mode)
+        self.model.set_mode(mode)
 
         # Configure sampler for binary classification task by passing the ids of the 
         # previous epochs' correctly answered questions to the sampler
-        self._sampler.samples = duplicate_list([mem['sampler_idx'] for mem in self._replay_memory], 2)      # TODO: shuffle these lists https://stackoverflow.com/questions/23289547/shuffle-two-list-at-once-with-same-order
-        psuedolabels = iter(duplicate_list([mem['topk'] for mem in self._replay_memory], 2))
+        # Each twice, for a positive and a negative binary classification sample
+        # In distributed training, each worker takes its share of all workers' questions
+        if self._distributed:
+            self._replay_memory.all_gather(shard=True)
+        self._sampler.samples = self._replay_memory.sampler_idxs(repeats=2).tolist()      # TODO: shuffle these lists https://stackoverflow.com/questions/23289547/shuffle-two-list-at-once-with-same-order
+        psuedolabels = iter(self._replay_memory.trajectories(repeats=2))
         if False:
             # # len=1
             # psuedolabels = iter(duplicate_list([[13], [3], [13], [7], [18], [4], [6], [6]], 100))
@@ -116,6 +163,9 @@ class CustomTrainer(GradientDescentTrainer):
         batch_group_generator = common_util.lazy_groups_of(
             batch_generator, self._num_gradient_accumulation_steps
         )
+        batch_group_generator = self._stage_timer.iterate(batch_group_generator, 'data_loading')
+        if self._serialization_dir is not None:
+            self._stage_timer.start_trace(os.path.join(self._serialization_dir, 'profiler_trace'))
 
         logger.info("Training")
 
@@ -147,7 +197,7 @@ class CustomTrainer(GradientDescentTrainer):
                 # data in each). If so, we can't proceed because we would hang when we hit the
                 # barrier implicit in Model.forward. We use a IntTensor instead a BoolTensor
                 # here because NCCL process groups apparently don't support BoolTensor.
-                done = torch.tensor(0, device=self.cuda_device)
+                done = torch.tensor(0, device=self._device)
                 torch.distributed.all_reduce(done, torch.distributed.ReduceOp.SUM)
                 if done.item() > 0:
                     done_early = True
@@ -175,7 +225,8 @@ class CustomTrainer(GradientDescentTrainer):
 
                 # [batch['metadata'][i]['context'].split('.')[batch['metadata'][i]['psuedolabel_retrievals'][0]].strip() == batch['metadata'][i]['question_text'].strip('.') for i in range(4)]
 
-                batch_outputs = self.batch_outputs(batch, for_training=True)
+                with self._stage_timer.span('forward'):
+                    batch_outputs = self.batch_outputs(batch, for_training=True)
                 batch_group_outputs.append(batch_outputs)
                 loss = batch_outputs["loss"]
                 reg_loss = batch_outputs["reg_loss"]
@@ -183,38 +234,41 @@ class CustomTrainer(GradientDescentTrainer):
                     raise ValueError("nan loss encountered")
                 loss = loss / len(batch_group)
                 reg_loss = reg_loss / len(batch_group)
-                if self._opt_level is not None:
-                    with amp.scale_loss(loss, self.optimizer) as scaled_loss:
-                        scaled_loss.backward()
-                else:
-                    loss.backward()
+                with self._stage_timer.span('backward'):
+                    if self._opt_level is not None:
+                        with amp.scale_loss(loss, self.optimizer) as scaled_loss:
+                            scaled_loss.backward()
+                    else:
+                        loss.backward()
                 train_loss = loss.item() * batches_this_epoch
                 train_reg_loss += reg_loss.item()
 
-            batch_grad_norm = self.rescale_gradients()
-
-            # This does nothing if batch_num_total is None or you are using a
-            # scheduler which doesn't update per batch.
-            if self._learning_rate_scheduler:
-                self._learning_rate_scheduler.step_batch(batch_num_total)
-            if self._momentum_scheduler:
-                self._momentum_scheduler.step_batch(batch_num_total)
-
-            param_updates = None
-            if self._tensorboard.should_log_histograms_this_batch() and self._master:
-                # Get the magnitude of parameter updates for logging.  We need to do some
-                # computation before and after the optimizer step, and it's expensive because of
-                # GPU/CPU copies (necessary for large models, and for shipping to tensorboard), so
-                # we don't do this every batch, only when it's requested.
-                param_updates = {
-                    name: param.detach().cpu().clone()
-                    for name, param in self.model.named_parameters()
-                }
-                self.optimizer.step()
-                for name, param in self.model.named_parameters():
-                    param_updates[name].sub_(param.detach().cpu())
-            else:
-                self.optimizer.step()
+            with self._stage_timer.span('optimizer_step'):
+                batch_grad_norm = self.rescale_gradients()
+
+                # This does nothing if batch_num_total is None or you are using a
+                # scheduler which doesn't update per batch.
+                if self._learning_rate_scheduler:
+                    self._learning_rate_scheduler.step_batch(batch_num_total)
+                if self._momentum_scheduler:
+                    self._momentum_scheduler.step_batch(batch_num_total)
+
+                param_updates = None
+                if self._tensorboard.should_log_histograms_this_batch() and self._master:
+                    # Get the magnitude of parameter updates for logging.  We need to do some
+                    # computation before and after the optimizer step, and it's expensive because of
+                    # GPU/CPU copies (necessary for large models, and for shipping to tensorboard), so
+                    # we don't do this every batch, only when it's requested.
+                    param_updates = {
+                        name: param.detach().cpu().clone()
+                        for name, param in self.model.named_parameters()
+                    }
+                    self.optimizer.step()
+                    for name, param in self.model.named_parameters():
+                        param_updates[name].sub_(param.detach().cpu())
+                else:
+                    self.optimizer.step()
+            self._stage_timer.step()
 
             # Update moving averages
             if self._moving_average is not None:
@@ -271,7 +325,7 @@ class CustomTrainer(GradientDescentTrainer):
                 f"Worker {torch.distributed.get_rank()} completed its entire epoch (training)."
             )
             # Indicate that we're done so that any workers that have remaining data stop the epoch early.
-            done = torch.tensor(1, device=self.cuda_device)
+            done = torch.tensor(1, device=self._device)
             torch.distributed.all_reduce(done, torch.distributed.ReduceOp.SUM)
             assert done.item()
 
@@ -292,6 +346,7 @@ class CustomTrainer(GradientDescentTrainer):
         metrics["cpu_memory_MB"] = peak_cpu_usage
         for (gpu_num, memory) in gpu_usage:
             metrics["gpu_" + str(gpu_num) + "_memory_MB"] = memory
+        self.dump_stage_timings(epoch, mode, batches_this_epoch)
         return metrics
 
     def _train_retrieval_epoch(self, epoch: int) -> Dict[str, float]:
@@ -311,11 +366,11 @@ class CustomTrainer(GradientDescentTrainer):
         train_reg_loss = 0.0
         # Set the model to "train" mode.
         self._pytorch_model.train()
-        self._pytorch_model.set_mode(mode)
+        self.model.set_mode(mode)
 
         # Pass the replay buffer to the model
         self._batch_sampler.set_mode(mode)
-        self._pytorch_model._replay_memory = self._replay_memory
+        self.model._replay_memory = self._replay_memory
         self.set_qlen()
         
         # Get tqdm for the training batches
@@ -323,6 +378,9 @@ class CustomTrainer(GradientDescentTrainer):
         batch_group_generator = common_util.lazy_groups_of(
             batch_generator, self._num_gradient_accumulation_steps
         )
+        batch_group_generator = self._stage_timer.iterate(batch_group_generator, 'data_loading')
+        if self._serialization_dir is not None:
+            self._stage_timer.start_trace(os.path.join(self._serialization_dir, 'profiler_trace'))
 
         logger.info("Training")
 
@@ -354,7 +412,7 @@ class CustomTrainer(GradientDescentTrainer):
                 # data in each). If so, we can't proceed because we would hang when we hit the
                 # barrier implicit in Model.forward. We use a IntTensor instead a BoolTensor
                 # here because NCCL process groups apparently don't support BoolTensor.
-                done = torch.tensor(0, device=self.cuda_device)
+                done = torch.tensor(0, device=self._device)
                 torch.distributed.all_reduce(done, torch.distributed.ReduceOp.SUM)
                 if done.item() > 0:
                     done_early = True
@@ -377,13 +435,10 @@ class CustomTrainer(GradientDescentTrainer):
             batch_group_outputs = []
             for batch in batch_group:
 
-                for m in batch['metadata']:
-                    # m['sampler_idx'] = self.data_loader.batch_sampler.batch.pop(0)
-                    m['sampler_idx'] = self._batch_sampler.batch.pop(0)
-
-                # assert all([(self.data_loader.dataset.instances[i].fields['metadata'].metadata['id'], batch['metadata'][n]['id']) for n,i in enumerate(self.data_loader.batch_sampler.batch[:4])])
+                # The metadata of each example holds its sampler_idx (set by the sampler)
 
-                batch_outputs = self.batch_outputs(batch, for_training=True)
+                with self._stage_timer.span('forward'):
+                    batch_outputs = self.batch_outputs(batch, for_training=True)
                 batch_group_outputs.append(batch_outputs)
                 loss = batch_outputs["loss"]
                 reg_loss = batch_outputs["reg_loss"]
@@ -391,38 +446,41 @@ class CustomTrainer(GradientDescentTrainer):
                     raise ValueError("nan loss encountered")
                 loss = loss / len(batch_group)
                 reg_loss = reg_loss / len(batch_group)
-                if self._opt_level is not None:
-                    with amp.scale_loss(loss, self.optimizer) as scaled_loss:
-                        scaled_loss.backward()
-                else:
-                    loss.backward()
+                with self._stage_timer.span('backward'):
+                    if self._opt_level is not None:
+                        with amp.scale_loss(loss, self.optimizer) as scaled_loss:
+                            scaled_loss.backward()
+                    else:
+                        loss.backward()
                 train_loss = loss.item() * batches_this_epoch
                 train_reg_loss += reg_loss.item()
 
-            batch_grad_norm = self.rescale_gradients()
-
-            # This does nothing if batch_num_total is None or you are using a
-            # scheduler which doesn't update per batch.
-            if self._learning_rate_scheduler:
-                self._learning_rate_scheduler.step_batch(batch_num_total)
-            if self._momentum_scheduler:
-                self._momentum_scheduler.step_batch(batch_num_total)
-
-            param_updates = None
-            if self._tensorboard.should_log_histograms_this_batch() and self._master:
-                # Get the magnitude of parameter updates for logging.  We need to do some
-                # computation before and after the optimizer step, and it's expensive because of
-                # GPU/CPU copies (necessary for large models, and for shipping to tensorboard), so
-                # we don't do this every batch, only when it's requested.
-                param_updates = {
-                    name: param.detach().cpu().clone()
-                    for name, param in self.model.named_parameters()
-                }
-                self.optimizer.step()
-                for name, param in self.model.named_parameters():
-                    param_updates[name].sub_(param.detach().cpu())
-            else:
-                self.optimizer.step()
+            with self._stage_timer.span('optimizer_step'):
+                batch_grad_norm = self.rescale_gradients()
+
+                # This does nothing if batch_num_total is None or you are using a
+                # scheduler which doesn't update per batch.
+                if self._learning_rate_scheduler:
+                    self._learning_rate_scheduler.step_batch(batch_num_total)
+                if self._momentum_scheduler:
+                    self._momentum_scheduler.step_batch(batch_num_total)
+
+                param_updates = None
+                if self._tensorboard.should_log_histograms_this_batch() and self._master:
+                    # Get the magnitude of parameter updates for logging.  We need to do some
+                    # computation before and after the optimizer step, and it's expensive because of
+                    # GPU/CPU copies (necessary for large models, and for shipping to tensorboard), so
+                    # we don't do this every batch, only when it's requested.
+                    param_updates = {
+                        name: param.detach().cpu().clone()
+                        for name, param in self.model.named_parameters()
+                    }
+                    self.optimizer.step()
+                    for name, param in self.model.named_parameters():
+                        param_updates[name].sub_(param.detach().cpu())
+                else:
+                    self.optimizer.step()
+            self._stage_timer.step()
 
             # Update moving averages
             if self._moving_average is not None:
@@ -479,7 +537,7 @@ class CustomTrainer(GradientDescentTrainer):
                 f"Worker {torch.distributed.get_rank()} completed its entire epoch (training)."
             )
             # Indicate that we're done so that any workers that have remaining data stop the epoch early.
-            done = torch.tensor(1, device=self.cuda_device)
+            done = torch.tensor(1, device=self._device)
             torch.distributed.all_reduce(done, torch.distributed.ReduceOp.SUM)
             assert done.item()
 
@@ -500,6 +558,7 @@ class CustomTrainer(GradientDescentTrainer):
         metrics["cpu_memory_MB"] = peak_cpu_usage
         for (gpu_num, memory) in gpu_usage:
             metrics["gpu_" + str(gpu_num) + "_memory_MB"] = memory
+        self.dump_stage_timings(epoch, mode, batches_this_epoch)
         return metrics
 
     # def train(self) -> Dict[str, Any]:
@@ -711,6 +770,10 @@ class CustomTrainer(GradientDescentTrainer):
         longest_proof = None, 
         shortest_proof = None, 
         topk = None, 
+        profile_stages: bool = False,
+        profiler_trace_steps: int = 0,
+        metrics_log_every: int = 100,
+        metrics_log_background: bool = False,
     ) -> "Trainer":
 
         """
@@ -788,4 +851,8 @@ class CustomTrainer(GradientDescentTrainer):
             save_best_model = save_best_model,
             num_gradient_accumulation_steps=num_gradient_accumulation_steps,
             opt_level=opt_level,
+            profile_stages=profile_stages,
+            profiler_trace_steps=profiler_trace_steps,
+            metrics_log_every=metrics_log_every,
+            metrics_log_background=metrics_log_background,
         )
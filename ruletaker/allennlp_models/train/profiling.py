@@ -0,0 +1,133 @@
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class StageTimer:
+    ''' Named wall-clock timers around the stages of a training step.
+
+        Spans are synchronized with the GPU (when cuda_sync is set) so that
+        asynchronous kernels are attributed to the stage that launched them.
+        Durations are kept per stage until reset(), and summarized as
+        count / total / mean / p50 / p95 tables. A disabled timer is a no-op.
+
+        Optionally records a torch.profiler trace of the first
+        `trace_steps` steps (after one wait and one warmup step), with each
+        span marked as a record_function so the stages show up in the trace.
+    '''
+    def __init__(self, enabled: bool = False, cuda_sync: bool = False, trace_steps: int = 0):
+        self.enabled = enabled
+        self.cuda_sync = cuda_sync and torch.cuda.is_available()
+        self.trace_steps = trace_steps
+        self._durations = {}
+        self._profiler = None
+        self._traced = False
+
+    def _sync(self):
+        if self.cuda_sync:
+            torch.cuda.synchronize()
+
+    @contextmanager
+    def span(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        record = torch.autograd.profiler.record_function(name) if self._profiler is not None else None
+        if record is not None:
+            record.__enter__()
+        try:
+            self._sync()
+            start = time.perf_counter()
+            yield
+            # Spans which raise (including a StopIteration in iterate) are not recorded
+            self._sync()
+            self._durations.setdefault(name, []).append(time.perf_counter() - start)
+        finally:
+            if record is not None:
+                record.__exit__(None, None, None)
+
+    def iterate(self, iterable, name):
+        ''' Yields from iterable, timing each next() call as a span.
+        '''
+        iterator = iter(iterable)
+        while True:
+            try:
+                with self.span(name):
+                    item = next(iterator)
+            except StopIteration:
+                return
+            yield item
+
+    def summary(self):
+        table = {}
+        for name, durations in self._durations.items():
+            ms = np.array(durations) * 1000
+            table[name] = {
+                'count': len(ms),
+                'total_s': float(ms.sum() / 1000),
+                'mean_ms': float(ms.mean()),
+                'p50_ms': float(np.percentile(ms, 50)),
+                'p95_ms': float(np.percentile(ms, 95)),
+            }
+        return table
+
+    def reset(self):
+        self._durations = {}
+
+    def dump(self, path, **extra):
+        ''' Write the summary (and any extra fields) to a JSON file, log it
+            and reset the timers.
+        '''
+        if not self.enabled:
+            return None
+        summary = self.summary()
+        with open(path, 'w') as f:
+            json.dump({**extra, 'stages': summary}, f, indent=2)
+
+        lines = [f"{'stage':<20}{'count':>8}{'total_s':>10}{'p50_ms':>10}{'p95_ms':>10}"]
+        for name, row in sorted(summary.items(), key=lambda kv: -kv[1]['total_s']):
+            lines.append(f"{name:<20}{row['count']:>8}{row['total_s']:>10.2f}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}")
+        logger.info("Stage timings (%s):\n%s", path, '\n'.join(lines))
+
+        self.reset()
+        return summary
+
+    def start_trace(self, trace_dir):
+        ''' Start a torch.profiler trace written to trace_dir (viewable with
+            tensorboard). Call step() after every training step. Only the
+            first call starts a trace.
+        '''
+        if not self.enabled or not self.trace_steps or self._traced:
+            return
+        if not hasattr(torch, 'profiler'):
+            raise ValueError("profiler_trace_steps requires torch.profiler (torch >= 1.8).\nInvestigate!")
+        os.makedirs(trace_dir, exist_ok=True)
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=1, warmup=1, active=self.trace_steps, repeat=1),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+            record_shapes=True,
+            profile_memory=True,
+        )
+        self._profiler.__enter__()
+        self._traced = True
+
+    def step(self):
+        if self._profiler is not None:
+            self._profiler.step()
+
+    def stop_trace(self):
+        if self._profiler is not None:
+            self._profiler.__exit__(None, None, None)
+            self._profiler = None
@@ -45,7 +45,9 @@ class ResultsProcessor():
 
         # Add proof depth for each prediction
         # There are multiple predictions per question (one per epoch)
-        preds = self.scores[self.best_idx]['validation_predictions']
+        preds = self.scores[self.best_idx].get('validation_predictions')
+        if preds is None:
+            preds = self.load_predictions(self.best_idx)
         self.preds = {}
         for pred in preds:
             qid = pred['id']
@@ -55,6 +57,16 @@ class ResultsProcessor():
                 self.preds[qid] = pred
 
 
+    def load_predictions(self, metrics_path, predictions_file='predictions.jsonl'):
+        ''' Predictions streamed by the model's prediction sink in the same
+            epoch as metrics_path (predictions_file is the model's setting).
+        '''
+        epoch = metrics_path.split('_')[-1].split('.')[0]
+        root, ext = os.path.splitext(predictions_file)
+        with open(os.path.join(self.dir, f'{root}_epoch_{epoch}{ext}'), 'r') as f:
+            return [json.loads(line) for line in f]
+
+
 class ResultsAnalyzer(ResultsProcessor):
     def __init__(self, *args):
         super().__init__(*args)
@@ -0,0 +1,120 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+pytest.importorskip("ruletaker.allennlp_models")
+batch_encoding = pytest.importorskip("ruletaker.allennlp_models.dataset_readers.batch_encoding")
+
+PAD = 1
+
+
+class Tokenizer:
+    ''' Unpadded batch_encode_plus as in transformers 2.x: <s> a </s> and
+        <s> a </s></s> b </s>, with (RoBERTa) all-zero type ids.
+    '''
+    pad_token_id = PAD
+
+    def __init__(self):
+        self.calls = 0
+
+    def encode(self, text):
+        if isinstance(text, tuple):
+            a, b = text
+            return [0] + self.ids(a) + [2, 2] + self.ids(b) + [2]
+        return [0] + self.ids(text) + [2]
+
+    @staticmethod
+    def ids(text):
+        return [len(word) + 3 for word in text.split()]
+
+    def batch_encode_plus(self, texts, add_special_tokens, max_length, return_token_type_ids):
+        self.calls += 1
+        input_ids = [self.encode(text)[:max_length] for text in texts]
+        return {'input_ids': input_ids, 'token_type_ids': [[0] * len(ids) for ids in input_ids]}
+
+
+def test_encode_texts_pads_each_text_as_the_indexer_would():
+    tokenizer = Tokenizer()
+    texts = ['a bb', ('ccc', 'd'), 'e']
+    rows = batch_encoding.encode_texts(tokenizer, texts, max_length=16)
+    assert tokenizer.calls == 1
+    max_len = max(len(tokenizer.encode(text)) for text in texts)
+    for i, text in enumerate(texts):
+        ids = tokenizer.encode(text)
+        assert rows['token_ids'][i].tolist() == ids + [PAD] * (max_len - len(ids))
+        assert rows['mask'][i].tolist() == [True] * len(ids) + [False] * (max_len - len(ids))
+    assert rows['type_ids'].eq(0).all()
+
+
+def test_pad_ids_keeps_type_ids_and_handles_no_rows():
+    rows = batch_encoding.pad_ids([[5, 6, 7], [8]], [[0, 1, 1], [1]], pad_idx=0)
+    assert rows['token_ids'].tolist() == [[5, 6, 7], [8, 0, 0]]
+    assert rows['type_ids'].tolist() == [[0, 1, 1], [1, 0, 0]]
+    empty = batch_encoding.pad_ids([], None, pad_idx=0)
+    assert empty['token_ids'].shape == (0, 0)
+
+
+def test_group_rows_pads_missing_rows_as_a_list_field():
+    rows = batch_encoding.pad_ids([[5, 6], [7], [8, 9]], None, pad_idx=PAD)
+    grouped = batch_encoding.group_rows(rows, [2, 0, 1], pad_idx=PAD)
+    assert grouped['token_ids'].tolist() == [
+        [[5, 6], [7, PAD]],
+        [[PAD, PAD], [PAD, PAD]],
+        [[8, 9], [PAD, PAD]],
+    ]
+    assert grouped['mask'].tolist() == [
+        [[True, True], [True, False]],
+        [[False, False], [False, False]],
+        [[True, True], [False, False]],
+    ]
+
+
+def reader_module():
+    return pytest.importorskip("ruletaker.allennlp_models.dataset_readers.retrieval_reasoning_reader")
+
+
+def reader(concat):
+    tokenizer = Tokenizer()
+    reader = SimpleNamespace(
+        _retriever_variant='roberta-base', _concat=concat, _max_pieces=32, _add_prefix=None,
+        _tokenizer_retriever_internal=tokenizer, _tokenizer_qamodel_internal=tokenizer,
+        pad_idx=lambda mode: PAD,
+    )
+    reader._encode_qa_pairs = lambda pairs, pad_idx=None: \
+        reader_module().RetrievalReasoningReader._encode_qa_pairs(reader, pairs, pad_idx)
+    return reader
+
+
+def test_retrieval_rows_split_question_and_context_into_sentences():
+    rr = reader_module()
+    r = reader(concat=False)
+    sentences = [('Is a b.', '', 'A b. C dd.'), ('Is e.', '', 'E f.')]
+    rows = rr.RetrievalReasoningReader.retrieval_rows(r, sentences)
+    assert r._tokenizer_retriever_internal.calls == 1
+    assert rows['token_ids'].shape[:2] == (2, 3)
+    expected = [['Is a b.', ' A b.', ' C dd.'], ['Is e.', ' E f.']]
+    for b, items in enumerate(expected):
+        for i, item in enumerate(items):
+            ids = Tokenizer().encode(item)
+            assert rows['token_ids'][b, i, :len(ids)].tolist() == ids
+    assert not rows['mask'][1, 2].any()
+
+
+def test_retrieval_rows_concat_each_candidate_to_the_retrieved_sentences():
+    rr = reader_module()
+    r = reader(concat=True)
+    rows = rr.RetrievalReasoningReader.retrieval_rows(r, [('Is a b.', 'C dd.', 'A b. C dd.')])
+    for i, candidate in enumerate(['A b.', 'C dd.']):
+        ids = Tokenizer().encode(('Is a b.', 'C dd. ' + candidate))
+        assert rows['token_ids'][0, i, :len(ids)].tolist() == ids
+
+
+def test_batch_encode_labels_and_metadata():
+    rr = reader_module()
+    r = reader(concat=False)
+    batch = rr.RetrievalReasoningReader.batch_encode(r, [('Is a b.', 'A b.', torch.tensor(1)), ('Is e.', 'E f.', 0)])
+    assert batch['label'].tolist() == [1, 0]
+    assert [m['context'] for m in batch['metadata']] == ['A b.', 'E f.']
+    ids = Tokenizer().encode(('Is e.', 'E f.'))
+    assert batch['phrase']['tokens']['token_ids'][1, :len(ids)].tolist() == ids
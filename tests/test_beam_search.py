@@ -0,0 +1,82 @@
+import itertools
+
+import pytest
+import torch
+
+pytest.importorskip("ruletaker.allennlp_models")
+beam_search = pytest.importorskip("ruletaker.allennlp_models.models.beam_search")
+
+INF = float('inf')
+
+
+def test_duplicate_subsets_are_merged_into_their_best():
+    scores = torch.tensor([[-1., -2., -0.5, -3., -2.]])
+    keys = torch.tensor([[7, 8, 7, 9, 8]])
+    merged = beam_search.merge_duplicate_subsets(scores, keys)
+
+    expected = torch.tensor([[
+        -INF,
+        torch.logsumexp(torch.tensor([-2., -2.]), 0),      # The first of equal bests
+        torch.logsumexp(torch.tensor([-1., -0.5]), 0),
+        -3.,
+        -INF,
+    ]])
+    assert torch.allclose(merged, expected)
+
+
+def test_merging_keeps_unique_and_impossible_hypotheses():
+    scores = torch.tensor([[-1., -INF, -2.], [-INF, -INF, -1.]])
+    keys = torch.tensor([[1, 2, 3], [4, 4, 5]])
+    merged = beam_search.merge_duplicate_subsets(scores, keys)
+    assert torch.equal(merged, torch.tensor([[-1., -INF, -2.], [-INF, -INF, -1.]]))
+
+
+def test_subset_keys_do_not_depend_on_order():
+    weights = beam_search.subset_weights(6)
+    assert torch.equal(weights, beam_search.subset_weights(6))
+    sums = {frozenset(s): int(weights[list(s)].sum()) for s in itertools.combinations(range(6), 3)}
+    assert len(set(sums.values())) == len(sums)
+
+
+def log_probs_given(table, history):
+    ''' Log-probs of retrieving each sentence next, given the retrieved ones. '''
+    logits = table.clone()
+    logits[history] = -INF
+    return logits.log_softmax(-1)
+
+
+def test_wide_beam_finds_the_exact_subset_probabilities():
+    torch.manual_seed(0)
+    n, steps = 4, 2
+    table = torch.randn(n)
+    weights = beam_search.subset_weights(n)
+
+    scores, keys = torch.zeros(1, 1), torch.zeros(1, 1, dtype=torch.long)
+    history = torch.zeros(1, 1, 0, dtype=torch.long)
+    for t in range(steps):
+        log_probs = torch.stack([log_probs_given(table, h) for h in history[0].tolist()]).unsqueeze(0)
+        scores, keys, parents, actions = beam_search.beam_step(scores, keys, log_probs, weights, beam_size=n * n)
+        history = torch.cat([history.gather(1, parents.unsqueeze(-1).expand(-1, -1, t)), actions.unsqueeze(-1)], -1)
+
+    beams = {
+        frozenset(h): s for h, s in zip(history[0].tolist(), scores[0].tolist()) if s > -INF
+    }
+    # One beam per subset, scored with the probability of all its orders
+    assert len(beams) == 6
+    for subset, score in beams.items():
+        a, b = sorted(subset)
+        exact = torch.logsumexp(torch.stack([
+            log_probs_given(table, [])[a] + log_probs_given(table, [a])[b],
+            log_probs_given(table, [])[b] + log_probs_given(table, [b])[a],
+        ]), 0)
+        assert abs(score - float(exact)) < 1e-5
+    assert scores[0, 0] == max(beams.values())
+
+
+def test_best_beam_rows_are_the_best_candidates_of_their_parents():
+    bsz, b, n, seq_len = 2, 3, 4, 5
+    rows = torch.arange(bsz * b * n * seq_len).view(bsz, b, n, seq_len)
+    parents = torch.tensor([[2, 0], [1, 1]])
+    actions = torch.tensor([[3, 1], [0, 2]])
+    q = beam_search.best_beam_rows(rows, parents, actions)
+    assert torch.equal(q, torch.stack([rows[0, 2, 3], rows[1, 1, 0]]))
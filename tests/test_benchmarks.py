@@ -0,0 +1,30 @@
+from benchmarks import run, synthetic
+
+
+def test_examples_hold_their_proof_chain():
+    examples = synthetic.make_examples(20, n_sentences=8, proof_length=3)
+    assert [e['context'] for e in examples] == [e['context'] for e in synthetic.make_examples(20, 8, 3)]
+    for example in examples:
+        sentences = [s + '.' for s in example['context'].split('.')[:-1]]
+        assert len(sentences) == 8
+        assert len(example['node_label']) == len(sentences) + 1
+        assert example['qlen'] == 3 and example['qdep'] == 2
+        # Proof sentences are only labelled when the question is true
+        assert example['node_label'][:-1].sum() == 3 * example['label']
+        assert example['node_label'][-1] == 1 - example['label']
+
+
+def test_compare_flags_slowdowns_and_memory_growth_past_the_tolerance():
+    baseline = {
+        'a': {'examples_per_sec': 10., 'peak_memory_delta_mb': 100.},
+        'b': {'examples_per_sec': 10., 'peak_memory_delta_mb': 100.},
+    }
+    results = {
+        'a': {'examples_per_sec': 9.5, 'peak_memory_delta_mb': 105.},
+        'b': {'examples_per_sec': 8., 'peak_memory_delta_mb': 120.},
+        'new': {'examples_per_sec': 1., 'peak_memory_delta_mb': 1000.},
+    }
+    assert run.compare(results, baseline, tolerance=0.1) == [
+        ('b', 'examples_per_sec', 8., 10.),
+        ('b', 'peak_memory_delta_mb', 120., 100.),
+    ]
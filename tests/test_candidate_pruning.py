@@ -0,0 +1,84 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+pytest.importorskip("ruletaker.allennlp_models")
+candidate_pruning = pytest.importorskip("ruletaker.allennlp_models.models.candidate_pruning")
+
+PAD = 1
+PREFIX = [0, 10, 11, 2]     # <s> question </s>
+
+
+def make_rows(candidates, seq_len=9):
+    rows = torch.full((1, len(candidates), seq_len), PAD, dtype=torch.long)
+    for n, candidate in enumerate(candidates):
+        if candidate is not None:
+            row = PREFIX + candidate + [2]
+            rows[0, n, :len(row)] = torch.tensor(row)
+    return rows
+
+
+def reference_scores(candidates):
+    ''' Query tokens of each candidate, weighted by 1 / # candidates they occur in. '''
+    suffixes = [set(c + [2]) if c is not None else set() for c in candidates]
+    scores = []
+    for c, suffix in zip(candidates, suffixes):
+        if c is None:
+            scores.append(-float('inf'))
+            continue
+        scores.append(sum(
+            1 / sum(token in s for s in suffixes) for token in c + [2] if token in PREFIX
+        ))
+    return scores
+
+
+CANDIDATES = [[10, 20], [30, 31], [10, 11, 21], None, [11, 11]]
+
+
+def test_scores_match_the_reference():
+    scores = candidate_pruning.lexical_overlap_scores(make_rows(CANDIDATES), PAD)
+    assert scores[0].tolist() == pytest.approx(reference_scores(CANDIDATES))
+
+
+def test_pruning_keeps_the_highest_scores():
+    keep = candidate_pruning.prune_candidates(make_rows(CANDIDATES), PAD, topk=2)
+    assert sorted(keep[0].tolist()) == [2, 4]
+
+
+def test_ties_keep_the_earlier_candidate():
+    candidates = [[30], [10], [31], [11], [32], [12]]
+    for topk in range(1, 6):
+        keep = candidate_pruning.prune_candidates(make_rows(candidates), PAD, topk=topk)
+        scores = reference_scores(candidates)
+        ranked = sorted(range(len(candidates)), key=lambda i: (-scores[i], i))
+        assert sorted(keep[0].tolist()) == sorted(ranked[:topk])
+
+
+def test_pruned_candidates_are_not_scored():
+    gumbel_softmax = pytest.importorskip("ruletaker.allennlp_models.models.gumbel_softmax")
+    recalls = []
+    model = SimpleNamespace(
+        _prune_topk=2, retriever_pad_idx=PAD,
+        update_prune_recall=lambda qr, meta, keep: recalls.append(keep),
+    )
+    rows = make_rows(CANDIDATES)
+    scored = []
+    score_fn = lambda r: scored.append(r) or r[..., 4].float()
+
+    scores = gumbel_softmax.GumbelSoftmaxRetrieverReasoner.score_candidates(model, rows, [{}], score_fn)
+    assert scored[0].shape == (1, 2, rows.size(-1))
+    assert scores[0].tolist() == [-float('inf'), -float('inf'), 10., -float('inf'), 11.]
+    assert len(recalls) == 1
+
+
+def test_candidate_frequency_matches_the_pairwise_count():
+    torch.manual_seed(0)
+    suffix = torch.randint(0, 6, (3, 5, 7))
+    suffix_mask = torch.rand(3, 5, 7) > 0.3
+    same = (suffix[:, :, :, None, None] == suffix[:, None, None, :, :]) & suffix_mask[:, None, None, :, :]
+    expected = same.any(-1).sum(-1) * suffix_mask
+
+    df = candidate_pruning.candidate_frequency(suffix, suffix_mask)
+    assert df.tolist() == expected.tolist()
+    assert candidate_pruning.candidate_frequency(suffix[..., :0], suffix_mask[..., :0]).shape == (3, 5, 0)
@@ -0,0 +1,193 @@
+import pickle
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("ruletaker.allennlp_models")
+context_store = pytest.importorskip("ruletaker.allennlp_models.dataset_readers.context_store")
+
+
+class Builder:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return [self.calls]
+
+
+def test_values_are_built_once_per_context_and_shared():
+    store = context_store.ContextStore()
+    build = Builder()
+    first = store.get('c1', 'tokens', build)
+    assert store.get('c1', 'tokens', build) is first
+    assert store.get('c1', 'fields', build) is not first
+    assert store.get('c2', 'tokens', build) is not first
+    assert build.calls == 3
+    assert (store.hits, store.misses) == (1, 3)
+    assert len(store) == 2
+
+
+def test_least_recently_used_context_is_evicted():
+    store = context_store.ContextStore(max_contexts=2)
+    build = Builder()
+    a = store.get('a', 'tokens', build)
+    store.get('b', 'tokens', build)
+    store.get('a', 'tokens', build)
+    store.get('c', 'tokens', build)     # Evicts b
+    assert len(store) == 2
+    assert store.get('a', 'tokens', build) is a
+    store.get('b', 'tokens', build)
+    assert build.calls == 4
+
+
+def test_max_contexts_zero_disables_sharing():
+    store = context_store.ContextStore(max_contexts=0)
+    build = Builder()
+    assert store.get('a', 'tokens', build) != store.get('a', 'tokens', build)
+    assert len(store) == 0
+
+
+def test_pickled_copies_start_empty():
+    store = context_store.ContextStore(max_contexts=3)
+    store.get('a', 'tokens', Builder())
+    copy = pickle.loads(pickle.dumps(store))
+    assert len(copy) == 0 and len(store) == 1
+    build = Builder()
+    copy.get('a', 'tokens', build)
+    assert build.calls == 1
+
+
+def reader_module():
+    return pytest.importorskip("ruletaker.allennlp_models.dataset_readers.retrieval_reasoning_reader")
+
+
+class Tokenizer:
+    def __init__(self):
+        self.calls = []
+
+    def tokenize(self, text):
+        self.calls.append(text)
+        return text.split()
+
+
+def test_context_sentences_are_tokenized_once_per_context():
+    rr = reader_module()
+    reader = SimpleNamespace(_concat=False, _context_store=context_store.ContextStore())
+    reader._num_context_items = lambda q, c: rr.RetrievalReasoningReader._num_context_items(reader, q, c)
+    tokenizer = Tokenizer()
+    context = 'The cat is red. The dog is blue.'
+
+    first = rr.RetrievalReasoningReader.listfield_features_from_qa(reader, 'Is the cat red.', context, '', tokenizer)
+    second = rr.RetrievalReasoningReader.listfield_features_from_qa(reader, 'Is the dog red.', context, '', tokenizer)
+    # Same items as tokenizing the question + context split on full stops
+    assert first == [t.split() for t in ['Is the cat red.', 'The cat is red.', ' The dog is blue.']]
+    assert second[1:] == first[1:] and second[1] is first[1]
+    assert tokenizer.calls == ['Is the cat red.', 'The cat is red.', ' The dog is blue.', 'Is the dog red.']
+
+
+def test_exact_match_is_the_first_matching_sentence():
+    rr = reader_module()
+    reader = SimpleNamespace(_context_store=context_store.ContextStore())
+    context = 'A is b. C is d. A is b.'
+    assert rr.RetrievalReasoningReader._get_exact_match(reader, 'A is b.', context) == 0
+    assert rr.RetrievalReasoningReader._get_exact_match(reader, 'C is d.', context) == 1
+    assert rr.RetrievalReasoningReader._get_exact_match(reader, 'E is f.', context) == -1
+
+
+class WordPieces:
+    ''' Word-level stand-in for a qa model tokenizer: a word after a space
+        is a different token (as RoBERTa's "Ġ"), the pair layout is RoBERTa's
+        or BERT's.
+    '''
+    def __init__(self, bert=False):
+        self.bert = bert
+        self.vocab = {'<s>': 0, '</s>': 2}
+        self.encoded = []
+
+    def encode(self, text, add_special_tokens=False):
+        self.encoded.append(text)
+        words = [('Ġ' if n or text[:1].isspace() else '') + w for n, w in enumerate(text.split())]
+        return [self.vocab.setdefault(w, len(self.vocab) + 3) for w in words]
+
+    def convert_ids_to_tokens(self, ids):
+        inverse = {i: w for w, i in self.vocab.items()}
+        return inverse[ids] if isinstance(ids, int) else [inverse[i] for i in ids]
+
+    def build_inputs_with_special_tokens(self, ids, pair_ids):
+        if self.bert:
+            return [0] + ids + [2] + pair_ids + [2]
+        return [0] + ids + [2, 2] + pair_ids + [2]
+
+    def create_token_type_ids_from_sequences(self, ids, pair_ids):
+        if self.bert:
+            return [0] * (len(ids) + 2) + [1] * (len(pair_ids) + 1)
+        return [0] * len(self.build_inputs_with_special_tokens(ids, pair_ids))
+
+
+class PairTokenizer:
+    ''' tokenize_sentence_pair as the pretrained transformer tokenizer runs
+        it: encode_plus with each segment prefixed by a space, truncated
+        longest first to max_length.
+    '''
+    def __init__(self, tokenizer, max_length):
+        self.tokenizer, self.max_length = tokenizer, max_length
+
+    def tokenize_sentence_pair(self, question, context):
+        from allennlp.data.tokenizers import Token
+        ids = self.tokenizer.encode(' ' + question)
+        pair_ids = self.tokenizer.encode(' ' + context)
+        specials = len(self.tokenizer.build_inputs_with_special_tokens([], []))
+        for _ in range(max(len(ids) + len(pair_ids) + specials - self.max_length, 0)):
+            if len(ids) > len(pair_ids):
+                ids = ids[:-1]
+            else:
+                pair_ids = pair_ids[:-1]
+        input_ids = self.tokenizer.build_inputs_with_special_tokens(ids, pair_ids)
+        type_ids = self.tokenizer.create_token_type_ids_from_sequences(ids, pair_ids)
+        return [
+            Token(text=self.tokenizer.convert_ids_to_tokens(i), text_id=i, type_id=t)
+            for i, t in zip(input_ids, type_ids)
+        ]
+
+
+def concat_reader(bert=False, max_pieces=32, add_prefix=None):
+    rr = reader_module()
+    tokenizer = WordPieces(bert)
+    reader = SimpleNamespace(
+        _concat=True, _max_pieces=max_pieces, _add_prefix=add_prefix, _context_store=context_store.ContextStore(),
+        _tokenizer_qamodel_internal=tokenizer, _tokenizer_qamodel=PairTokenizer(tokenizer, max_pieces),
+    )
+    for name in ['_concat_features', '_pair_template', '_segment_tokens', 'transformer_features_from_qa']:
+        setattr(reader, name, getattr(rr.RetrievalReasoningReader, name).__get__(reader))
+    return rr, reader
+
+
+def as_tuples(rows):
+    return [[(t.text, t.text_id, t.type_id) for t in row] for row in rows]
+
+
+@pytest.mark.parametrize('bert', [False, True])
+@pytest.mark.parametrize('max_pieces', [32, 11, 8])
+@pytest.mark.parametrize('add_prefix', [None, {'q': 'Q: ', 'c': 'C: '}])
+def test_concat_rows_match_tokenizing_each_pair(bert, max_pieces, add_prefix):
+    rr, reader = concat_reader(bert, max_pieces, add_prefix)
+    question, context = 'Is the big cat red.', 'The cat is red. The big dog is not very blue. Cats chase dogs.'
+    shared = rr.RetrievalReasoningReader.listfield_features_from_qa(reader, question, context, '', None)
+    expected = [
+        reader.transformer_features_from_qa(question, toks.strip() + '.')[0] for toks in context.split('.')[:-1]
+    ]
+    assert as_tuples(shared) == as_tuples(expected)
+
+
+def test_concat_sentences_are_tokenized_once_per_context():
+    rr, reader = concat_reader()
+    context = 'The cat is red. The dog is blue.'
+    first = rr.RetrievalReasoningReader.listfield_features_from_qa(reader, 'Is the cat red.', context, '', None)
+    encoded = list(reader._tokenizer_qamodel_internal.encoded)
+    second = rr.RetrievalReasoningReader.listfield_features_from_qa(reader, 'Is the dog red.', context, '', None)
+    # Only the new question is tokenized
+    assert reader._tokenizer_qamodel_internal.encoded[len(encoded):] == [' Is the dog red.']
+    # Sentence tokens are the same objects in every question's rows
+    assert first[1][-2] is second[1][-2]
+    assert [t.text for t in second[1]] == ['<s>', 'ĠIs', 'Ġthe', 'Ġdog', 'Ġred.', '</s>', '</s>', 'ĠThe', 'Ġdog', 'Ġis', 'Ġblue.', '</s>']
@@ -0,0 +1,68 @@
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+pytest.importorskip("ruletaker.allennlp_models")
+replay_buffer = pytest.importorskip("ruletaker.allennlp_models.models.replay_buffer")
+sampler = pytest.importorskip("ruletaker.allennlp_models.dataset_readers.sampler")
+
+if not dist.is_available():
+    pytest.skip("torch.distributed is not available", allow_module_level=True)
+
+WORLD_SIZE = 2
+
+
+def _worker(rank, init_file, counts, results):
+    dist.init_process_group('gloo', init_method=f'file://{init_file}', rank=rank, world_size=WORLD_SIZE)
+    try:
+        memory = replay_buffer.ReplayMemory(capacity=8, max_trajectory_len=3)
+        for n in range(counts[rank]):
+            memory.push({'sampler_idx': 10 * rank + n, 'topk': list(range(n % 3 + 1))}, priority=1. + n)
+
+        gathered = replay_buffer.ReplayMemory(capacity=8, max_trajectory_len=3)
+        for entry in memory:
+            gathered.push(entry, priority=entry['priority'])
+        gathered.all_gather()
+
+        memory.all_gather(shard=True)
+        results.put((
+            rank,
+            [(e['sampler_idx'], e['topk'], e['priority']) for e in gathered],
+            [(e['sampler_idx'], e['topk'], e['priority']) for e in memory],
+            sampler.shard(list(range(5))),
+        ))
+    finally:
+        dist.destroy_process_group()
+
+
+def run_workers(tmp_path, counts):
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    mp.spawn(_worker, args=(str(tmp_path / 'init'), counts, results), nprocs=WORLD_SIZE)
+    return dict((r[0], r[1:]) for r in (results.get(timeout=60) for _ in range(WORLD_SIZE)))
+
+
+def entries(rank, count):
+    return [(10 * rank + n, list(range(n % 3 + 1)), 1. + n) for n in range(count)]
+
+
+@pytest.mark.parametrize('counts', [(3, 2), (3, 0)])
+def test_all_gather_shards_evenly_across_gloo_workers(tmp_path, counts):
+    results = run_workers(tmp_path, counts)
+    everything = entries(0, counts[0]) + entries(1, counts[1])
+
+    for rank in range(WORLD_SIZE):
+        gathered, shard, _ = results[rank]
+        # Every worker gathers all entries, in rank order
+        assert gathered == everything
+
+        # Equal shards, padded by wrapping around, which cover every entry
+        total = -(-len(everything) // WORLD_SIZE) * WORLD_SIZE
+        assert shard == [everything[i % len(everything)] for i in range(rank, total, WORLD_SIZE)]
+
+
+def test_sampler_shards_evenly_across_gloo_workers(tmp_path):
+    results = run_workers(tmp_path, (1, 1))
+    shards = [results[rank][2] for rank in range(WORLD_SIZE)]
+    assert shards == [[0, 2, 4], [1, 3, 0]]
@@ -0,0 +1,76 @@
+import os
+
+import pytest
+import torch
+from torch import nn
+
+pytest.importorskip("ruletaker.allennlp_models")
+inference_precision = pytest.importorskip("ruletaker.allennlp_models.models.inference_precision")
+prediction_sink = pytest.importorskip("ruletaker.allennlp_models.models.prediction_sink")
+metrics_sink = pytest.importorskip("ruletaker.allennlp_models.models.metrics_sink")
+
+CPU, CUDA = torch.device('cpu'), torch.device('cuda')
+
+
+def test_autocast_dtypes():
+    assert inference_precision.autocast_dtype('fp32', CPU) is None
+    assert inference_precision.autocast_dtype('bf16', CPU) == torch.bfloat16
+    assert inference_precision.autocast_dtype('fp16', CUDA) == torch.float16
+    assert inference_precision.autocast_dtype('auto', CPU) == torch.bfloat16
+
+
+def test_old_torch_falls_back_to_cuda_amp(monkeypatch):
+    monkeypatch.delattr(torch, 'autocast', raising=False)
+    assert inference_precision.autocast_dtype('auto', CPU) is None
+    assert inference_precision.autocast_dtype('auto', CUDA) == torch.float16
+    assert isinstance(inference_precision.autocast('fp16', CUDA), torch.cuda.amp.autocast)
+    with pytest.raises(ValueError):
+        inference_precision.autocast('bf16', CPU)
+
+
+class QA(nn.Module):
+    def __init__(self, path):
+        super().__init__()
+        self._prediction_sink = prediction_sink.PredictionSink(path)
+        self.set_inference_mode('bf16', False)
+
+    def set_inference_mode(self, precision, quantize):
+        self._inference_precision, self._quantize_inference = precision, quantize
+
+
+class Model(nn.Module):
+    def __init__(self, path):
+        super().__init__()
+        self.qa_model = QA(path)
+        # Shared with the qa model, as in the retrieval models
+        self._prediction_sink = self.qa_model._prediction_sink
+
+
+def test_precision_passes_write_no_predictions_or_metrics(tmp_path, monkeypatch):
+    model = Model(str(tmp_path / 'predictions.jsonl'))
+    prediction_sink.set_prediction_epoch(model, 0)
+    logged = []
+    sink = metrics_sink.configure_metrics_sink(str(tmp_path / 'metrics.jsonl'), flush_every=1)
+    monkeypatch.setattr(sink, 'log', lambda metrics, commit=True: logged.append(metrics))
+
+    def evaluate(model, data_loader, cuda_device=-1):
+        qa = model.qa_model
+        qa._prediction_sink.write(
+            [{}], torch.zeros(1, 2), torch.full((1, 2), .5), torch.zeros(1, dtype=torch.long), lambda e, p: {}
+        )
+        qa._prediction_sink.close()
+        metrics_sink.get_metrics_sink().log({'val_loss': 1.})
+        return {'EM': 1. if qa._inference_precision == 'fp32' else .75}
+
+    monkeypatch.setattr('allennlp.training.util.evaluate', evaluate)
+    results = inference_precision.validation_precision_delta(model, data_loader=None)
+
+    assert results['fp32_EM'] == 1. and results['inference_EM'] == .75
+    assert results['inference_EM_delta'] == -.25
+    assert model.qa_model._inference_precision == 'bf16'
+    assert os.listdir(tmp_path) == ['metrics.jsonl'] and logged == []
+    # The sink is re-enabled for the epoch's validation pass
+    assert model._prediction_sink.enabled
+    assert model._prediction_sink.current_path().endswith('predictions_epoch_0.jsonl')
+    assert metrics_sink.get_metrics_sink() is sink
+    metrics_sink.configure_metrics_sink()
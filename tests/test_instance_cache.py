@@ -0,0 +1,145 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip("ruletaker.allennlp_models")
+instance_cache = pytest.importorskip("ruletaker.allennlp_models.dataset_readers.instance_cache")
+from allennlp.data.tokenizers import Token
+
+FIELDS = {
+    'phrase': instance_cache.TOKENS,
+    'retrieval': instance_cache.TOKEN_LISTS,
+    'rollout_prefix': instance_cache.ARRAY,
+    'rollout_sentences': instance_cache.ARRAY_ROWS,
+}
+
+
+class Vocab:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, ids):
+        self.calls += 1
+        return [f'tok{i}' for i in ids]
+
+
+def tokens(ids, type_id=0):
+    return [Token(text=f'tok{i}', text_id=i, type_id=type_id) for i in ids]
+
+
+def instances():
+    yield {'item_id': 'a', 'label': True}, {
+        'phrase': tokens([0, 5, 6, 2], type_id=1),
+        'retrieval': [tokens([0, 7, 2]), tokens([0, 8, 9, 2])],
+        'rollout_prefix': np.array([0, 5, 2, 2]),
+        'rollout_sentences': np.array([[7, 1], [8, 9]]),
+    }
+    yield {'item_id': 'b', 'label': False}, {'phrase': tokens([0, 3, 2]), 'retrieval': []}
+
+
+def write(cache, items):
+    writer = cache.writer(FIELDS)
+    try:
+        for record, toks in items:
+            writer.add(record, toks)
+        writer.finalize()
+    finally:
+        writer.close()
+
+
+def test_round_trip(tmp_path):
+    cache = instance_cache.TokenizedInstanceCache(str(tmp_path), 'key')
+    write(cache, instances())
+    assert cache.exists()
+
+    vocab = Vocab()
+    id_to_token = {'phrase': vocab, 'retrieval': vocab}
+    for (record, expected), (record_, read) in zip(instances(), cache.read(id_to_token)):
+        assert record == record_
+        assert set(read) == set(expected)
+        for name in ['phrase']:
+            assert [(t.text, t.text_id, t.type_id) for t in read[name]] == \
+                [(t.text, t.text_id, t.type_id) for t in expected[name]]
+        assert [[t.text_id for t in row] for row in read['retrieval']] == \
+            [[t.text_id for t in row] for row in expected['retrieval']]
+        if 'rollout_prefix' in expected:
+            assert np.array_equal(read['rollout_prefix'], expected['rollout_prefix'])
+            assert np.array_equal(read['rollout_sentences'], expected['rollout_sentences'])
+    # One vocab lookup per row, not per id
+    assert vocab.calls == 4
+
+
+def test_partial_read_leaves_no_entry(tmp_path):
+    cache = instance_cache.TokenizedInstanceCache(str(tmp_path), 'key')
+    writer = cache.writer(FIELDS)
+    record, toks = next(instances())
+    writer.add(record, toks)
+    writer.close()
+    assert not cache.exists()
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_empty_dataset(tmp_path):
+    cache = instance_cache.TokenizedInstanceCache(str(tmp_path), 'key')
+    write(cache, [])
+    assert list(cache.read({})) == []
+
+
+def test_cache_key_depends_on_options(tmp_path):
+    data = tmp_path / 'train.jsonl'
+    data.write_text('{}\n')
+    key = instance_cache.cache_key([str(data)], {'max_pieces': 512})
+    assert key == instance_cache.cache_key([str(data)], {'max_pieces': 512})
+    assert key != instance_cache.cache_key([str(data)], {'max_pieces': 256})
+    data.write_text('{"id": 1}\n')
+    assert key != instance_cache.cache_key([str(data)], {'max_pieces': 512})
+
+
+def test_numpy_records_and_compact_arrays(tmp_path):
+    cache = instance_cache.TokenizedInstanceCache(str(tmp_path), 'key')
+    record = {'item_id': 'a', 'node_label': np.array([1, 0], dtype=np.int8), 'qlen': np.int64(1)}
+    write(cache, [(record, {
+        'phrase': tokens([0, 2]),
+        'retrieval': [],
+        'rollout_prefix': np.array([0, 5], dtype=np.uint16),
+        'rollout_sentences': np.array([[7, 1]], dtype=np.uint16),
+    })])
+    (record_, read), = cache.read({'phrase': Vocab(), 'retrieval': Vocab()})
+    assert record_ == {'item_id': 'a', 'node_label': [1, 0], 'qlen': 1}
+    assert read['rollout_prefix'].dtype == np.uint16
+    assert read['rollout_sentences'].dtype == np.uint16
+
+
+class NamedVocab:
+    def __init__(self, name):
+        self.name = name
+
+    def convert_ids_to_tokens(self, ids):
+        return [f'{self.name}{i}' for i in ids]
+
+
+@pytest.mark.parametrize('concat', [False, True])
+def test_reader_maps_ids_back_with_the_tokenizer_which_made_them(tmp_path, concat):
+    rr = pytest.importorskip("ruletaker.allennlp_models.dataset_readers.retrieval_reasoning_reader")
+    qa, retriever = NamedVocab('qa'), NamedVocab('rtr')
+    reader = SimpleNamespace(_concat=concat, _tokenizer_qamodel_internal=qa, _tokenizer_retriever_internal=retriever)
+
+    # Concat retrieval rows are question + sentence pairs of the qa tokenizer
+    as_tokens = lambda vocab, ids: [Token(text=t, text_id=i, type_id=0) for t, i in zip(vocab.convert_ids_to_tokens(ids), ids)]
+    sentences = [as_tokens(qa, [0, 5, 2, 7, 2]), as_tokens(qa, [0, 5, 2, 8, 2])]
+    toks = {
+        'phrase': as_tokens(qa, [0, 5, 2, 7, 8, 2]),
+        'retrieval': sentences if concat else [as_tokens(retriever, [0, 7, 2]), as_tokens(retriever, [0, 8, 2])],
+        'sentences': sentences,
+    }
+    cache = instance_cache.TokenizedInstanceCache(str(tmp_path), 'key')
+    writer = cache.writer(rr.RetrievalReasoningReader._cached_fields(reader))
+    writer.add({'item_id': 'a'}, toks)
+    writer.finalize()
+
+    (_, read), = cache.read(rr.RetrievalReasoningReader._id_to_token_fns(reader))
+    for name in ['retrieval', 'sentences']:
+        assert [[t.text for t in row] for row in read[name]] == [[t.text for t in row] for row in toks[name]]
+    assert [t.text for t in read['phrase']] == [t.text for t in toks['phrase']]
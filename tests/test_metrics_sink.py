@@ -0,0 +1,92 @@
+import json
+
+import pytest
+import torch
+
+pytest.importorskip("ruletaker.allennlp_models")
+metrics_sink = pytest.importorskip("ruletaker.allennlp_models.models.metrics_sink")
+
+
+class Backend:
+    def __init__(self):
+        self.written = []
+        self.closed = False
+
+    def write(self, metrics, step):
+        self.written.append((step, metrics))
+
+    def close(self):
+        self.closed = True
+
+
+def test_running_means_are_written_every_flush_every_steps():
+    backend = Backend()
+    sink = metrics_sink.MetricsSink([backend], flush_every=2)
+    sink.log({'loss': torch.tensor([1., 3.])}, commit=False)
+    sink.log({'loss': 4., 'lr': 0.1})
+    assert backend.written == []
+    sink.log({'loss': 0.})
+    assert backend.written == [(2, {'loss': 2., 'lr': 0.1})]
+
+    sink.close()
+    assert backend.written == [(2, {'loss': 2., 'lr': 0.1})] and backend.closed
+
+
+def test_bucket_metrics_are_flushed_with_their_prefix():
+    backend = Backend()
+    sink = metrics_sink.MetricsSink([backend], flush_every=100)
+    sink.log_buckets('val_', torch.tensor([1, 2]), torch.tensor([True, False]))
+    sink.flush()
+    assert backend.written == [(0, {
+        'val_acc': 0.5, 'val_acc_1': 1., 'val_acc_2': 0.,
+        'val_acc_noncuml': 0.5, 'val_acc_noncuml_1': 1., 'val_acc_noncuml_2': 0.,
+    })]
+
+
+def test_bucket_metrics_stay_cumulative_across_flushes():
+    backend = Backend()
+    sink = metrics_sink.MetricsSink([backend], flush_every=1)
+    sink.log_buckets('train_', torch.tensor([1, 2]), torch.tensor([True, True]))
+    sink.log({'loss': 0.})
+    sink.log_buckets('train_', torch.tensor([1]), torch.tensor([False]))
+    sink.log({'loss': 0.})
+    assert backend.written[1][1] == {
+        'loss': 0.,
+        'train_acc': pytest.approx(2 / 3), 'train_acc_1': 0.5, 'train_acc_2': 1.,
+        'train_acc_noncuml': 0., 'train_acc_noncuml_1': 0.,
+    }
+
+    sink.reset('train_')
+    sink.log_buckets('train_', torch.tensor([2]), torch.tensor([False]))
+    sink.log({'loss': 0.})
+    assert backend.written[2][1]['train_acc'] == 0. and 'train_acc_1' not in backend.written[2][1]
+
+
+def test_background_flushes_are_written_by_close():
+    backend = Backend()
+    sink = metrics_sink.MetricsSink([backend], flush_every=1, background=True)
+    for n in range(3):
+        sink.log({'loss': float(n)})
+    sink.close()
+    assert backend.written == [(1, {'loss': 0.}), (2, {'loss': 1.}), (3, {'loss': 2.})]
+
+
+def test_a_sink_without_backends_records_nothing():
+    sink = metrics_sink.MetricsSink()
+    sink.log({'loss': 1.})
+    sink.log_buckets('val_', None, torch.tensor([True]))
+    assert not sink.enabled and sink._sums == {} and sink._buckets == {}
+
+
+def test_jsonl_backend_and_disabling_the_global_sink(tmp_path):
+    path = tmp_path / 'log' / 'metrics.jsonl'
+    sink = metrics_sink.configure_metrics_sink(str(path), flush_every=1, wandb=False)
+    assert metrics_sink.get_metrics_sink() is sink
+    sink.log({'loss': 1.})
+    with metrics_sink.metrics_sink_disabled():
+        metrics_sink.get_metrics_sink().log({'loss': 2.})
+    assert metrics_sink.get_metrics_sink() is sink
+
+    metrics_sink.configure_metrics_sink()
+    rows = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [(r['step'], r['loss']) for r in rows] == [(1, 1.)]
@@ -0,0 +1,136 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("ruletaker.allennlp_models")
+parallel = pytest.importorskip("ruletaker.allennlp_models.dataset_readers.parallel")
+
+
+class Reader(parallel.ParallelTokenizationMixin):
+    def __init__(self, num_workers=None, worker_chunk_size=3):
+        self.scale = 10
+        if num_workers is not None:
+            self._init_workers(num_workers, worker_chunk_size)
+
+    def _encode_records(self, records):
+        # One "batched" call per chunk
+        return [
+            (record, {'x_scaled': record['x'] * self.scale, 'chunk_size': len(records), 'encoded_by': os.getpid()})
+            for record in records
+        ]
+
+    def text_to_instance(self, item_id, x, x_scaled, chunk_size, encoded_by):
+        return item_id, x_scaled, chunk_size, encoded_by, os.getpid()
+
+
+def records(n):
+    return ({'item_id': f'q{i}', 'x': i} for i in range(n))
+
+
+def test_chunks_cover_items_in_order():
+    assert list(parallel._chunks(range(7), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(parallel._chunks([], 3)) == []
+
+
+@pytest.mark.parametrize('num_workers', [0, 1])
+def test_serial_read_runs_in_process(num_workers):
+    instances = list(Reader(num_workers)._instances_from_records(records(5)))
+    assert [(i, x) for i, x, *_ in instances] == [(f'q{i}', 10 * i) for i in range(5)]
+    assert [size for _, _, size, _, _ in instances] == [3, 3, 3, 2, 2]
+    assert {pid for _, _, _, *pids in instances for pid in pids} == {os.getpid()}
+
+
+def test_parallel_read_keeps_the_input_order():
+    instances = list(Reader(num_workers=2)._instances_from_records(records(20)))
+    assert [(i, x) for i, x, *_ in instances] == [(f'q{i}', 10 * i) for i in range(20)]
+    # Records are encoded in the workers, instances are built here
+    assert os.getpid() not in {encoded_by for _, _, _, encoded_by, _ in instances}
+    assert {built_by for *_, built_by in instances} == {os.getpid()}
+
+
+def test_parallel_read_of_no_records():
+    assert list(Reader(num_workers=2)._instances_from_records(records(0))) == []
+
+
+def test_default_encoding_leaves_tokenization_to_text_to_instance():
+    reader = SimpleNamespace()
+    reader.text_to_instance = lambda item_id, x: (item_id, x)
+    reader._parallel_map = parallel.ParallelTokenizationMixin._parallel_map.__get__(reader)
+    reader._encode_records = parallel.ParallelTokenizationMixin._encode_records.__get__(reader)
+    instances = parallel.ParallelTokenizationMixin._instances_from_records(reader, records(4))
+    assert list(instances) == [(f'q{i}', i) for i in range(4)]
+
+
+class WordTokenizer:
+    ''' Word-level stand-in for a pretrained transformer tokenizer, with
+        BERT's pair layout and longest first truncation.
+    '''
+    def __init__(self, max_length):
+        self.max_length = max_length
+        self.vocab = {'[PAD]': 0, '[CLS]': 1, '[SEP]': 2}
+        self.batches = []
+
+    def _encode(self, text, pair=None):
+        ids = [self.vocab.setdefault(w, len(self.vocab)) for w in text.split()]
+        pair_ids = [self.vocab.setdefault(w, len(self.vocab)) for w in pair.split()] if pair is not None else None
+        specials = 3 if pair is not None else 2
+        for _ in range(max(len(ids) + len(pair_ids or []) + specials - self.max_length, 0)):
+            if pair_ids is None or len(ids) > len(pair_ids):
+                ids = ids[:-1]
+            else:
+                pair_ids = pair_ids[:-1]
+        if pair_ids is None:
+            return [1] + ids + [2], [0] * (len(ids) + 2)
+        return [1] + ids + [2] + pair_ids + [2], [0] * (len(ids) + 2) + [1] * (len(pair_ids) + 1)
+
+    def batch_encode_plus(self, texts, add_special_tokens, max_length, return_token_type_ids):
+        assert add_special_tokens and max_length == self.max_length
+        self.batches.append(texts)
+        encoded = [self._encode(*t) if isinstance(t, tuple) else self._encode(t) for t in texts]
+        return {'input_ids': [ids for ids, _ in encoded], 'token_type_ids': [t for _, t in encoded]}
+
+    @property
+    def pad_token_id(self):
+        return 0
+
+    def convert_ids_to_tokens(self, ids):
+        inverse = {i: w for w, i in self.vocab.items()}
+        return [inverse[i] for i in ids]
+
+    # PretrainedTransformerTokenizer
+    def tokenize(self, text, pair=None):
+        from allennlp.data.tokenizers import Token
+        ids, type_ids = self._encode(text, pair)
+        return [Token(text=w, text_id=i, type_id=t) for w, i, t in zip(self.convert_ids_to_tokens(ids), ids, type_ids)]
+
+    def tokenize_sentence_pair(self, text, pair):
+        return self.tokenize(text, pair)
+
+
+@pytest.mark.parametrize('add_prefix', [None, {'q': 'Q: ', 'c': 'C: '}])
+def test_rule_reader_encodes_chunks_as_it_tokenizes_records(add_prefix):
+    rr = pytest.importorskip("ruletaker.allennlp_models.dataset_readers.rule_reasoning_reader")
+    tokenizer = WordTokenizer(max_length=10)
+    reader = SimpleNamespace(
+        _tokenizer=tokenizer, _tokenizer_internal=tokenizer, _max_pieces=10, _add_prefix=add_prefix,
+    )
+    for name in ['_encode_records', '_add_prefixes', 'transformer_features_from_qa']:
+        setattr(reader, name, getattr(rr.RuleReasoningReader, name).__get__(reader))
+
+    records = [
+        {'item_id': 'a', 'question_text': 'the cat is red', 'context': 'the cat is big . the dog is red .'},
+        {'item_id': 'b', 'question_text': 'the dog is blue', 'context': ''},
+    ]
+    if add_prefix is None:
+        records.append({'item_id': 'c', 'question_text': 'is the dog red', 'context': None})
+    encoded = reader._encode_records(records)
+    assert len(tokenizer.batches) == 1
+    assert [record for record, _ in encoded] == records
+
+    as_tuples = lambda tokens: [(t.text, t.text_id, t.type_id) for t in tokens]
+    for record, encoding in encoded:
+        expected, _ = reader.transformer_features_from_qa(record['question_text'], record['context'])
+        tokens, segment_ids = reader.transformer_features_from_qa(record['question_text'], record['context'], **encoding)
+        assert as_tuples(tokens) == as_tuples(expected)
+        assert segment_ids == [0] * len(tokens)
@@ -0,0 +1,86 @@
+import json
+
+import pytest
+import torch
+from torch import nn
+
+pytest.importorskip("ruletaker.allennlp_models")
+prediction_sink = pytest.importorskip("ruletaker.allennlp_models.models.prediction_sink")
+
+
+def write_batch(sink, ids):
+    logits = torch.tensor([[0., 1.], [2., 0.]])[:len(ids)]
+    sink.write(
+        [{'id': i} for i in ids], logits, logits.softmax(-1), logits.argmax(-1),
+        lambda example, prediction: {'id': example['id'], 'is_correct': prediction == 1},
+    )
+
+
+def read(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_one_file_per_epoch(tmp_path):
+    sink = prediction_sink.PredictionSink(str(tmp_path / 'predictions.jsonl'), flush_every=3)
+    sink.set_epoch(0)
+    write_batch(sink, ['a', 'b'])
+    write_batch(sink, ['c', 'd'])
+    assert read(tmp_path / 'predictions_epoch_0.jsonl')[0]['id'] == 'a'       # Flushed at 3 rows
+    assert sink.close() == str(tmp_path / 'predictions_epoch_0.jsonl')
+
+    # e.g. resumed at epoch 3, the file matches metrics_epoch_3.json
+    sink.set_epoch(3)
+    write_batch(sink, ['e'])
+    sink.close()
+
+    rows = read(tmp_path / 'predictions_epoch_0.jsonl')
+    assert [r['id'] for r in rows] == ['a', 'b', 'c', 'd']
+    assert rows[0] == {
+        'logits': [0., 1.], 'label_probs': pytest.approx(torch.tensor([0., 1.]).softmax(-1).tolist()),
+        'prediction': 1, 'id': 'a', 'is_correct': True,
+    }
+    assert [r['id'] for r in read(tmp_path / 'predictions_epoch_3.jsonl')] == ['e']
+
+
+def test_passes_without_predictions_write_no_file(tmp_path):
+    sink = prediction_sink.PredictionSink(str(tmp_path / 'predictions.jsonl'))
+    assert sink.close() is None
+    assert list(tmp_path.iterdir()) == []
+    write_batch(sink, ['a'])
+    # Without an epoch (outside the trainer) the path is used as is
+    assert sink.close() == str(tmp_path / 'predictions.jsonl')
+
+
+def test_disabled_sink_writes_nothing(tmp_path):
+    sink = prediction_sink.PredictionSink()
+    write_batch(sink, ['a'])
+    assert not sink.enabled and sink.close() is None
+
+
+class Model(nn.Module):
+    def __init__(self, path):
+        super().__init__()
+        self.qa_model = nn.Module()
+        self.qa_model._prediction_sink = prediction_sink.PredictionSink(path)
+
+
+def test_relative_paths_resolve_against_the_serialization_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    model = Model('predictions.jsonl')
+    # Nothing is written until the trainer gives the file a directory
+    assert not model.qa_model._prediction_sink.enabled
+    write_batch(model.qa_model._prediction_sink, ['a'])
+    assert model.qa_model._prediction_sink.close() is None
+    assert list(tmp_path.iterdir()) == []
+
+    serialization_dir = tmp_path / 'run'
+    prediction_sink.set_prediction_directory(model, str(serialization_dir))
+    prediction_sink.set_prediction_epoch(model, 2)
+    assert model.qa_model._prediction_sink.current_path() == str(serialization_dir / 'predictions_epoch_2.jsonl')
+
+    with prediction_sink.predictions_disabled(model):
+        write_batch(model.qa_model._prediction_sink, ['a'])
+        assert model.qa_model._prediction_sink.close() is None
+    assert model.qa_model._prediction_sink.enabled
+    assert list(tmp_path.iterdir()) == []
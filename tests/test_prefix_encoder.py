@@ -0,0 +1,64 @@
+import pytest
+import torch
+
+pytest.importorskip("ruletaker.allennlp_models")
+prefix_encoder = pytest.importorskip("ruletaker.allennlp_models.models.prefix_encoder")
+transformers = pytest.importorskip("transformers")
+
+PAD = 1
+
+
+def make_roberta(num_layers):
+    torch.manual_seed(0)
+    config = transformers.RobertaConfig(
+        vocab_size=30, hidden_size=16, num_hidden_layers=num_layers, num_attention_heads=2,
+        intermediate_size=32, max_position_embeddings=40, pad_token_id=PAD,
+        initializer_range=0.5,      # So that the context visibly changes each token
+    )
+    return transformers.RobertaModel(config).eval()
+
+
+def full_first_token(model, rows):
+    flat = rows.view(-1, rows.size(-1))
+    with torch.no_grad():
+        hidden = model(flat, attention_mask=(flat != PAD).long())[0]
+    return hidden[:, 0].view(*rows.shape[:2], -1)
+
+
+ROWS = torch.tensor([[
+    [0, 5, 6, 2, 7, 8, 2],
+    [0, 5, 6, 2, 9, 2, PAD],
+    [PAD] * 7,
+    [0, 5, 6, 2, 10, 11, 2],
+]])
+
+
+def test_split_shared_prefix():
+    prefix, prefix_mask, prefix_len, suffix, suffix_mask = prefix_encoder.split_shared_prefix(ROWS, PAD)
+    assert prefix.tolist() == [[0, 5, 6, 2]] and prefix_mask.all() and prefix_len.tolist() == [4]
+    assert suffix.tolist() == [[[7, 8, 2], [9, 2, PAD], [PAD] * 3, [10, 11, 2]]]
+    assert suffix_mask.tolist() == [[[True] * 3, [True, True, False], [False] * 3, [True] * 3]]
+
+
+def test_suffixes_keep_at_least_one_token():
+    rows = torch.tensor([[[0, 5, 2], [0, 5, 2]]])
+    _, _, prefix_len, suffix, _ = prefix_encoder.split_shared_prefix(rows, PAD)
+    assert prefix_len.tolist() == [2] and suffix.tolist() == [[[2], [2]]]
+
+
+def test_matches_full_encoding_without_a_shared_prefix():
+    model = make_roberta(num_layers=2)
+    rows = torch.tensor([[[0, 5, 2, PAD], [0, 6, 7, 2]]])
+    with torch.no_grad():
+        hidden, mask = prefix_encoder.encode_with_shared_prefix(model, rows, PAD)
+    assert torch.allclose(hidden[:, :, 0], full_first_token(model, rows), atol=1e-5)
+    assert mask.tolist() == [[[True, True, True, False], [True, True, True, True]]]
+
+
+def test_first_token_is_exact_for_one_layer():
+    # The prefix only loses sight of the candidate from the second layer on
+    model = make_roberta(num_layers=1)
+    with torch.no_grad():
+        hidden, _ = prefix_encoder.encode_with_shared_prefix(model, ROWS, PAD)
+    valid = (ROWS != PAD).any(-1)[0]
+    assert torch.allclose(hidden[0, valid, 0], full_first_token(model, ROWS)[0, valid], atol=1e-5)
@@ -0,0 +1,150 @@
+import itertools
+import json
+
+import numpy as np
+import pytest
+
+pytest.importorskip("ruletaker.allennlp_models")
+processors = pytest.importorskip("ruletaker.allennlp_models.dataset_readers.processors")
+proof_utils = pytest.importorskip("ruletaker.allennlp_models.dataset_readers.proof_utils")
+
+NFACT, NRULE = 3, 2
+PROOFS = [
+    '[(((((triple1 triple2) -> rule1) triple3) -> rule2))]',
+    '[(((NAF) -> rule1))] OR [(((triple3) -> rule1))]',
+    '[(@X = (rule1 <- triple2 <- FAIL))]',
+    '[(triple2)]',
+]
+
+
+def loop_labels(proofs, sentence_scramble, nfact, nrule):
+    # The per-element construction the vectorized labels replaced
+    proof = proofs.split("OR")[0]
+    node_label = [0] * (nfact + nrule + 1)
+    edge_label = np.zeros((nfact + nrule + 1, nfact + nrule + 1), dtype=int)
+    if "FAIL" in proof:
+        nodes, edges = proof_utils.get_proof_graph_with_fail(proof)
+    else:
+        nodes, edges = proof_utils.get_proof_graph(proof)
+
+    component_index_map = {}
+    for (i, index) in enumerate(sentence_scramble):
+        component = "triple" + str(index) if index <= nfact else "rule" + str(index - nfact)
+        component_index_map[component] = i
+    component_index_map["NAF"] = nfact + nrule
+
+    for node in nodes:
+        node_label[component_index_map[node]] = 1
+    for start, end in set(edges):
+        edge_label[component_index_map[start]][component_index_map[end]] = 1
+
+    n = len(edge_label)
+    for i in range(n):
+        for j in range(n):
+            is_fact_start = i == n - 1 or sentence_scramble[i] <= nfact
+            is_fact_end = j == n - 1 or sentence_scramble[j] <= nfact
+            if i == j or node_label[i] == 0 or node_label[j] == 0 or is_fact_end:
+                edge_label[i][j] = -100
+    return node_label, list(edge_label.flatten())
+
+
+@pytest.mark.parametrize('proofs', PROOFS)
+def test_constrained_labels_match_the_loop_for_every_scramble(proofs):
+    processor = processors.RRProcessor()
+    for scramble in itertools.permutations(range(1, NFACT + NRULE + 1)):
+        node_label, edge_label = processor._get_node_edge_label_constrained(proofs, list(scramble), NFACT, NRULE)
+        expected_nodes, expected_edges = loop_labels(proofs, list(scramble), NFACT, NRULE)
+        assert node_label.tolist() == expected_nodes
+        assert edge_label.tolist() == expected_edges
+
+
+def test_constrained_labels_keep_rule_edges():
+    processor = processors.RRProcessor()
+    node_label, edge_label = processor._get_node_edge_label_constrained(PROOFS[0], [1, 2, 3, 4, 5], NFACT, NRULE)
+    edge_label = edge_label.reshape(6, 6)
+    assert node_label.tolist() == [1, 1, 1, 1, 1, 0]
+    # triple1, triple2 -> rule1 -> rule2 <- triple3
+    assert [tuple(e) for e in np.argwhere(edge_label == 1)] == [(0, 3), (1, 3), (2, 4), (3, 4)]
+    assert edge_label[4, 3] == 0 and edge_label[0, 1] == -100
+
+
+def test_record_structures_are_shared_by_labels_of_a_context():
+    processor = processors.RRProcessor()
+    scramble = [4, 1, 5, 3, 2]
+    structures = processor._get_record_structures(scramble, NFACT, NRULE)
+    assert structures[0]['rule1'] == 0 and structures[0]['NAF'] == 5
+    assert structures[1].tolist() == [False, True, False, True, True, True]
+    for proofs in PROOFS:
+        shared = processor._get_node_edge_label_constrained(proofs, scramble, NFACT, NRULE, structures)
+        own = processor._get_node_edge_label_constrained(proofs, scramble, NFACT, NRULE)
+        assert all(np.array_equal(a, b) for a, b in zip(shared, own))
+
+
+def test_unconstrained_labels_are_not_masked():
+    processor = processors.RRProcessor()
+    node_label, edge_label = processor._get_node_edge_label_unconstrained(PROOFS[0], [1, 2, 3, 4, 5], NFACT, NRULE)
+    assert set(edge_label.tolist()) == {0, 1}
+    assert edge_label.sum() == 4
+
+
+def record(n):
+    context = f'Fact {n}a. Fact {n}b. Fact {n}c. Rule {n}a. Rule {n}b.'
+    questions = [
+        {'id': f'R{n}-Q{j + 1}', 'text': f'Question {n}{j}.', 'label': j % 2 == 0, 'meta': {'QDep': j, 'QLen': j + 1}}
+        for j in range(len(PROOFS))
+    ]
+    meta = {
+        'id': f'R{n}', 'NFact': NFACT, 'NRule': NRULE,
+        'questions': {f'Q{j + 1}': {'question': q['text'], 'proofs': p} for j, (q, p) in enumerate(zip(questions, PROOFS))},
+    }
+    return {'id': f'R{n}', 'context': context, 'meta': {'sentenceScramble': [3, 5, 1, 4, 2]}, 'questions': questions}, meta
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    records, metas = zip(*[record(n) for n in range(3)])
+    # Written with a BOM, which both readers strip
+    with open(tmp_path / 'dev.jsonl', 'w', encoding='utf-8-sig') as f:
+        f.write('\n'.join(json.dumps(r) for r in records) + '\n')
+    with open(tmp_path / 'meta-dev.jsonl', 'w', encoding='utf-8') as f:
+        f.write('\n'.join(json.dumps(m) for m in metas) + '\n')
+    return str(tmp_path)
+
+
+def as_tuples(examples):
+    return [
+        (e.id, e.context, e.question, e.node_label.tolist(), e.edge_label.tolist(), e.label, e.qdep, e.qlen)
+        for e in examples
+    ]
+
+
+def test_streamed_examples_match_the_loaded_examples(data_dir):
+    processor = processors.RRProcessor()
+    streamed = processor.iter_examples(data_dir, 'dev')
+    assert not isinstance(streamed, list)
+    streamed = as_tuples(streamed)
+    assert streamed == as_tuples(processor.get_examples(data_dir, 'dev'))
+    assert len(streamed) == 3 * len(PROOFS)
+    assert streamed[0][0] == 'R0-Q1' and streamed[-1][0] == 'R2-Q4'
+
+
+def test_examples_of_a_single_record_by_id(data_dir):
+    processor = processors.RRProcessor()
+    examples = processor.get_record_examples(data_dir, 'dev', 'R2')
+    assert [e.id for e in examples] == [f'R2-Q{j + 1}' for j in range(len(PROOFS))]
+    assert as_tuples(examples) == as_tuples(processor.get_examples(data_dir, 'dev'))[-len(PROOFS):]
+    # The index is built once per file
+    assert processor._indexed_files(data_dir, 'dev') is processor._indexed_files(data_dir, 'dev')
+
+
+def test_indexed_jsonl_reads_records_by_line_and_id(data_dir):
+    with open(data_dir + '/dev.jsonl', 'a') as f:
+        f.write('\n')
+    records = processors.IndexedJsonl(data_dir + '/dev.jsonl')
+    assert records._offsets is None
+    assert len(records) == 3
+    assert records[0]['id'] == 'R0' and records[2]['id'] == 'R2'
+    assert records.get('R1')['context'].startswith('Fact 1a.')
+    assert [r['id'] for r in records] == ['R0', 'R1', 'R2']
+    with pytest.raises(KeyError):
+        records.line_of('R3')
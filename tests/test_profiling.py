@@ -0,0 +1,86 @@
+import json
+import os
+
+import pytest
+import torch
+
+pytest.importorskip("ruletaker.allennlp_models")
+profiling = pytest.importorskip("ruletaker.allennlp_models.train.profiling")
+
+
+def test_spans_are_recorded_per_stage():
+    timer = profiling.StageTimer(enabled=True)
+    for _ in range(3):
+        with timer.span('forward'):
+            pass
+    with timer.span('backward'):
+        pass
+    summary = timer.summary()
+    assert summary['forward']['count'] == 3
+    assert summary['backward']['count'] == 1
+    assert set(summary['forward']) == {'count', 'total_s', 'mean_ms', 'p50_ms', 'p95_ms'}
+    assert summary['forward']['p50_ms'] <= summary['forward']['p95_ms']
+
+
+def test_iterate_times_each_item_but_not_the_exhausted_next():
+    timer = profiling.StageTimer(enabled=True)
+    assert list(timer.iterate(range(4), 'data_loading')) == [0, 1, 2, 3]
+    assert timer.summary()['data_loading']['count'] == 4
+
+
+def test_spans_which_raise_are_not_recorded():
+    timer = profiling.StageTimer(enabled=True)
+    with pytest.raises(RuntimeError):
+        with timer.span('forward'):
+            raise RuntimeError
+    assert timer.summary() == {}
+
+
+def test_disabled_timer_is_a_no_op(tmp_path):
+    timer = profiling.StageTimer()
+    with timer.span('forward'):
+        pass
+    assert list(timer.iterate([1, 2], 'data_loading')) == [1, 2]
+    assert timer.summary() == {}
+    assert timer.dump(str(tmp_path / 'timings.json')) is None
+    assert not os.path.exists(tmp_path / 'timings.json')
+    timer.start_trace(str(tmp_path / 'trace'))
+    assert not os.path.exists(tmp_path / 'trace')
+
+
+def test_dump_writes_the_summary_and_resets(tmp_path):
+    timer = profiling.StageTimer(enabled=True)
+    with timer.span('forward'):
+        pass
+    path = str(tmp_path / 'timings.json')
+    summary = timer.dump(path, epoch=2, mode='retrieval')
+    with open(path) as f:
+        dumped = json.load(f)
+    assert dumped['epoch'] == 2 and dumped['mode'] == 'retrieval'
+    assert dumped['stages'] == summary
+    assert summary['forward']['count'] == 1
+    assert timer.summary() == {}
+
+
+def test_start_trace_requires_torch_profiler(tmp_path, monkeypatch):
+    monkeypatch.delattr(torch, 'profiler')
+    timer = profiling.StageTimer(enabled=True, trace_steps=1)
+    with pytest.raises(ValueError):
+        timer.start_trace(str(tmp_path))
+
+
+@pytest.mark.skipif(not hasattr(torch, 'profiler'), reason="torch.profiler requires torch >= 1.8")
+def test_trace_is_written_once(tmp_path):
+    timer = profiling.StageTimer(enabled=True, trace_steps=1)
+    trace_dir = str(tmp_path / 'trace')
+    timer.start_trace(trace_dir)
+    first = timer._profiler
+    timer.start_trace(trace_dir)
+    assert timer._profiler is first
+    for _ in range(3):
+        with timer.span('forward'):
+            torch.ones(2).sum()
+        timer.step()
+    timer.stop_trace()
+    assert timer._profiler is None
+    assert os.listdir(trace_dir)
@@ -0,0 +1,62 @@
+import pickle
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip("ruletaker.allennlp_models")
+proof_utils = pytest.importorskip("ruletaker.allennlp_models.dataset_readers.proof_utils")
+
+
+def example(context, node_label=(1, 0, 1), edge_label=(0, -100, 1)):
+    return proof_utils.RRInputExample('q1', context, 'Is it?', node_label, edge_label, True, 1, 2)
+
+
+def test_examples_are_compact():
+    e = example('The cat is red.')
+    assert not hasattr(e, '__dict__')
+    assert e.node_label.dtype == np.int8 and e.node_label.tolist() == [1, 0, 1]
+    assert e.edge_label.dtype == np.int8 and e.edge_label.tolist() == [0, -100, 1]
+    assert example('The cat is red.', node_label=None, edge_label=None).node_label is None
+
+
+def test_questions_on_a_context_share_its_string():
+    # Built at runtime, as if parsed from separate JSON lines
+    first = example(''.join(['The cat ', 'is red.']))
+    second = example(''.join(['The cat is', ' red.']))
+    assert first.context is second.context
+    assert proof_utils.intern_context(None) is None
+
+
+def test_lazy_metadata_computes_entries_on_access():
+    calls = []
+
+    def texts(tokens):
+        calls.append(tokens)
+        return proof_utils.token_texts(tokens)
+
+    tokens = [SimpleNamespace(text='<s>'), SimpleNamespace(text='Is')]
+    metadata = proof_utils.LazyMetadata({'id': 'q1'}, lazy={'tokens': (texts, tokens)})
+    assert 'tokens' not in dict(metadata) and not calls
+    assert 'tokens' in metadata and 'other' not in metadata
+    assert metadata['tokens'] == ['<s>', 'Is']
+    assert metadata.get('tokens') == ['<s>', 'Is']
+    assert metadata.get('other', 0) == 0
+    assert metadata['id'] == 'q1'
+    with pytest.raises(KeyError):
+        metadata['other']
+
+
+def test_lazy_metadata_survives_pickling():
+    tokens = [SimpleNamespace(text='<s>')]
+    metadata = proof_utils.LazyMetadata({'id': 'q1'}, lazy={'tokens': (proof_utils.token_texts, tokens)})
+    copy = pickle.loads(pickle.dumps(metadata))
+    assert copy['id'] == 'q1' and copy['tokens'] == ['<s>']
+
+
+def test_rollout_ids_fit_the_qa_vocabulary():
+    rr = pytest.importorskip("ruletaker.allennlp_models.dataset_readers.retrieval_reasoning_reader")
+    reader = SimpleNamespace(_tokenizer_qamodel_internal=range(50265), _tokenizer_retriever_internal=range(10))
+    assert rr.RetrievalReasoningReader._token_id_dtype(reader) == np.uint16
+    reader._tokenizer_qamodel_internal = range(2**16 + 1)
+    assert rr.RetrievalReasoningReader._token_id_dtype(reader) == np.int32
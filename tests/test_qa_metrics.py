@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip("ruletaker.allennlp_models")
+qa_metrics = pytest.importorskip("ruletaker.allennlp_models.models.qa_metrics")
+
+METADATA = [
+    {'node_label': np.array([1, 0, 1, 0]), 'topk': [0, 1], 'QLen': 2},
+    {'node_label': np.array([0, 1, 0, 1, 1, 0]), 'topk': [1, 3, 4], 'QLen': 3},
+    {'node_label': np.array([0, 0, 1]), 'topk': [0], 'QLen': 1},       # No proof (NAF)
+    {'node_label': np.array([1, 0]), 'topk': [], 'QLen': 2},
+]
+LABELS = torch.tensor([1, 1, 0, 1])
+CORRECT = torch.tensor([True, False, True, True])
+
+
+def reference_recall(meta, label):
+    ''' Per example recall, as computed before batching (-1 = undefined). '''
+    proof = {n for n, i in enumerate(meta['node_label'][:-1]) if i == 1}
+    if label and proof:
+        return len(proof & set(meta['topk'])) / len(proof)
+    return -1
+
+
+def test_masks_from_metadata():
+    assert qa_metrics.proof_mask_from_metadata(METADATA).tolist() == [
+        [True, False, True, False, False],
+        [False, True, False, True, True],
+        [False, False, False, False, False],
+        [True, False, False, False, False],
+    ]
+    assert qa_metrics.retrieved_from_metadata(METADATA).tolist() == [
+        [0, 1, -1], [1, 3, 4], [0, -1, -1], [-1, -1, -1],
+    ]
+
+
+def test_retrieval_recall_matches_the_per_example_reference():
+    recall, defined = qa_metrics.retrieval_recall(
+        qa_metrics.retrieved_from_metadata(METADATA), qa_metrics.proof_mask_from_metadata(METADATA)
+    )
+    assert defined.tolist() == [True, True, False, True]
+    for r, d, meta in zip(recall.tolist(), defined.tolist(), METADATA):
+        if d:
+            assert r == pytest.approx(reference_recall(meta, 1))
+
+
+def test_bucketed_metrics_match_the_per_example_reference():
+    metrics = qa_metrics.BucketedQAMetrics()
+    qlens = torch.tensor([m['QLen'] for m in METADATA])
+    for _ in range(2):
+        metrics(
+            qlens, CORRECT, LABELS,
+            qa_metrics.retrieved_from_metadata(METADATA), qa_metrics.proof_mask_from_metadata(METADATA),
+        )
+    result = metrics.get_metric(reset=True, prefix='val_', bucket_name='QLen_')
+
+    recalls = [reference_recall(m, l) for m, l in zip(METADATA, LABELS.tolist())]
+    assert result['val_acc'] == pytest.approx(CORRECT.float().mean().item())
+    assert result['val_ret_recall'] == pytest.approx(np.mean([r for r in recalls if r >= 0]))
+    assert result['val_acc_QLen_2'] == 1. and result['val_acc_QLen_3'] == 0.
+    assert result['val_ret_recall_QLen_2'] == pytest.approx(np.mean([recalls[0], recalls[3]]))
+    assert 'val_ret_recall_QLen_1' not in result
+    # Reset
+    assert metrics.get_metric() == {}
+
+
+def test_unbucketed_metrics_have_overall_values_only():
+    metrics = qa_metrics.BucketedQAMetrics(max_bucket=2)
+    metrics(None, CORRECT)
+    assert metrics.get_metric() == {'acc': 0.75}
+    metrics.reset()
+    metrics(torch.tensor([5, 5, 0, 0]), CORRECT)
+    # Buckets past max_bucket are counted in max_bucket
+    assert metrics.get_metric()['acc_2'] == 0.5
@@ -0,0 +1,75 @@
+import random
+
+import pytest
+import torch
+
+pytest.importorskip("ruletaker.allennlp_models")
+replay_buffer = pytest.importorskip("ruletaker.allennlp_models.models.replay_buffer")
+
+
+def test_sum_tree_sums_and_finds_prefix_masses():
+    tree = replay_buffer.SumTree(5)
+    for idx, priority in enumerate([1., 2., 0., 3., 4.]):
+        tree.update(idx, priority)
+    assert tree.total() == 10.
+    assert [tree.find(m) for m in [0., 0.99, 1., 2.99, 3., 5.99, 6., 9.99]] == [0, 0, 1, 1, 3, 3, 4, 4]
+
+    tree.update(3, 0.)
+    assert tree.total() == 7. and tree.find(3.) == 4
+    tree.clear()
+    assert tree.total() == 0.
+
+
+def test_ring_buffer_keeps_the_newest_entries_in_order():
+    memory = replay_buffer.ReplayMemory(capacity=3, max_trajectory_len=2)
+    for n in range(5):
+        memory.push({'sampler_idx': n, 'topk': [n] * (n % 2 + 1)})
+    assert len(memory) == 3
+    assert memory.sampler_idxs().tolist() == [2, 3, 4]
+    assert memory.sampler_idxs(repeats=2).tolist() == [2, 2, 3, 3, 4, 4]
+    assert memory.trajectories() == [[2], [3, 3], [4]]
+    assert memory.peek()['sampler_idx'] == 2
+    assert [e['sampler_idx'] for e in memory] == [2, 3, 4]
+
+    memory.empty()
+    assert len(memory) == 0 and list(memory) == []
+
+
+def test_trajectories_longer_than_the_buffer_rows_raise():
+    memory = replay_buffer.ReplayMemory(capacity=2, max_trajectory_len=2)
+    with pytest.raises(ValueError):
+        memory.push({'sampler_idx': 0, 'topk': [0, 1, 2]})
+
+
+def test_sampling_is_proportional_to_priority():
+    random.seed(0)
+    memory = replay_buffer.ReplayMemory(capacity=4)
+    for n, priority in enumerate([1., 0., 3., 0.]):
+        memory.push({'sampler_idx': n, 'topk': [n]}, priority=priority)
+    counts = [0] * 4
+    for entry in memory.sample(4000):
+        counts[entry['sampler_idx']] += 1
+    assert counts[1] == counts[3] == 0
+    assert abs(counts[2] / counts[0] - 3) < 0.1
+
+    memory.update_priorities([0, 2], torch.tensor([0., 1.]))
+    assert {e['sampler_idx'] for e in memory.sample(100)} == {2}
+    # New entries get the highest priority seen so far
+    memory.push({'sampler_idx': 4, 'topk': []})
+    assert memory.peek(-1)['priority'] == 3.
+
+
+def test_full_buffers_spill_to_disk_before_overwriting(tmp_path):
+    memory = replay_buffer.ReplayMemory(capacity=2, spill_dir=str(tmp_path))
+    for n in range(5):
+        memory.push({'sampler_idx': n, 'topk': [n, n + 1]}, priority=float(n + 1))
+    assert [e['sampler_idx'] for e in memory.spilled()] == [0, 1, 2, 3]
+    assert next(memory.spilled()) == {'sampler_idx': 0, 'topk': [0, 1], 'priority': 1.}
+    assert memory.sampler_idxs().tolist() == [3, 4]
+
+
+def test_all_gather_is_a_no_op_outside_distributed_training():
+    memory = replay_buffer.ReplayMemory(capacity=2)
+    memory.push({'sampler_idx': 1, 'topk': [0]})
+    memory.all_gather(shard=True)
+    assert [e['sampler_idx'] for e in memory] == [1]
@@ -0,0 +1,66 @@
+import pytest
+import torch
+
+pytest.importorskip("ruletaker.allennlp_models")
+rollout_prefetch = pytest.importorskip("ruletaker.allennlp_models.models.rollout_prefetch")
+
+PAD = 1
+
+
+class Reader:
+    ''' Encodes (question, retrieved, context) as one row per context word,
+        of [len(question), len(retrieved), position] ids.
+    '''
+    def retrieval_rows(self, sentences, vocab=None):
+        n_items = max(len(c.split()) for _, _, c in sentences)
+        rows = torch.full((len(sentences), n_items, 3 + len(sentences)), PAD, dtype=torch.long)
+        for n, (q, r, c) in enumerate(sentences):
+            for m in range(len(c.split())):
+                rows[n, m, :3] = torch.tensor([len(q), len(r), m])
+        return {'token_ids': rows}
+
+    def pad_idx(self, mode=None):
+        return PAD
+
+
+SENTENCES = [('q1', '', 'a b'), ('q22', 'a', 'a b c'), ('q3', 'b', 'a'), ('q4', '', 'a b c d'), ('q5', 'c', 'a b')]
+
+
+def expected_rows():
+    chunks = [Reader().retrieval_rows(SENTENCES[i:i + 2])['token_ids'] for i in range(0, len(SENTENCES), 2)]
+    rows = torch.full((len(SENTENCES), 4, max(c.size(-1) for c in chunks)), PAD, dtype=torch.long)
+    offset = 0
+    for c in chunks:
+        rows[offset:offset + len(c), :c.size(1), :c.size(2)] = c
+        offset += len(c)
+    return rows
+
+
+@pytest.mark.parametrize('backend', ['thread', 'process'])
+def test_prefetched_rows_match_the_reader(backend):
+    prefetcher = rollout_prefetch.RolloutPrefetcher(Reader(), num_workers=2, chunk_size=2, backend=backend)
+    try:
+        rows = prefetcher.submit(SENTENCES, 'cpu')
+        assert torch.equal(rows.result(), expected_rows())
+        assert rows.result() is rows.result()
+        metrics = prefetcher.get_metrics(reset=True)
+        assert set(metrics) == {'prefetch_queue_depth', 'prefetch_stall_ms'}
+        assert 0 <= metrics['prefetch_queue_depth'] <= 3
+    finally:
+        prefetcher.close()
+
+
+def test_process_workers_are_spawned():
+    prefetcher = rollout_prefetch.RolloutPrefetcher(Reader(), num_workers=1, backend='process')
+    try:
+        assert prefetcher._get_pool()._mp_context.get_start_method() == 'spawn'
+    finally:
+        prefetcher.close()
+
+
+def test_deferred_runs_once_on_result():
+    calls = []
+    deferred = rollout_prefetch.Deferred(lambda: calls.append(1) or len(calls))
+    assert calls == []
+    assert deferred.result() == deferred.result() == 1
+    assert calls == [1]
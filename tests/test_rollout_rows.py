@@ -0,0 +1,72 @@
+import pytest
+import torch
+
+pytest.importorskip("ruletaker.allennlp_models")
+utils = pytest.importorskip("ruletaker.allennlp_models.models.utils")
+
+PAD, BOS, EOS = 1, 0, 2
+
+
+def truncate_longest_first(ids, pair_ids, num_tokens_to_remove):
+    # Same loop as the tokenizer's "longest_first" truncation
+    for _ in range(num_tokens_to_remove):
+        if len(ids) > len(pair_ids):
+            ids = ids[:-1]
+        else:
+            pair_ids = pair_ids[:-1]
+    return ids, pair_ids
+
+
+def expected_row(question, context_prefix, sentences, retrieved, candidate, max_length=None):
+    context = list(context_prefix)
+    for j, sentence in enumerate(sentences):
+        if j in retrieved:
+            context += sentence
+    context += sentences[candidate]
+    if max_length is not None:
+        excess = max(len(question) + len(context) + 4 - max_length, 0)
+        question, context = truncate_longest_first(question, context, excess)
+    return [BOS] + question + [EOS, EOS] + context + [EOS]
+
+
+def padded(rows, length=None):
+    length = length or max(len(r) for r in rows)
+    return torch.tensor([r + [PAD] * (length - len(r)) for r in rows])
+
+
+def check(question, context_prefix, sentences, retrieved, max_length=None):
+    prefix = padded([[BOS] + question + [EOS, EOS] + context_prefix], 20)
+    sentences_ = padded(sentences).unsqueeze(0)
+    retrieved_ = torch.zeros(1, len(sentences), dtype=torch.bool)
+    retrieved_[0, list(retrieved)] = True
+
+    rows = utils.build_rollout_rows(prefix, sentences_, retrieved_, PAD, EOS, max_length)[0]
+    for j in range(len(sentences)):
+        row = [i for i in rows[j].tolist() if i != PAD]
+        if j in retrieved:
+            assert row == []
+        else:
+            assert row == expected_row(question, context_prefix, sentences, retrieved, j, max_length)
+
+
+def test_rows_are_retrieved_sentences_in_context_order_then_candidate():
+    check([10, 11], [], [[20, 21], [30], [40, 41, 42]], {2, 0})
+
+
+def test_rows_with_context_prefix():
+    check([10, 11], [5], [[20, 21], [30], [40, 41, 42]], {1})
+
+
+@pytest.mark.parametrize("max_length", [14, 12, 10, 8, 7])
+def test_rows_truncated_longest_first(max_length):
+    check([10, 11, 12, 13, 14], [5], [[20, 21], [30], [40, 41, 42]], {0}, max_length)
+    check([10], [], [[20, 21, 22, 23], [30], [40, 41, 42]], {0}, max_length)
+
+
+def test_rows_below_max_length_are_unchanged():
+    question, sentences = [10, 11], [[20, 21], [30]]
+    prefix = padded([[BOS] + question + [EOS, EOS]])
+    retrieved = torch.tensor([[True, False]])
+    rows = utils.build_rollout_rows(prefix, padded(sentences).unsqueeze(0), retrieved, PAD, EOS)
+    truncated = utils.build_rollout_rows(prefix, padded(sentences).unsqueeze(0), retrieved, PAD, EOS, 512)
+    assert torch.equal(rows, truncated)
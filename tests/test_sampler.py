@@ -0,0 +1,88 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("ruletaker.allennlp_models")
+sampler = pytest.importorskip("ruletaker.allennlp_models.dataset_readers.sampler")
+
+
+def make_instance(qlen, sentence_lengths):
+    metadata = SimpleNamespace(metadata={'QLen': qlen})
+    sentences = [SimpleNamespace(tokens=[None] * l) for l in sentence_lengths]
+    return SimpleNamespace(fields={'metadata': metadata, 'retrieval': SimpleNamespace(field_list=sentences)})
+
+
+def make_batch_sampler(dataset, **kwargs):
+    batch_sampler = sampler.TokenBudgetBatchSampler(sampler.CustomSequentialSampler(dataset), **kwargs)
+    batch_sampler.req_QLens = [1, 2]
+    return batch_sampler
+
+
+def test_instance_without_sentences_has_zero_length():
+    instance = make_instance(1, [])
+    assert sampler.CustomSequentialSampler._instance_length(instance) == (0, 0)
+
+
+def test_retrieval_batches_fit_the_token_budget():
+    dataset = [make_instance(1 + n % 2, [4 + n % 3] * 3) for n in range(20)] + [make_instance(1, [50] * 3)]
+    batch_sampler = make_batch_sampler(dataset, batch_size=2, max_tokens=40, padding_noise=0.)
+    batches = list(batch_sampler)
+
+    assert sorted(i for b in batches for i in b) == list(range(len(dataset)))
+    for batch in batches:
+        # One QLen per batch
+        assert len({dataset[i].fields['metadata'].metadata['QLen'] for i in batch}) == 1
+        n_sentences = max(sampler.CustomSequentialSampler._instance_length(dataset[i])[0] for i in batch)
+        length = max(sampler.CustomSequentialSampler._instance_length(dataset[i])[1] for i in batch)
+        # Only an instance over the budget on its own may exceed it
+        assert len(batch) * n_sentences * length <= 40 or len(batch) == 1
+    assert [20] in batches
+
+
+def test_max_instances_caps_retrieval_batches():
+    dataset = [make_instance(1, [2]) for _ in range(10)]
+    batch_sampler = make_batch_sampler(dataset, batch_size=2, max_tokens=1000, max_instances=3)
+    assert sorted(len(b) for b in batch_sampler) == [1, 3, 3, 3]
+
+
+def test_binary_classification_batches_use_batch_size():
+    dataset = [make_instance(1, [2]) for _ in range(7)]
+    batch_sampler = make_batch_sampler(dataset, batch_size=3, max_tokens=1000)
+    batch_sampler.sampler.samples = list(range(7))
+    batch_sampler.set_mode('binary_classification')
+    assert list(batch_sampler) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert len(batch_sampler) == 3
+
+
+def test_len_matches_the_batches_of_the_next_iteration(monkeypatch):
+    dataset = [make_instance(1 + n % 2, [2 + n % 5] * (1 + n % 3)) for n in range(40)]
+    batch_sampler = make_batch_sampler(dataset, batch_size=2, max_tokens=30, padding_noise=0.5)
+    for _ in range(5):
+        n_batches = len(batch_sampler)
+        assert len(batch_sampler) == n_batches
+        assert len(list(batch_sampler)) == n_batches
+
+    calls = []
+    make_batches = batch_sampler._make_batches
+    monkeypatch.setattr(batch_sampler, '_make_batches', lambda noise: calls.append(noise) or make_batches(noise))
+    len(batch_sampler)
+    batches = list(batch_sampler)
+    assert calls == [0.5]
+    # A new plan after each epoch and when the QLens change
+    batch_sampler.req_QLens = [1]
+    assert len(batch_sampler) == len(list(batch_sampler)) and calls == [0.5, 0.5]
+    assert len(batches) > len(batch_sampler)
+
+
+def test_drop_last_is_rejected():
+    with pytest.raises(ValueError):
+        make_batch_sampler([make_instance(1, [2])], batch_size=2, max_tokens=10, drop_last=True)
+
+
+def test_max_pieces_budgets_rows_after_the_rollout():
+    # Rows of 4 pieces grow to 4 * QLen, capped at max_pieces = 10
+    dataset = [make_instance(1, [4] * 2) for _ in range(6)] + [make_instance(2, [4] * 2) for _ in range(6)]
+    batch_sampler = make_batch_sampler(dataset, batch_size=2, max_tokens=40, padding_noise=0., max_pieces=10)
+    batches = list(batch_sampler)
+    sizes = {qlen: sorted(len(b) for b in batches if dataset[b[0]].fields['metadata'].metadata['QLen'] == qlen) for qlen in (1, 2)}
+    assert sizes == {1: [1, 5], 2: [2, 2, 2]}
@@ -0,0 +1,79 @@
+import pytest
+import torch
+
+pytest.importorskip("ruletaker.allennlp_models")
+score_cache = pytest.importorskip("ruletaker.allennlp_models.models.score_cache")
+
+PAD = 1
+
+
+class Scorer:
+    def __init__(self):
+        self.rows_scored = 0
+
+    def __call__(self, rows):
+        self.rows_scored += rows.size(0)
+        mask = (rows != PAD).float()
+        return torch.stack([(rows.float() * mask).sum(-1), mask.sum(-1)], dim=-1)
+
+
+def test_keys_ignore_trailing_padding():
+    rows = torch.tensor([[0, 5, 6, 2, PAD], [0, 5, 6, 2, PAD]])
+    longer = torch.tensor([[0, 5, 6, 2, PAD, PAD, PAD]])
+    keys = score_cache.RetrievalScoreCache.keys(rows, PAD)
+    assert keys[0] == keys[1] == score_cache.RetrievalScoreCache.keys(longer, PAD)[0]
+
+
+def test_keys_of_different_rows_differ():
+    rows = torch.tensor([[0, 5, 6, 2], [0, 6, 5, 2], [0, 5, 6, PAD], [0, 5, 2, PAD]])
+    keys = score_cache.RetrievalScoreCache.keys(rows, PAD)
+    assert len(set(keys)) == len(keys)
+    # Same ids in a different dtype give the same key
+    assert keys == score_cache.RetrievalScoreCache.keys(rows.int(), PAD)
+
+
+def test_cached_row_outputs_only_scores_new_rows():
+    cache = score_cache.RetrievalScoreCache()
+    scorer = Scorer()
+    rows = torch.tensor([[0, 5, 6, 2], [0, 7, 2, PAD], [0, 5, 6, 2]])
+
+    out = score_cache.cached_row_outputs(cache, rows, PAD, scorer)
+    assert torch.equal(out, scorer(rows))
+    assert scorer.rows_scored == 2 + 3       # Duplicate row scored once (+ the reference call)
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    more = torch.tensor([[0, 7, 2, PAD, PAD], [0, 8, 2, PAD, PAD]])
+    scorer.rows_scored = 0
+    out = score_cache.cached_row_outputs(cache, more, PAD, scorer)
+    assert scorer.rows_scored == 1
+    assert out.tolist() == [[9, 3], [10, 3]]
+    assert cache.hit_rate() == pytest.approx(2 / 5)
+
+
+def test_lru_eviction():
+    cache = score_cache.RetrievalScoreCache(max_entries=2)
+    cache.push([b'a', b'b'], [torch.tensor([1.0]), torch.tensor([2.0])])
+    assert cache.lookup([b'a'])[0].tolist() == [1.0]        # b is now least recently used
+    cache.push([b'c'], [torch.tensor([3.0])])
+    assert len(cache) == 2
+    b, a, c = cache.lookup([b'b', b'a', b'c'])
+    assert b is None and a.tolist() == [1.0] and c.tolist() == [3.0]
+
+
+def test_memory_limit():
+    cache = score_cache.RetrievalScoreCache(max_memory_mb=1e-3)
+    cache.push([bytes([i]) for i in range(100)], [torch.tensor([float(i)]) for i in range(100)])
+    assert 0 < len(cache) < 100
+    assert cache._bytes <= 1e-3 * 2 ** 20
+
+
+def test_cached_values_are_detached_tensors():
+    cache = score_cache.RetrievalScoreCache()
+    weight = torch.ones(2, requires_grad=True)
+    rows = torch.tensor([[0, 5, 2], [0, 6, 2]])
+    score_cache.cached_row_outputs(cache, rows, PAD, lambda r: Scorer()(r) * weight)
+
+    out = score_cache.cached_row_outputs(cache, rows, PAD, Scorer())
+    assert not out.requires_grad and out.dtype == torch.float
+    assert all(isinstance(v, torch.Tensor) and not v.requires_grad for v in cache.memory.values())
+    assert torch.equal(out, Scorer()(rows))
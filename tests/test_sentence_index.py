@@ -0,0 +1,86 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+from torch import nn
+
+pytest.importorskip("ruletaker.allennlp_models")
+sentence_index = pytest.importorskip("ruletaker.allennlp_models.models.sentence_index")
+retriever_embedders = pytest.importorskip("ruletaker.allennlp_models.models.retriever_embedders")
+transformers = pytest.importorskip("transformers")
+
+PAD = 1
+
+
+def make_embedder():
+    torch.manual_seed(0)
+    config = transformers.RobertaConfig(
+        vocab_size=20, hidden_size=16, num_hidden_layers=2, num_attention_heads=2,
+        intermediate_size=32, max_position_embeddings=40, pad_token_id=PAD,
+    )
+    embedder = retriever_embedders.TransformerRetrievalEmbedder.__new__(
+        retriever_embedders.TransformerRetrievalEmbedder
+    )
+    nn.Module.__init__(embedder)
+    embedder.embedder = transformers.RobertaModel(config).eval()
+    return embedder
+
+
+def test_row_keys_ignore_trailing_padding():
+    rows = torch.tensor([[0, 5, 2, PAD, PAD], [0, 5, 2, PAD, PAD], [0, 6, 2, PAD, PAD], [PAD] * 5])
+    keys = sentence_index.row_keys(rows, PAD)
+    assert keys[0] == keys[1] == sentence_index.row_keys(rows[:1, :3], PAD)[0]
+    assert keys[0] != keys[2] and keys[3] == 0
+
+
+IDXS = torch.tensor([[
+    [0, 5, 6, 7, 2],
+    [0, 8, 2, PAD, PAD],
+    [0, 9, 10, 2, PAD],
+]])
+
+
+def test_forward_is_the_unmasked_baseline():
+    embedder = make_embedder()
+    with torch.no_grad():
+        forward_embs = embedder(IDXS)
+        unmasked = embedder.embedder(IDXS[0])[0][:, 0]
+        masked = embedder.embed_rows(IDXS[0])
+    assert torch.equal(forward_embs[0], unmasked)
+    # Only padded rows differ
+    assert torch.allclose(forward_embs[0, 0], masked[0], atol=1e-5)
+    assert not torch.allclose(forward_embs[0, 1], masked[1], atol=1e-3)
+
+
+def test_index_path_embeds_every_row_with_the_padding_mask(tmp_path):
+    qa_retriever = pytest.importorskip("ruletaker.allennlp_models.models.transformer_binary_qa_retriever")
+    embedder = make_embedder()
+    with torch.no_grad():
+        model = SimpleNamespace(sentence_index=None, retriever_model=embedder)
+        assert torch.equal(qa_retriever.TransformerBinaryQARetriever.embed_sentences(model, IDXS), embedder(IDXS))
+
+        model.sentence_index = sentence_index.SentenceEmbeddingIndex.build(
+            str(tmp_path / 'index'), [IDXS[0, 1:]], embedder.embed_rows, PAD, batch_size=2
+        )
+        index_embs = qa_retriever.TransformerBinaryQARetriever.embed_sentences(model, IDXS)
+        # Embedding each row on its own, without padding
+        unpadded = torch.stack([embedder.embed_rows(row[row != PAD].unsqueeze(0))[0] for row in IDXS[0]])
+
+    assert model.sentence_index.hits == 2
+    assert torch.allclose(index_embs[0], unpadded, atol=1e-5)
+
+
+def test_lookup_embeds_missing_rows_and_zeros_padding(tmp_path):
+    embedder = make_embedder()
+    indexed = torch.tensor([[0, 5, 2], [0, 6, 2]])
+    index = sentence_index.SentenceEmbeddingIndex.build(str(tmp_path / 'index'), [indexed], embedder.embed_rows, PAD)
+    assert len(index) == 2 and sentence_index.SentenceEmbeddingIndex.exists(str(tmp_path / 'index'))
+
+    rows = torch.tensor([[0, 6, 2, PAD], [0, 7, 2, PAD], [PAD] * 4])
+    computed = []
+    with torch.no_grad():
+        embs = index.lookup(rows, lambda missing: computed.append(missing) or embedder.embed_rows(missing))
+    assert index.hits == 1 and index.misses == 1
+    assert len(computed) == 1 and computed[0].tolist() == [[0, 7, 2, PAD]]
+    assert torch.equal(embs[2], torch.zeros_like(embs[2]))
+    assert torch.allclose(embs[0], embedder.embed_rows(indexed[1:]).detach()[0], atol=1e-5)
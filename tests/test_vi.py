@@ -0,0 +1,104 @@
+import itertools
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+pytest.importorskip("ruletaker.allennlp_models")
+vi = pytest.importorskip("ruletaker.allennlp_models.models.vi")
+
+
+def test_draw_samples_are_ordered_subsets_without_replacement():
+    model = SimpleNamespace(n_z=3, num_samples=4)
+    z = vi.ELBO._draw_samples(model, torch.randn(2, 5))
+    assert z.shape == (2, 4, 3)
+    for sample in z.view(-1, 3).tolist():
+        assert len(set(sample)) == 3
+
+
+def test_draw_samples_caps_n_z_at_the_number_of_sentences():
+    model = SimpleNamespace(n_z=5, num_samples=1)
+    assert vi.ELBO._draw_samples(model, torch.randn(2, 3)).shape == (2, 1, 3)
+
+
+def test_sample_logprobs_of_single_sentences_are_the_log_softmax():
+    logits = torch.randn(2, 4)
+    z = torch.tensor([[[1], [3]], [[0], [2]]])
+    logprobs = vi.ELBO._sample_logprobs(None, logits, z)
+    assert torch.allclose(logprobs, logits.log_softmax(-1).gather(-1, z.squeeze(-1)))
+
+
+def test_sample_logprobs_sum_to_one_over_all_ordered_subsets():
+    logits = torch.randn(1, 4)
+    z = torch.tensor(list(itertools.permutations(range(4), 2))).unsqueeze(0)
+    logprobs = vi.ELBO._sample_logprobs(None, logits, z)
+    assert torch.allclose(logprobs.exp().sum(), torch.tensor(1.), atol=1e-5)
+
+
+def test_prep_batch_keeps_the_context_of_every_sample():
+    encoded = []
+    reader = SimpleNamespace(
+        batch_encode=lambda sentences: encoded.extend(sentences) or 'batch',
+        move=lambda batch, device: batch,
+    )
+    model = SimpleNamespace(dataset_reader=reader, _d='cpu')
+    metadata = [{'question_text': 'Q?', 'context': 'A. B. C.'}]
+    z = torch.tensor([[[0, 2], [1, 0]]])
+
+    assert vi.ELBO._prep_batch(model, z, metadata, [1]) == 'batch'
+    assert encoded == [('Q?', 'A. C.', 1), ('Q?', 'A. B.', 1)]
+    assert metadata[0]['context_str'] == ['q: Q? c: A. C.', 'q: Q? c: A. B.']
+
+
+def _loop_first_last(embs, x, split_idx):
+    # The per-example loop the pooler replaced
+    rows = []
+    for b in range(x.size(0)):
+        end_idxs = (x[b] == split_idx).nonzero().view(-1).tolist()
+        end_idxs[0] += 5
+        rows.append([
+            torch.cat([embs[b, end_idxs[i - 1]], embs[b, end_idxs[i] - 1]])
+            for i in range(1, len(end_idxs))
+        ])
+    return rows
+
+
+SPLIT = 9
+TOKENS = torch.tensor([
+    [0, 1, SPLIT, 2, 2, 2, 2, 2, 3, 4, SPLIT, 5, SPLIT, 6, 7, 8, SPLIT],
+    [0, 1, 1, SPLIT, 2, 2, 2, 2, 2, 3, 3, 4, SPLIT, 1, 1, 1, 1],
+])
+
+
+def test_first_last_pooling_matches_the_per_example_loop():
+    embs = torch.randn(2, TOKENS.size(1), 3)
+    reprs, mask = vi.SentenceSpanPooler(SPLIT)(embs, TOKENS)
+    assert mask.tolist() == [[True, True, True], [True, False, False]]
+    for b, expected in enumerate(_loop_first_last(embs, TOKENS, SPLIT)):
+        assert torch.equal(reprs[b, :len(expected)], torch.stack(expected))
+
+
+def test_mean_and_max_pooling_cover_the_first_last_span():
+    embs = torch.arange(TOKENS.numel(), dtype=torch.float).view(2, -1, 1)
+    mean, mask = vi.SentenceSpanPooler(SPLIT, 'mean')(embs, TOKENS)
+    max_, _ = vi.SentenceSpanPooler(SPLIT, 'max')(embs, TOKENS)
+    # Spans (as in first_last, from the previous full stop to the token before
+    # the next): tokens 7-9, 10-11 and 12-15 of the first row, 25-28 of the second
+    assert mean[0, :, 0].tolist() == [8., 10.5, 13.5]
+    assert max_[0, :, 0].tolist() == [9., 11., 15.]
+    assert mean[1, :, 0].tolist() == [26.5, 0., 0.]
+    assert max_[1, :, 0].tolist() == [28., 0., 0.]
+    assert vi.SentenceSpanPooler(SPLIT, 'mean').output_dim(4) == 4
+    assert vi.SentenceSpanPooler(SPLIT).output_dim(4) == 8
+
+
+def test_sentence_classifier_gives_padded_sentences_a_zero_logit():
+    embs = torch.randn(2, TOKENS.size(1), 3)
+    W = torch.nn.Linear(6, 1)
+    model = SimpleNamespace(
+        model=lambda x: (embs,), _pooler=vi.SentenceSpanPooler(SPLIT), _W=W,
+    )
+    logprobs = vi._BaseSentenceClassifier.forward(model, TOKENS)
+    logits = [W(torch.stack(row)).squeeze(-1) for row in _loop_first_last(embs, TOKENS, SPLIT)]
+    expected = torch.stack([logits[0], torch.cat([logits[1], torch.zeros(2)])])
+    assert torch.allclose(logprobs, expected.log_softmax(-1))